@@ -16,6 +16,9 @@ import torch
 # 模型效果测试及评估：        sft_batch_test
 # 奖励模型效果测试及评估：     rm_batch_test
 # 扩充词表：                  expand_vocab
+# 预训练语料离线分词：         tokenize_corpus
+# 数据集统计：                dataset_stats
+# 显存估算：                  estimate_memory
 
 
 @dataclass
@@ -28,7 +31,8 @@ class WorkingMode:
             'choices': ['pretrain', 'sft_train', 'rm_train', 'ppo_train',
                         'dpo_train', 'web_inference', 'terminal_inference',
                         'merge_lora_model', 'show_model_info', 'save_quantized_model',
-                        'sft_batch_test', 'rm_batch_test', 'expand_vocab'],
+                        'sft_batch_test', 'rm_batch_test', 'expand_vocab', 'tokenize_corpus',
+                        'dataset_stats', 'estimate_memory'],
         }
     )
 
@@ -245,8 +249,9 @@ class DataTrainingArguments:
     dev_ratio: Optional[float] = field(
         default=0,
         metadata={
-            # 如果要验证模型结果，但是又没有数据集，愿意从训练集拿多少比例的数据给验证集？
-            'help': 'Proportion of the dataset to include in the development set, should be between 0.0 and 1.0.'
+            # 如果要验证模型结果，但是又没有数据集，愿意从训练集拿多少百分比的数据给验证集？
+            # 按每条数据的哈希值随机划分，新增文件不会改变已有数据的划分。
+            'help': 'Percentage of the dataset to include in the development set, should be between 0 and 100.'
         }
     )
     prompt_template: Optional[str] = field(
@@ -259,6 +264,22 @@ class DataTrainingArguments:
                         'linksoul', 'xverse', 'tigerbot', 'flagalpha', 'chatglm3', 'orca', 'yi']
         }
     )
+    stats_mode: Optional[str] = field(
+        default='sft_train',
+        metadata={
+            # dataset_stats模式统计哪一种训练模式的数据，统计长度分布、截断比例、不同batch size和packing下的padding比例及每个epoch的步数。
+            'help': 'Which training mode the dataset_stats mode profiles the data of.',
+            'choices': ['pretrain', 'sft_train', 'rm_train', 'ppo_train', 'dpo_train']
+        }
+    )
+    compile_prompt_template: Optional[bool] = field(
+        default=True,
+        metadata={
+            # 把prompt模板里面固定的部分（system前缀、角色标记、分隔符）只分词一次，之后直接拼接token id，
+            # 如果分段分词和整句分词的结果不一致会自动退回整句分词。
+            'help': 'Whether to tokenize the constant segments of the prompt template once and reuse their ids.'
+        }
+    )
     overwrite_cache: Optional[bool] = field(
         default=True,
         metadata={
@@ -280,6 +301,91 @@ class DataTrainingArguments:
             'help': 'Max token of model input.'
         }
     )
+    streaming: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 预训练时流式读取语料，边读边分词并拼接成max_input_token长度的块，不需要提前把整个语料处理好，
+            # 各个进程和dataloader的worker读取不同的分片，开启后需要设置max_steps。
+            'help': 'Whether to stream the pretrain corpus instead of tokenizing all of it before training.'
+        }
+    )
+    shuffle_buffer_size: Optional[int] = field(
+        default=10000,
+        metadata={
+            # 流式读取时打乱数据所用的缓冲区大小（文本条数）。
+            'help': 'The size of the buffer used to shuffle the streaming corpus.'
+        }
+    )
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            # 按文件缓存分词后的数据集，缓存的key包含文件内容、tokenizer、prompt模板、工作模式和max_input_token等，
+            # 设置后只有新增或者修改过的文件才会重新分词，不受overwrite_cache影响。
+            'help': 'The folder to cache the tokenized dataset of every data file.'
+        }
+    )
+    sharded_preprocessing: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 分布式训练时每个rank按文件大小分到一部分文件并行分词，写进tokenized_cache_dir，同步之后合并各rank的索引
+            # 再读取完整的数据集，不再由主进程单独分词。tokenized_cache_dir需要所有节点都能访问。
+            'help': 'Whether every rank tokenizes its own share of the data files into the shared tokenized cache.'
+        }
+    )
+    token_shards_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            # tokenize_corpus模式把train_file_dir和validation_file_dir下的语料分词后保存到该路径，
+            # 预训练时设置该路径后直接用内存映射的方式读取分好词的token，不再重复分词。
+            'help': 'The folder of the memory-mapped token shards written by tokenize_corpus mode.'
+        }
+    )
+    sft_packing: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 指令微调时把多条样本拼接进同一个max_input_token长度的块里面，减少padding，每条样本的position ids重新计数，
+            # 通过分段的attention mask隔离块内样本，仅支持llama和mistral，验证集不拼接。
+            'help': 'Whether to pack several samples into one block in supervised fine-tuning.'
+        }
+    )
+    pretrain_append_eos: Optional[bool] = field(
+        default=True,
+        metadata={
+            # 预训练拼接文档时在每篇文档末尾补上eos，模型能学到文档的边界。
+            'help': 'Whether to append the eos token to every document before the documents are concatenated.'
+        }
+    )
+    pretrain_document_mask: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 预训练时同一个块内的文档互相不可见，每篇文档的position ids重新计数，文档的首个token不计算loss，
+            # llama和mistral会通过分段的attention mask隔离块内文档，其它模型只重置position ids。
+            'help': 'Whether to keep the documents packed into one block from attending to each other in pretraining.'
+        }
+    )
+    dedup: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 分词之前去除训练集和验证集里面的重复数据，先对归一化后的文本做精确哈希去重，再用MinHash-LSH去除近似重复，
+            # 训练集和验证集一起去重，和训练集重复的验证集样本会被去掉。签名由主进程使用preprocessing_num_workers个进程计算，
+            # 去重结果再广播给其它进程。
+            'help': 'Whether to remove the exact and near duplicates before tokenization.'
+        }
+    )
+    dedup_threshold: Optional[float] = field(
+        default=0.8,
+        metadata={
+            # 近似去重的Jaccard相似度阈值，设为1只做精确去重。
+            'help': 'The estimated Jaccard similarity above which two samples are near duplicates.'
+        }
+    )
+    dedup_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            # 按文件保存去重签名的路径，设置后只有新增或者修改过的文件才会重新计算签名。
+            'help': 'The folder to keep the dedup signatures of every data file.'
+        }
+    )
     ignore_pad_token_for_loss: Optional[bool] = field(
         default=True,
         metadata={
@@ -313,6 +419,131 @@ class TrainingArguments(Seq2SeqTrainingArguments):
             'help': 'Whether to use firefly loss.'
         }
     )
+    chunked_ce_loss: bool = field(
+        default=False,
+        metadata={
+            # 指令微调时只取有label的位置的hidden states，分块经过lm_head并计算交叉熵，反向时逐块重算logits，
+            # 不会生成完整的[batch, seq, vocab]的logits，qwen这种词表很大的模型可以省下大量显存。
+            'help': 'Whether to compute the sft loss chunk by chunk on the supervised positions only.'
+        }
+    )
+    ce_chunk_size: int = field(
+        default=4096,
+        metadata={
+            # 分块交叉熵每一块的token数
+            'help': 'Number of tokens in every chunk of the chunked cross entropy.'
+        }
+    )
+    rm_shared_prompt: bool = field(
+        default=False,
+        metadata={
+            # 奖励模型训练时同一个prompt只计算一次，后面接上它的所有回答，每个回答只能看到prompt和自己，
+            # output可以是按好坏排序的多个回答，loss取组内所有两两比较的平均。仅支持llama和mistral，不能和flash attention同时使用。
+            'help': 'Whether to run the prompt of a group of responses only once in reward model training.'
+        }
+    )
+    throughput_metrics: bool = field(
+        default=False,
+        metadata={
+            # 训练时记录每张卡每秒的有效token数、padding占比、MFU、等待dataloader和前向反向的耗时、显存峰值，
+            # 写入日志，训练结束后保存到output_dir下的throughput_results.json。计时用cuda event，只在打日志时同步。
+            # PPO的MFU只按策略模型的一次训练计算，不含生成、奖励模型和参考模型的前向，是一个下限。
+            'help': 'Whether to log the tokens per second, padding fraction, MFU, data stalls and peak memory.'
+        }
+    )
+    peak_tflops: Optional[float] = field(
+        default=None,
+        metadata={
+            # 计算MFU用的单卡峰值算力(TFLOPS)，不设置时按显卡型号查bf16的稠密算力，查不到就不计算MFU。
+            'help': 'Peak TFLOPS of one device for the MFU, looked up by the device name when it is not set.'
+        }
+    )
+    torch_profile: bool = field(
+        default=False,
+        metadata={
+            # 用torch.profiler采集一段训练步(训练模式)或一段生成(web_inference和terminal_inference模式)，
+            # 每段采集完后在output_dir/profile下导出chrome trace和耗时最多的算子表，CPU上也可以使用。
+            'help': 'Whether to profile a window of training steps or generations with torch.profiler.'
+        }
+    )
+    profile_wait: int = field(
+        default=1,
+        metadata={
+            # 开始采集前跳过的步数
+            'help': 'Number of steps skipped before every profiling window.'
+        }
+    )
+    profile_warmup: int = field(
+        default=1,
+        metadata={
+            # 采集前预热的步数，预热的步不计入结果
+            'help': 'Number of warmup steps of every profiling window, they are not recorded.'
+        }
+    )
+    profile_active: int = field(
+        default=3,
+        metadata={
+            # 每段采集的步数
+            'help': 'Number of steps recorded in every profiling window.'
+        }
+    )
+    profile_repeat: int = field(
+        default=1,
+        metadata={
+            # 采集的段数
+            'help': 'Number of profiling windows.'
+        }
+    )
+    profile_record_shapes: bool = field(
+        default=True,
+        metadata={
+            # 记录算子输入的shape，算子表按shape分组
+            'help': 'Whether to record the input shapes of the operators.'
+        }
+    )
+    profile_memory: bool = field(
+        default=False,
+        metadata={
+            # 记录算子的显存和内存分配
+            'help': 'Whether to record the memory allocated by the operators.'
+        }
+    )
+    profile_with_stack: bool = field(
+        default=False,
+        metadata={
+            # 记录算子的python调用栈，开销较大
+            'help': 'Whether to record the python stack of the operators.'
+        }
+    )
+    profile_row_limit: int = field(
+        default=30,
+        metadata={
+            # 算子表保留的行数
+            'help': 'Number of operators in the table of top operators.'
+        }
+    )
+    estimate_mode: Optional[str] = field(
+        default='sft_train',
+        metadata={
+            # estimate_memory模式估算哪一种训练模式的显存，只读取模型的config，不加载权重。
+            'help': 'Which training mode the estimate_memory mode estimates the memory of.',
+            'choices': ['pretrain', 'sft_train', 'rm_train', 'ppo_train', 'dpo_train']
+        }
+    )
+    estimate_num_devices: Optional[int] = field(
+        default=None,
+        metadata={
+            # 估算显存时训练用的卡数，deepspeed按卡数切分，不设置时取WORLD_SIZE或者本机的卡数。
+            'help': 'Number of devices of the training the memory is estimated for.'
+        }
+    )
+    estimate_device_memory_gb: Optional[float] = field(
+        default=None,
+        metadata={
+            # 估算时每张卡的显存(GB)，不设置时取本机第一张卡的显存。
+            'help': 'Memory of one device in GB, the first cuda device is used when it is not set.'
+        }
+    )
     output_dir: str = field(
         default='checkpoint/sft',
         metadata={
@@ -540,6 +771,38 @@ class TrainingArguments(Seq2SeqTrainingArguments):
             'help': 'Log the first global_step'
         }
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            # 按token数量动态组batch，设置后指令微调、奖励模型和DPO训练会把长度相近的样本分到一起，
+            # 每个batch补齐后的token数不超过该值，此时per_device_train_batch_size不再生效。
+            'help': 'Token budget of each training batch after padding, '
+                    'batches are built by length bucketing when it is set.'
+        },
+    )
+    token_balanced_sampler: Optional[bool] = field(
+        default=False,
+        metadata={
+            # 数据并行训练时在全局窗口内按token数给各个rank分配样本，每一步各rank的micro-batch的token数相近，
+            # 减少等待最慢rank的时间，日志里的token_imbalance是每步最慢的rank比平均多出的token比例。
+            'help': 'Whether to balance the tokens of the micro-batches of all ranks at every step.'
+        },
+    )
+    balance_window_steps: Optional[int] = field(
+        default=8,
+        metadata={
+            # 每次在多少个全局batch组成的窗口内按长度排序再分配，窗口越大越均衡但随机性越低。
+            'help': 'Number of global batches sorted and partitioned together by the token balanced sampler.'
+        },
+    )
+    balance_method: Optional[str] = field(
+        default='karmarkar_karp',
+        metadata={
+            # 每一步把全局batch分给各rank的方法，greedy为排序后贪心，karmarkar_karp为平衡的最大差分法
+            'help': 'How the token balanced sampler partitions a global batch across the ranks.',
+            'choices': ['greedy', 'karmarkar_karp'],
+        },
+    )
     noise_alpha: Optional[float] = field(
         default=0,
         metadata={
@@ -677,6 +940,32 @@ class TrainingArguments(Seq2SeqTrainingArguments):
             'help': 'The beta factor in DPO loss. Higher beta means less divergence from the initial policy.'
         }
     )
+    dpo_precompute_ref_log_probs: Optional[bool] = field(
+        default=False,
+        metadata={
+            # DPO训练开始时（模型放到设备上之后）先用参考模型把chosen和rejected的log-probs算好，保存在output_dir下的内存映射文件里面，
+            # 训练时直接读取，不需要再拷贝一份参考模型，也不需要每一步都做一次参考模型的前向计算。
+            'help': 'Whether to precompute the reference log-probs once instead of keeping a reference model.'
+        }
+    )
+    dpo_reference: Optional[str] = field(
+        default='copy',
+        metadata={
+            # DPO参考模型的来源，copy: 拷贝一份完整的模型作为参考模型；
+            # disable_adapter: 合并SFT的adapter后训练新的lora，参考模型就是关掉lora的同一份权重，不需要拷贝模型；
+            # sft_adapter: 不合并SFT的adapter，从它继续训练，同时加载一份冻结的SFT adapter用于计算参考模型，可以用于qlora。
+            'help': 'Where the reference model of DPO comes from.',
+            'choices': ['copy', 'disable_adapter', 'sft_adapter'],
+        }
+    )
+    dpo_packing: bool = field(
+        default=False,
+        metadata={
+            # DPO训练时把一个batch的chosen和rejected样本首尾拼接成一行，不做padding，每条样本的position ids重新计数，
+            # 样本之间的attention通过分段的mask隔离，参考模型的前向也一样。仅支持llama和mistral，且需要开启use_flash_attn。
+            'help': 'Whether to concatenate the chosen and rejected samples of a batch into one row without padding.'
+        }
+    )
     log_with: Optional[str] = field(
         default='wandb',
         metadata={
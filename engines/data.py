@@ -5,18 +5,32 @@
 # @File : data.py
 # @Software: PyCharm
 from transformers import AutoTokenizer, LlamaTokenizer, BloomTokenizerFast
-from transformers import DataCollatorWithPadding
-from engines.utils.prompt_template import Template
-from datasets import load_dataset
+from engines.utils.prompt_template import Template, CompiledTemplate
+from engines.utils.packing import pack_supervised_samples, PretrainPacker, document_positions
+from engines.utils.streaming import StreamingPretrainDataset
+from engines.utils.data_files import DATA_FILE_SUFFIXES, get_file_format, load_data_files
+from engines.utils.token_shards import write_token_shards, MemmapPretrainDataset, META_NAME
+from engines.utils.tokenize_cache import TokenizedFileCache, hash_tokenizer, assign_files_to_ranks
+from engines.utils.dedup import Deduplicator, example_to_text
+from engines.utils.samplers import compute_sample_lengths, TokenBudgetBatchSampler
+from engines.utils.dataset_stats import summarize_lengths, length_histogram, padding_fraction, packed_block_lengths
+from engines.utils.dataset_stats import steps_per_epoch, format_stats_table
+from datasets import concatenate_datasets, Dataset, DatasetDict
 from itertools import chain
 from glob import glob
+import hashlib
+import json
+import sys
+import numpy as np
+import torch
 import os
 
 
 class DataManager:
     def __init__(self, config, logger):
         self.logger = logger
-        self.mode = config.mode
+        # dataset_stats mode profiles the data pipeline of stats_mode
+        self.mode = config.data_args.stats_mode if config.mode == 'dataset_stats' else config.mode
         self.data_args = config.data_args
         self.model_args = config.model_args
         self.training_args = config.training_args
@@ -24,11 +38,26 @@ class DataManager:
         logger.info(f'Load tokenizer from {self.model_args.model_path}')
         self.tokenizer = self.load_tokenizer(self.model_args.model_path)
         self.logger.info(f'Tokenizer:\n{self.tokenizer}')
+        self.compiled_template = None
+        if self.data_args.compile_prompt_template:
+            self.compiled_template = CompiledTemplate(self.prompt_template, self.tokenizer, logger)
         if self.data_args.ignore_pad_token_for_loss:
             self.label_pad_token_id = -100
         else:
             self.label_pad_token_id = self.tokenizer.pad_token_id
         self.use_firefly_loss = self.training_args.use_firefly_loss
+        if self.data_args.sharded_preprocessing and self.data_args.tokenized_cache_dir is None:
+            raise ValueError('sharded_preprocessing requires a tokenized_cache_dir shared by all ranks.')
+        self.truncated_flags = None
+        self.deduplicator = None
+        self.dedup_keep_masks = None
+        if self.data_args.dedup:
+            self.deduplicator = Deduplicator(
+                self.data_args.dedup_threshold,
+                logger,
+                cache_dir=self.data_args.dedup_cache_dir,
+                num_proc=self.data_args.preprocessing_num_workers
+            )
 
     def load_tokenizer(self, model_path):
         if self.model_args.model_type in ['chatglm', 'baichuan', 'internlm', 'aquila', 'moss', 'xverse', 'mistral', 'yi']:
@@ -58,108 +87,223 @@ class DataManager:
                                      replace_additional_special_tokens=False)
         return tokenizer
 
+    @staticmethod
+    def get_data_files(file_dir):
+        return [file_path for suffix in DATA_FILE_SUFFIXES
+                for file_path in glob(f'{file_dir}/**/*{suffix}', recursive=True)]
+
+    def get_data_columns(self):
+        # only these columns are loaded from the data files
+        if self.mode == 'pretrain':
+            return ['text']
+        return ['instruction', 'input', 'output', 'history']
+
+    def get_split_data_files(self):
+        data_files = {}
+        if self.data_args.train_file_dir is not None and os.path.exists(self.data_args.train_file_dir):
+            data_files['train'] = self.get_data_files(self.data_args.train_file_dir)
+        if self.training_args.do_eval and self.data_args.validation_file_dir is not None \
+                and os.path.exists(self.data_args.validation_file_dir):
+            data_files['validation'] = self.get_data_files(self.data_args.validation_file_dir)
+        return data_files
+
     def load_datasets_from_files(self, test=False):
         data_files = {}
-        kwargs = {}
         if not test:
-            if self.data_args.train_file_dir is not None and os.path.exists(self.data_args.train_file_dir):
-                train_data_files = glob(f'{self.data_args.train_file_dir}/**/*.txt', recursive=True) + glob(
-                    f'{self.data_args.train_file_dir}/**/*.json', recursive=True) + glob(
-                    f'{self.data_args.train_file_dir}/**/*.jsonl', recursive=True)
-                self.logger.info(f"train files: {', '.join(train_data_files)}")
-                data_files['train'] = train_data_files
-            if self.training_args.do_eval and self.data_args.validation_file_dir is not None \
-                    and os.path.exists(self.data_args.validation_file_dir):
-                eval_data_files = glob(f'{self.data_args.validation_file_dir}/**/*.txt', recursive=True) + glob(
-                    f'{self.data_args.validation_file_dir}/**/*.json', recursive=True) + glob(
-                    f'{self.data_args.validation_file_dir}/**/*.jsonl', recursive=True)
-                self.logger.info(f"eval files: {', '.join(eval_data_files)}")
-                data_files['validation'] = eval_data_files
-            extension = 'text' if data_files['train'][0].endswith('txt') else 'json'
-            if extension == 'text':
-                kwargs['keep_linebreaks'] = True
-            raw_datasets = load_dataset(
-                extension,
-                data_files=data_files,
-                cache_dir=self.model_args.cache_dir,
-                **kwargs
-            )
+            data_files = self.get_split_data_files()
+            if 'train' in data_files:
+                self.logger.info(f"train files: {', '.join(data_files['train'])}")
+            if 'validation' in data_files:
+                self.logger.info(f"eval files: {', '.join(data_files['validation'])}")
+            raw_datasets = DatasetDict(
+                {split: self.load_raw_dataset(split_data_files) for split, split_data_files in data_files.items()})
+            if self.deduplicator is not None:
+                for split, split_data_files in data_files.items():
+                    raw_datasets[split] = self.deduplicate_dataset(raw_datasets[split], split_data_files)
             if self.training_args.do_eval and 'validation' not in raw_datasets.keys() \
                     and self.data_args.dev_ratio > 0.0:
-                raw_datasets['validation'] = load_dataset(
-                    extension,
-                    data_files=data_files,
-                    split=f'train[:{self.data_args.dev_ratio}%]',
-                    cache_dir=self.model_args.cache_dir,
-                    **kwargs
-                )
-                raw_datasets['train'] = load_dataset(
-                    extension,
-                    data_files=data_files,
-                    split=f'train[{self.data_args.dev_ratio}%:]',
-                    cache_dir=self.model_args.cache_dir,
-                    **kwargs
-                )
+                is_dev = self.get_dev_mask(raw_datasets['train'])
+                raw_datasets['validation'] = raw_datasets['train'].select(np.flatnonzero(is_dev))
+                raw_datasets['train'] = raw_datasets['train'].select(np.flatnonzero(~is_dev))
         else:
             if self.data_args.test_file is not None and os.path.exists(self.data_args.test_file):
-                test_data_files = glob(
-                    f'{self.data_args.test_file}/**/*.json', recursive=True) + glob(
-                    f'{self.data_args.test_file}/**/*.jsonl', recursive=True)
+                test_data_files = [file_path for file_path in self.get_data_files(self.data_args.test_file)
+                                   if get_file_format(file_path) != 'text']
                 self.logger.info(f"test files: {', '.join(test_data_files)}")
                 data_files['test'] = test_data_files
-            raw_datasets = load_dataset(
-                'json',
-                data_files=data_files,
-                cache_dir=self.model_args.cache_dir,
-            )
+            raw_datasets = DatasetDict(
+                {split: self.load_raw_dataset(split_data_files) for split, split_data_files in data_files.items()})
         self.logger.info(f'Raw datasets: {raw_datasets}')
         return raw_datasets
 
-    def format_example(self, examples, join_history=True):
+    def get_dedup_keep_masks(self, data_files):
+        if self.dedup_keep_masks is None:
+            # the train and validation files are deduplicated together, a validation row repeating a train row is
+            # removed from the validation set
+            all_data_files = list(dict.fromkeys(
+                file_path for split_data_files in self.get_split_data_files().values()
+                for file_path in split_data_files))
+            if self.training_args.world_size > 1:
+                # the main process hashes the files and sends the masks, every rank keeps the same rows
+                keep_masks = [None]
+                if self.training_args.process_index == 0:
+                    keep_masks = [self.deduplicator.get_keep_masks(all_data_files, self.load_raw_dataset)]
+                torch.distributed.broadcast_object_list(keep_masks, src=0)
+                keep_masks = keep_masks[0]
+            else:
+                keep_masks = self.deduplicator.get_keep_masks(all_data_files, self.load_raw_dataset)
+            self.dedup_keep_masks = dict(zip(all_data_files, keep_masks))
+        return [self.dedup_keep_masks[file_path] for file_path in data_files]
+
+    def deduplicate_dataset(self, dataset, data_files):
+        # the rows of the dataset follow the order of data_files
+        keep = np.concatenate(self.get_dedup_keep_masks(data_files))
+        if keep.all():
+            return dataset
+        return dataset.select(np.flatnonzero(keep))
+
+    def get_dev_mask(self, dataset):
+        # hash every row with the seed instead of slicing, the split is random but a row always falls into the
+        # same split no matter which other files are loaded
+        dev_ratio = self.data_args.dev_ratio / 100
+        seed = self.training_args.seed
+
+        def is_dev(examples):
+            num_rows = len(examples[next(iter(examples))])
+            return {'is_dev': [
+                int.from_bytes(hashlib.blake2b(f'{seed}\n{example_to_text(examples, i)}'.encode('utf-8'),
+                                               digest_size=8).digest(), 'little') < dev_ratio * 2 ** 64
+                for i in range(num_rows)]}
+
+        is_dev_list = dataset.map(
+            is_dev,
+            batched=True,
+            num_proc=self.data_args.preprocessing_num_workers,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=False,
+            desc='Splitting dev set'
+        )['is_dev']
+        return np.asarray(is_dev_list, dtype=bool)
+
+    def format_query_example(self, examples):
         for i in range(len(examples['instruction'])):
             if examples['instruction'][i] and examples['output'][i]:
                 query, answer = examples['instruction'][i], examples['output'][i]
                 query = query + examples['input'][i] if examples['input'][i] else query
                 if 'history' in examples and (history := examples['history'][i]) is not None:
-                    prompt = self.prompt_template.get_prompt(query, history, join_history)
+                    yield query, history, answer
                 else:
-                    prompt = self.prompt_template.get_prompt(query, [], join_history)
-                yield prompt, answer
+                    yield query, [], answer
+
+    def format_example(self, examples, join_history=True):
+        for query, history, answer in self.format_query_example(examples):
+            yield self.prompt_template.get_prompt(query, history, join_history), answer
+
+    def encode_prompts(self, samples, join_history=True):
+        # samples are (query, history, answer) from format_query_example
+        if self.compiled_template is not None:
+            return self.compiled_template.encode_prompts(
+                [(query, history) for query, history, _ in samples], join_history)
+        prompts = [self.prompt_template.get_prompt(query, history, join_history) for query, history, _ in samples]
+        if join_history:
+            return self.encode_texts(prompts)
+        ids_list = iter(self.encode_texts([sentence for prompt in prompts for sentence in prompt]))
+        return [[next(ids_list) for _ in prompt] for prompt in prompts]
 
     def transfer_front_tail_to_label_pad_token_id(self, label):
-        start_pointer = 0
-        end_pointer = len(label) - 1
-        while label[start_pointer] != self.label_pad_token_id:
-            label[start_pointer] = self.label_pad_token_id
-            start_pointer += 1
-        while label[end_pointer] != self.label_pad_token_id:
-            label[end_pointer] = self.label_pad_token_id
-            end_pointer -= 1
+        # mask the special tokens before the first and after the last label pad
+        label = np.asarray(label, dtype=np.int64)
+        is_pad = label == self.label_pad_token_id
+        start_pointer = int(np.argmax(is_pad))
+        end_pointer = len(label) - 1 - int(np.argmax(is_pad[::-1]))
+        label[:start_pointer] = self.label_pad_token_id
+        label[end_pointer + 1:] = self.label_pad_token_id
         return label
 
-    def preprocess_pretrain_dataset(self, examples):
-        # refer from https://github.com/ymcui/Chinese-LLaMA-Alpaca-2/blob/main/scripts/training/run_clm_pt_with_peft.py#L491
-        tokenized_examples = self.tokenizer(examples['text'])
+    def encode_texts(self, texts):
+        # encode the whole batch in one call, the fast tokenizers parallelize it
+        if not texts:
+            return []
+        return self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+    def build_labels(self, input_ids_list, context_lengths):
+        # labels are input ids with the first context_length tokens of every sample masked
+        lengths = np.fromiter((len(input_ids) for input_ids in input_ids_list), dtype=np.int64,
+                              count=len(input_ids_list))
+        if not len(lengths):
+            return []
+        flat_input_ids = np.fromiter(chain.from_iterable(input_ids_list), dtype=np.int64, count=int(lengths.sum()))
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(len(flat_input_ids)) - np.repeat(offsets, lengths)
+        is_context = positions < np.repeat(np.asarray(context_lengths, dtype=np.int64), lengths)
+        flat_labels = np.where(is_context, self.label_pad_token_id, flat_input_ids)
+        return np.split(flat_labels, offsets[1:])
+
+    def truncate(self, *sequences_list):
+        max_input_token = self.data_args.max_input_token
+        # counted by with_truncation_flags instead of warning in every batch
+        self.truncated_flags = [any(len(sequences[i]) > max_input_token for sequences in sequences_list)
+                                for i in range(len(sequences_list[0]))]
+        return tuple([sequence[:max_input_token] for sequence in sequences] for sequences in sequences_list)
+
+    def with_truncation_flags(self, process_func):
+        # the flags are returned as a column so that they are counted across the processes of the map
+        def process_with_truncation_flags(examples):
+            self.truncated_flags = None
+            result = process_func(examples)
+            num_rows = len(next(iter(result.values()))) if result else 0
+            flags = self.truncated_flags
+            result['truncated'] = flags if flags is not None and len(flags) == num_rows else [False] * num_rows
+            return result
+
+        return process_with_truncation_flags
+
+    def pop_truncation_flags(self, dataset):
+        if 'truncated' not in dataset.column_names:
+            return dataset
+        num_truncated = int(np.count_nonzero(dataset.with_format('numpy')['truncated']))
+        if num_truncated:
+            self.logger.warning(f'The token length of {num_truncated} of {len(dataset)} samples exceeds '
+                                f'{self.data_args.max_input_token}, they are truncated.')
+        return dataset.remove_columns('truncated')
+
+    def get_pretrain_block_size(self):
         block_size = self.data_args.max_input_token
         if block_size > self.tokenizer.model_max_length:
             self.logger.warning(
                 f'The block_size passed ({block_size}) is larger than the maximum length for the model'
                 f'({self.tokenizer.model_max_length}). Using block_size={self.tokenizer.model_max_length}.'
             )
-        block_size = min(block_size, self.tokenizer.model_max_length)
-
-        concatenated_examples = {k: list(chain(*tokenized_examples[k])) for k in tokenized_examples.keys()}
-        total_length = len(concatenated_examples[list(tokenized_examples.keys())[0]])
-        # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
-        # customize this part to your needs.
-        if total_length >= block_size:
-            total_length = (total_length // block_size) * block_size
-        # Split by chunks of max_len.
-        result = {
-            k: [t[i: i + block_size] for i in range(0, total_length, block_size)]
-            for k, t in concatenated_examples.items()
-        }
-        return result
+        return min(block_size, self.tokenizer.model_max_length)
+
+    def get_pretrain_eos_token_id(self):
+        return self.tokenizer.eos_token_id if self.data_args.pretrain_append_eos else None
+
+    def preprocess_pretrain_dataset(self, examples):
+        # only tokenize here, the documents are concatenated into blocks by pack_pretrain_dataset
+        return {'input_ids': self.tokenizer(examples['text'])['input_ids']}
+
+    def pack_pretrain_dataset(self, dataset):
+        # refer from https://github.com/ymcui/Chinese-LLaMA-Alpaca-2/blob/main/scripts/training/run_clm_pt_with_peft.py#L491
+        # the packer carries the leftover of every batch to the next one, so it runs in order in a single process
+        packer = PretrainPacker(
+            self.get_pretrain_block_size(),
+            eos_token_id=self.get_pretrain_eos_token_id(),
+            document_mask=self.data_args.pretrain_document_mask,
+            label_pad_token_id=self.label_pad_token_id
+        )
+        num_docs = len(dataset)
+        with self.training_args.main_process_first(desc='Handle dataset.'):
+            dataset = dataset.map(
+                packer,
+                batched=True,
+                with_indices=True,
+                remove_columns=dataset.column_names,
+                load_from_cache_file=not self.data_args.overwrite_cache,
+                desc='Packing dataset'
+            )
+        self.logger.info(f'Packed {num_docs} documents into {len(dataset)} blocks.')
+        return dataset
 
     def preprocess_train_supervised_fine_tuning_dataset(self, examples):
         # ChatGLM1: https://huggingface.co/THUDM/chatglm-6b/blob/main/tokenization_chatglm.py#L323
@@ -169,192 +313,765 @@ class DataManager:
         # moss: https://huggingface.co/fnlp/moss-moon-003-sft/blob/main/tokenization_moss.py#L226
         # Llama: https://github.com/huggingface/transformers/blob/main/src/transformers/models/llama/tokenization_llama.py#L296
         inputs_list = []
-        attention_mask_list = []
         labels_list = []
         if self.training_args.use_firefly_loss:
-            for prompt, answer in self.format_example(examples, False):
-                source_ids = []
-                labels = []
-                for i, sentence in enumerate(prompt):
-                    if i % 2 == 0:
-                        sentence_ids = self.tokenizer.encode(text=sentence, add_special_tokens=False)
-                        source_ids.extend(sentence_ids)
-                        labels.extend([self.label_pad_token_id] * (len(sentence_ids)))
-                    else:
-                        sentence_ids = self.tokenizer.encode(text=sentence, add_special_tokens=False)
-                        sentence_ids = sentence_ids + [self.tokenizer.eos_token_id]
-                        source_ids.extend(sentence_ids)
-                        labels.extend(sentence_ids)
-                target_ids = self.tokenizer.encode(text=answer, add_special_tokens=False)
+            samples = list(self.format_query_example(examples))
+            sentence_ids_list = self.encode_prompts(samples, False)
+            target_ids_list = self.encode_texts([answer for _, _, answer in samples])
+            for sentence_ids, target_ids in zip(sentence_ids_list, target_ids_list):
+                # user sentences are masked, bot sentences with eos are learned
+                sentence_ids = [ids if i % 2 == 0 else ids + [self.tokenizer.eos_token_id]
+                                for i, ids in enumerate(sentence_ids)]
+                source_ids = list(chain.from_iterable(sentence_ids))
+                is_bot = np.repeat(np.arange(len(sentence_ids)) % 2 == 1, [len(ids) for ids in sentence_ids])
+                labels = np.where(is_bot, np.asarray(source_ids, dtype=np.int64), self.label_pad_token_id)
                 if self.model_args.model_type in ('chatglm', 'baichuan', 'internlm', 'moss', 'llama'):
                     input_ids = self.tokenizer.build_inputs_with_special_tokens(source_ids, target_ids)
-                    labels = self.tokenizer.build_inputs_with_special_tokens(labels)
+                    labels = self.tokenizer.build_inputs_with_special_tokens(labels.tolist())
                     context_length = len(labels)
                     labels = self.transfer_front_tail_to_label_pad_token_id(labels)
-                    labels = labels + input_ids[context_length:]
+                    labels = np.concatenate([labels, np.asarray(input_ids[context_length:], dtype=np.int64)])
                 else:
                     input_ids = source_ids + target_ids + [self.tokenizer.eos_token_id]
                     if self.tokenizer.bos_token_id is not None:
                         input_ids = [self.tokenizer.bos_token_id] + input_ids
-                        labels = [self.label_pad_token_id] + labels
-                    labels = labels + target_ids + [self.tokenizer.eos_token_id]
-                attention_mask = [1] * len(input_ids)
-                if len(input_ids) > self.data_args.max_input_token:
-                    self.logger.warning(f'The token length of some sentences exceeds {self.data_args.max_input_token}.')
-                    input_ids = input_ids[:self.data_args.max_input_token]
-                    labels = labels[:self.data_args.max_input_token]
-                    attention_mask = attention_mask[:self.data_args.max_input_token]
+                        labels = np.concatenate([[self.label_pad_token_id], labels])
+                    labels = np.concatenate([labels, target_ids, [self.tokenizer.eos_token_id]]).astype(np.int64)
                 inputs_list.append(input_ids)
-                attention_mask_list.append(attention_mask)
                 labels_list.append(labels)
         else:
-            for prompt, answer in self.format_example(examples):
-                source_ids = self.tokenizer.encode(text=prompt, add_special_tokens=False)
-                target_ids = self.tokenizer.encode(text=answer, add_special_tokens=False)
+            samples = list(self.format_query_example(examples))
+            source_ids_list = self.encode_prompts(samples)
+            target_ids_list = self.encode_texts([answer for _, _, answer in samples])
+            context_lengths = []
+            for source_ids, target_ids in zip(source_ids_list, target_ids_list):
                 if self.model_args.model_type in ('chatglm', 'baichuan', 'internlm', 'moss', 'llama'):
                     input_ids = self.tokenizer.build_inputs_with_special_tokens(source_ids, target_ids)
                     context_length = len(self.tokenizer.build_inputs_with_special_tokens(source_ids))
-                    labels = [self.label_pad_token_id] * context_length + input_ids[context_length:]
                 else:
                     input_ids = source_ids + target_ids + [self.tokenizer.eos_token_id]
                     context_length = len(source_ids)
                     if self.tokenizer.bos_token_id is not None:
                         input_ids = [self.tokenizer.bos_token_id] + input_ids
                         context_length = context_length + 1
-                    labels = [self.label_pad_token_id] * context_length + target_ids + [self.tokenizer.eos_token_id]
-                attention_mask = [1] * len(input_ids)
-                if len(input_ids) > self.data_args.max_input_token:
-                    self.logger.warning(f'The token length of some sentences exceeds {self.data_args.max_input_token}.')
-                    input_ids = input_ids[:self.data_args.max_input_token]
-                    labels = labels[:self.data_args.max_input_token]
-                    attention_mask = attention_mask[:self.data_args.max_input_token]
                 inputs_list.append(input_ids)
-                attention_mask_list.append(attention_mask)
-                labels_list.append(labels)
+                context_lengths.append(context_length)
+            labels_list = self.build_labels(inputs_list, context_lengths)
+        inputs_list, labels_list = self.truncate(inputs_list, labels_list)
+        attention_mask_list = [np.ones(len(input_ids), dtype=np.int64) for input_ids in inputs_list]
         return {'input_ids': inputs_list, 'attention_mask': attention_mask_list, 'labels': labels_list}
 
+    def pack_supervised_fine_tuning_dataset(self, examples):
+        block_size = min(self.data_args.max_input_token, self.tokenizer.model_max_length)
+        return pack_supervised_samples(examples['input_ids'], examples['labels'], block_size, self.label_pad_token_id)
+
     def preprocess_eval_supervised_fine_tuning_dataset(self, examples):
         inputs_list = []
-        attention_mask_list = []
         labels_list = []
-        for prompt, answer in self.format_example(examples):
-            source_ids = self.tokenizer.encode(text=prompt, add_special_tokens=False)
-            target_ids = self.tokenizer.encode(text=answer, add_special_tokens=False)
+        samples = list(self.format_query_example(examples))
+        source_ids_list = self.encode_prompts(samples)
+        target_ids_list = self.encode_texts([answer for _, _, answer in samples])
+        for source_ids, target_ids in zip(source_ids_list, target_ids_list):
             if self.model_args.model_type in ('chatglm', 'baichuan', 'internlm', 'moss', 'llama'):
                 input_ids = self.tokenizer.build_inputs_with_special_tokens(source_ids)
-                labels = target_ids + [self.tokenizer.eos_token_id]
             else:
                 input_ids = source_ids
                 if self.tokenizer.bos_token_id is not None:
                     input_ids = [self.tokenizer.bos_token_id] + source_ids
-                labels = target_ids + [self.tokenizer.eos_token_id]
-            attention_mask = [1] * len(input_ids)
-            if len(input_ids) > self.data_args.max_input_token:
-                self.logger.warning(f'The token length of some sentences exceeds {self.data_args.max_input_token}.')
-                input_ids = input_ids[:self.data_args.max_input_token]
-                attention_mask = attention_mask[:self.data_args.max_input_token]
             inputs_list.append(input_ids)
-            attention_mask_list.append(attention_mask)
-            labels_list.append(labels)
+            labels_list.append(target_ids + [self.tokenizer.eos_token_id])
+        inputs_list, = self.truncate(inputs_list)
+        attention_mask_list = [np.ones(len(input_ids), dtype=np.int64) for input_ids in inputs_list]
         return {'input_ids': inputs_list, 'attention_mask': attention_mask_list, 'labels': labels_list}
 
+    def build_reward_model_sequence(self, source_ids, response_ids):
+        if self.model_args.model_type in ('chatglm', 'baichuan', 'internlm', 'moss', 'llama'):
+            return self.tokenizer.build_inputs_with_special_tokens(source_ids, response_ids)
+        if self.tokenizer.bos_token_id is not None:
+            source_ids = [self.tokenizer.bos_token_id] + source_ids
+        return source_ids + response_ids + [self.tokenizer.eos_token_id]
+
     def preprocess_train_reward_model_dataset(self, examples):
         accept_list, reject_list = [], []
-        for prompt, answer in self.format_example(examples):
-            source_ids = self.tokenizer.encode(text=prompt, add_special_tokens=False)
-            accept_ids = self.tokenizer.encode(text=answer[0], add_special_tokens=False)
-            reject_ids = self.tokenizer.encode(text=answer[1], add_special_tokens=False)
-            if self.model_args.model_type in ('chatglm', 'baichuan', 'internlm', 'moss', 'llama'):
-                accept_ids = self.tokenizer.build_inputs_with_special_tokens(source_ids, accept_ids)
-                reject_ids = self.tokenizer.build_inputs_with_special_tokens(source_ids, reject_ids)
+        samples = list(self.format_query_example(examples))
+        source_ids_list = self.encode_prompts(samples)
+        accept_ids_list = self.encode_texts([answer[0] for _, _, answer in samples])
+        reject_ids_list = self.encode_texts([answer[1] for _, _, answer in samples])
+        for source_ids, accept_ids, reject_ids in zip(source_ids_list, accept_ids_list, reject_ids_list):
+            accept_list.append(self.build_reward_model_sequence(source_ids, accept_ids))
+            reject_list.append(self.build_reward_model_sequence(source_ids, reject_ids))
+        accept_list, reject_list = self.truncate(accept_list, reject_list)
+        return {'accept_ids': accept_list, 'reject_ids': reject_list}
+
+    def preprocess_train_reward_model_grouped_dataset(self, examples):
+        # the prompt is kept once and followed by all of its responses, output lists them from the best to the
+        # worst. The prompt is the common prefix of the tokenized sequences, so special tokens are split correctly.
+        max_input_token = self.data_args.max_input_token
+        samples = [sample for sample in self.format_query_example(examples) if len(sample[2]) >= 2]
+        source_ids_list = self.encode_prompts(samples)
+        response_ids_iter = iter(self.encode_texts([response for _, _, answer in samples for response in answer]))
+        result = {'prompt_ids': [], 'response_ids': []}
+        truncated_flags = []
+        for source_ids, (_, _, answer) in zip(source_ids_list, samples):
+            sequences = [self.build_reward_model_sequence(source_ids, next(response_ids_iter)) for _ in answer]
+            truncated_flags.append(any(len(sequence) > max_input_token for sequence in sequences))
+            sequences = [sequence[:max_input_token] for sequence in sequences]
+            # every response keeps at least its last token, where it is scored
+            prompt_length = min(len(sequence) for sequence in sequences) - 1
+            for i in range(prompt_length):
+                if any(sequence[i] != sequences[0][i] for sequence in sequences):
+                    prompt_length = i
+                    break
+            result['prompt_ids'].append(sequences[0][:prompt_length])
+            result['response_ids'].append([sequence[prompt_length:] for sequence in sequences])
+        self.truncated_flags = truncated_flags
+        return result
+
+    def preprocess_train_dpo_dataset(self, examples):
+        # tokenized like trl's DPODataCollatorWithPadding, so the trainer does not tokenize the texts in every step
+        max_length = self.data_args.max_input_token
+        max_prompt_length = max_length // 2
+        samples = list(self.format_query_example(examples))
+        prompt_ids_list = self.encode_prompts(samples)
+        chosen_ids_list = self.encode_texts([answer[0] for _, _, answer in samples])
+        rejected_ids_list = self.encode_texts([answer[1] for _, _, answer in samples])
+        result = {key: [] for key in ('chosen_input_ids', 'chosen_labels', 'rejected_input_ids', 'rejected_labels')}
+        truncated_flags = []
+        for prompt_ids, chosen_ids, rejected_ids in zip(prompt_ids_list, chosen_ids_list, rejected_ids_list):
+            chosen_ids = chosen_ids + [self.tokenizer.eos_token_id]
+            rejected_ids = rejected_ids + [self.tokenizer.eos_token_id]
+            truncated = len(prompt_ids) + max(len(chosen_ids), len(rejected_ids)) > max_length
+            if truncated:
+                # keep the end of the prompt, then cut the responses
+                prompt_ids = prompt_ids[-max_prompt_length:]
+                chosen_ids = chosen_ids[:max_length - len(prompt_ids)]
+                rejected_ids = rejected_ids[:max_length - len(prompt_ids)]
+            truncated_flags.append(truncated)
+            for key, response_ids in (('chosen', chosen_ids), ('rejected', rejected_ids)):
+                result[f'{key}_input_ids'].append(prompt_ids + response_ids)
+                result[f'{key}_labels'].append([self.label_pad_token_id] * len(prompt_ids) + response_ids)
+        self.truncated_flags = truncated_flags
+        return result
+
+    def tokenize_corpus(self):
+        if self.data_args.token_shards_dir is None:
+            raise ValueError('token_shards_dir is required to save the tokenized corpus.')
+        for split, file_dir in (('train', self.data_args.train_file_dir),
+                                ('validation', self.data_args.validation_file_dir)):
+            if file_dir is None or not os.path.exists(file_dir):
+                continue
+            data_files = self.get_data_files(file_dir)
+            output_dir = os.path.join(self.data_args.token_shards_dir, split)
+            self.logger.info(f'Tokenize {len(data_files)} {split} files into {output_dir}')
+            meta = write_token_shards(data_files, self.tokenizer, output_dir,
+                                      eos_token_id=self.get_pretrain_eos_token_id(),
+                                      num_workers=self.data_args.preprocessing_num_workers, logger=self.logger)
+            num_tokens = sum(shard['num_tokens'] for shard in meta['shards'])
+            self.logger.info(f"{split}: {num_tokens} tokens saved as {meta['dtype']}.")
+
+    def prepare_memmap_pretrain_dataset(self):
+        block_size = self.get_pretrain_block_size()
+        document_mask = self.data_args.pretrain_document_mask
+        train_dir = os.path.join(self.data_args.token_shards_dir, 'train')
+        if not os.path.exists(os.path.join(train_dir, META_NAME)):
+            raise ValueError(f'Token shards not found at {train_dir}, run tokenize_corpus mode first.')
+        train_dataset = MemmapPretrainDataset(train_dir, block_size, document_mask, self.label_pad_token_id)
+        if train_dataset.vocab_size != len(self.tokenizer):
+            self.logger.warning(f'Token shards were written by a tokenizer with {train_dataset.vocab_size} tokens, '
+                                f'but the current tokenizer has {len(self.tokenizer)}.')
+        self.logger.debug(f'Train dataset nums: {len(train_dataset)}')
+        eval_dataset = None
+        if self.training_args.do_eval:
+            eval_dir = os.path.join(self.data_args.token_shards_dir, 'validation')
+            if not os.path.exists(os.path.join(eval_dir, META_NAME)):
+                raise ValueError('do_eval requires a validation dataset')
+            eval_dataset = MemmapPretrainDataset(eval_dir, block_size, document_mask, self.label_pad_token_id)
+            self.logger.debug(f'Validation dataset nums: {len(eval_dataset)}')
+        return train_dataset, eval_dataset
+
+    def prepare_streaming_pretrain_dataset(self):
+        train_data_files = self.get_data_files(self.data_args.train_file_dir)
+        self.logger.info(f"Streaming train files: {', '.join(train_data_files)}")
+        train_dataset = StreamingPretrainDataset(
+            train_data_files,
+            tokenizer=self.tokenizer,
+            block_size=self.get_pretrain_block_size(),
+            shuffle_buffer_size=self.data_args.shuffle_buffer_size,
+            seed=self.training_args.seed,
+            rank=self.training_args.process_index,
+            world_size=self.training_args.world_size,
+            eos_token_id=self.get_pretrain_eos_token_id(),
+            document_mask=self.data_args.pretrain_document_mask,
+            label_pad_token_id=self.label_pad_token_id
+        )
+        eval_dataset = None
+        if self.training_args.do_eval:
+            if self.data_args.validation_file_dir is None or not os.path.exists(self.data_args.validation_file_dir):
+                raise ValueError('do_eval with streaming requires a validation_file_dir')
+            eval_data_files = self.get_data_files(self.data_args.validation_file_dir)
+            self.logger.info(f"eval files: {', '.join(eval_data_files)}")
+            eval_dataset = self.load_raw_dataset(eval_data_files)
+            eval_dataset = eval_dataset.map(
+                self.preprocess_pretrain_dataset,
+                batched=True,
+                num_proc=self.data_args.preprocessing_num_workers,
+                remove_columns=eval_dataset.column_names,
+                desc='Running tokenizer on dataset'
+            )
+            eval_dataset = self.pack_pretrain_dataset(eval_dataset)
+            self.logger.debug(f'Validation dataset nums: {len(eval_dataset)}')
+        return train_dataset, eval_dataset
+
+    def grouped_reward_model_lengths(self, dataset, max_input_token):
+        """
+        Returns the length of every prompt and response sequence of the rm_shared_prompt rows, and the length of
+        every row after its sequences are truncated to max_input_token one by one.
+        """
+        def count_tokens(examples):
+            sequence_lengths, capped_lengths = [], []
+            for prompt_ids, responses in zip(examples['prompt_ids'], examples['response_ids']):
+                lengths = [len(prompt_ids) + len(response_ids) for response_ids in responses]
+                # every response keeps at least its last token
+                prompt_length = min(len(prompt_ids), max_input_token - 1)
+                sequence_lengths.append(lengths)
+                capped_lengths.append(prompt_length + sum(
+                    max(1, min(length, max_input_token) - prompt_length) for length in lengths))
+            return {'sequence_lengths': sequence_lengths, 'capped_length': capped_lengths}
+
+        lengths = dataset.map(
+            count_tokens,
+            batched=True,
+            num_proc=self.data_args.preprocessing_num_workers,
+            remove_columns=dataset.column_names,
+            desc='Counting tokens of dataset'
+        )
+        sequence_lengths = np.fromiter(chain.from_iterable(lengths['sequence_lengths']), dtype=np.int64)
+        return sequence_lengths, np.asarray(lengths['capped_length'], dtype=np.int64)
+
+    def dataset_stats(self):
+        max_input_token = self.data_args.max_input_token
+        # tokenize without truncation so that the truncation rate can be measured
+        self.data_args.max_input_token = sys.maxsize
+        try:
+            train_dataset = self.load_datasets_from_files()['train']
+            train_dataset = train_dataset.map(
+                self.get_process_func('train'),
+                batched=True,
+                num_proc=self.data_args.preprocessing_num_workers,
+                remove_columns=train_dataset.column_names,
+                load_from_cache_file=not self.data_args.overwrite_cache,
+                desc='Running tokenizer on dataset'
+            )
+        finally:
+            self.data_args.max_input_token = max_input_token
+        lengths = compute_sample_lengths(train_dataset, self.tokenizer, self.data_args.preprocessing_num_workers)
+        grouped = 'response_ids' in train_dataset.column_names
+        if grouped:
+            sequence_lengths, capped_lengths = self.grouped_reward_model_lengths(train_dataset, max_input_token)
+        else:
+            # the pairs of rm and dpo count twice in a padded batch, but every sequence is truncated alone
+            sequence_lengths = lengths // 2 if self.mode in ('rm_train', 'dpo_train') else lengths
+        args = self.training_args
+        samples_per_step = args.per_device_train_batch_size * args.world_size
+
+        stats = {'mode': self.mode, 'max_input_token': max_input_token, 'lengths': summarize_lengths(sequence_lengths)}
+        if grouped:
+            # a row holds its prompt once, the lengths are of the prompt and one response
+            stats['lengths'] |= {'num_groups': int(len(lengths)), 'num_tokens': int(lengths.sum())}
+        stats['histogram'] = length_histogram(sequence_lengths)
+        stats['truncation_rate'] = float(np.mean(sequence_lengths > max_input_token)) if len(lengths) else 0.0
+        self.logger.info(f"Token lengths of {self.mode}: {stats['lengths']}")
+        self.logger.info('Token length histogram:\n' + format_stats_table(
+            ['from', 'to', 'count'], [[row['from'], row['to'], row['count']] for row in stats['histogram']]))
+        self.logger.info(f"{stats['truncation_rate']:.2%} of the samples exceed max_input_token={max_input_token}.")
+
+        if self.mode == 'pretrain':
+            block_size = self.get_pretrain_block_size()
+            num_eos = int(np.count_nonzero(lengths)) if self.data_args.pretrain_append_eos else 0
+            num_blocks = (int(lengths.sum()) + num_eos) // block_size
+            stats['pretrain'] = {
+                'block_size': block_size,
+                'num_blocks': num_blocks,
+                'steps_per_epoch': steps_per_epoch(-(-num_blocks // samples_per_step), args.gradient_accumulation_steps)
+            }
+            self.logger.info(f"Pretrain blocks: {stats['pretrain']}")
+        else:
+            if grouped:
+                lengths = capped_lengths
             else:
-                if self.tokenizer.bos_token_id is not None:
-                    source_ids = [self.tokenizer.bos_token_id] + source_ids
-                accept_ids = source_ids + accept_ids + [self.tokenizer.eos_token_id]
-                reject_ids = source_ids + reject_ids + [self.tokenizer.eos_token_id]
+                lengths = np.minimum(lengths, max_input_token * (2 if self.mode in ('rm_train', 'dpo_train') else 1))
+            batch_sizes = sorted({1, 2, 4, 8, 16, 32, 64, args.per_device_train_batch_size})
+            settings = [('random', lengths, False), ('group_by_length', lengths, True)]
+            if self.mode == 'sft_train':
+                block_size = min(max_input_token, self.tokenizer.model_max_length)
+                block_lengths = packed_block_lengths(lengths, block_size)
+                stats['sft_packing'] = {'block_size': block_size, 'num_blocks': int(len(block_lengths)),
+                                        'fill_rate': float(block_lengths.sum() / max(1, len(block_lengths) * block_size))}
+                self.logger.info(f"SFT packing: {stats['sft_packing']}")
+                settings.append(('sft_packing', block_lengths, False))
+            rows = []
+            stats['padding'] = []
+            for name, setting_lengths, sort in settings:
+                for batch_size in batch_sizes:
+                    fraction = padding_fraction(setting_lengths, batch_size, sort, seed=args.seed)
+                    num_steps = steps_per_epoch(-(-len(setting_lengths) // (batch_size * args.world_size)),
+                                                args.gradient_accumulation_steps)
+                    stats['padding'].append({'setting': name, 'batch_size': batch_size,
+                                             'padding_fraction': fraction, 'steps_per_epoch': num_steps})
+                    rows.append([name, batch_size, f'{fraction:.2%}', num_steps])
+            if args.max_tokens_per_batch is not None:
+                sampler = TokenBudgetBatchSampler(lengths, args.max_tokens_per_batch, num_replicas=args.world_size,
+                                                  seed=args.seed)
+                fraction = sampler.padding_ratio()
+                num_steps = steps_per_epoch(len(sampler), args.gradient_accumulation_steps)
+                stats['padding'].append({'setting': 'max_tokens_per_batch', 'batch_size': args.max_tokens_per_batch,
+                                         'padding_fraction': fraction, 'steps_per_epoch': num_steps})
+                rows.append(['max_tokens_per_batch', args.max_tokens_per_batch, f'{fraction:.2%}', num_steps])
+            self.logger.info('Padding fraction and steps per epoch (per device batch size):\n' + format_stats_table(
+                ['setting', 'batch_size', 'padding', 'steps_per_epoch'], rows))
 
-            if len(accept_ids) > self.data_args.max_input_token or len(reject_ids) > self.data_args.max_input_token:
-                self.logger.warning(f'The token length of some sentences exceeds {self.data_args.max_input_token}.')
-                accept_ids = accept_ids[:self.data_args.max_input_token]
-                reject_ids = reject_ids[:self.data_args.max_input_token]
+        os.makedirs(args.output_dir, exist_ok=True)
+        stats_file = os.path.join(args.output_dir, 'dataset_stats.json')
+        with open(stats_file, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, ensure_ascii=False, indent=2)
+        self.logger.info(f'Dataset stats saved to {stats_file}')
+        return stats
 
-            accept_list.append(accept_ids)
-            reject_list.append(reject_ids)
-        return {'accept_ids': accept_list, 'reject_ids': reject_list}
+    def get_process_func(self, split):
+        if split == 'train':
+            process_funcs = {
+                'pretrain': self.preprocess_pretrain_dataset,
+                'sft_train': self.preprocess_train_supervised_fine_tuning_dataset,
+                'rm_train': self.preprocess_train_reward_model_dataset,
+                'ppo_train': self.preprocess_eval_supervised_fine_tuning_dataset,
+                'dpo_train': self.preprocess_train_dpo_dataset,
+            }
+        else:
+            process_funcs = {
+                'pretrain': self.preprocess_pretrain_dataset,
+                'sft_train': self.preprocess_eval_supervised_fine_tuning_dataset,
+                'rm_train': self.preprocess_train_reward_model_dataset,
+                'ppo_train': self.preprocess_eval_supervised_fine_tuning_dataset,
+                'dpo_train': self.preprocess_train_dpo_dataset,
+                'sft_batch_test': self.preprocess_eval_supervised_fine_tuning_dataset,
+                'rm_batch_test': self.preprocess_train_reward_model_dataset,
+            }
+        if self.mode in ('rm_train', 'rm_batch_test') and self.training_args.rm_shared_prompt:
+            return self.preprocess_train_reward_model_grouped_dataset
+        return process_funcs[self.mode]
+
+    def load_raw_dataset(self, data_files):
+        return load_data_files(data_files, self.get_data_columns(), cache_dir=self.model_args.cache_dir)
+
+    def process_files_with_cache(self, process_func, data_files, shuffle=True, dev_split=None):
+        """
+        dev_split is 'train' or 'validation' when the dev set is split out of data_files by dev_ratio.
+        """
+        settings = {
+            'tokenizer': hash_tokenizer(self.tokenizer),
+            'model_type': self.model_args.model_type,
+            'prompt_template': self.data_args.prompt_template,
+            'compiled_template': self.compiled_template is not None and self.compiled_template.exact,
+            'mode': self.mode,
+            'process_func': process_func.__name__,
+            'max_input_token': self.data_args.max_input_token,
+            'use_firefly_loss': self.training_args.use_firefly_loss,
+            'label_pad_token_id': self.label_pad_token_id,
+        }
+        data_files = sorted(data_files)
+        keep_masks = [None] * len(data_files)
+        if self.deduplicator is not None:
+            keep_masks = [None if keep.all() else keep for keep in self.get_dedup_keep_masks(data_files)]
+
+        def process_file(cache, file_path, keep):
+            file_settings = settings
+            if keep is not None:
+                # the kept rows depend on the other files, so they are part of the key
+                file_settings = {**settings, 'dedup': hashlib.sha256(np.packbits(keep).tobytes()).hexdigest()}
+            if dev_split is not None:
+                file_settings = {**file_settings, 'dev_split': dev_split, 'dev_ratio': self.data_args.dev_ratio,
+                                 'seed': self.training_args.seed}
+            key = cache.get_key(file_path, file_settings)
+            if (dataset := cache.load(key)) is not None:
+                return key, dataset, True
+            dataset = self.load_raw_dataset([file_path])
+            if keep is not None:
+                dataset = dataset.select(np.flatnonzero(keep))
+            if dev_split is not None:
+                is_dev = self.get_dev_mask(dataset)
+                dataset = dataset.select(np.flatnonzero(is_dev if dev_split == 'validation' else ~is_dev))
+            dataset = dataset.map(
+                self.with_truncation_flags(process_func),
+                batched=True,
+                num_proc=self.data_args.preprocessing_num_workers,
+                remove_columns=dataset.column_names,
+                load_from_cache_file=False,
+                desc=f'Running tokenizer on {os.path.basename(file_path)}'
+            )
+            dataset = self.pop_truncation_flags(dataset)
+            cache.save(key, file_path, dataset)
+            return key, dataset, False
+
+        if self.data_args.sharded_preprocessing and self.training_args.world_size > 1:
+            datasets_list, num_hits = self.process_files_sharded(process_file, data_files, keep_masks,
+                                                                 [settings, dev_split])
+        else:
+            datasets_list = []
+            num_hits = 0
+            with self.training_args.main_process_first(desc='Handle dataset.'):
+                cache = TokenizedFileCache(self.data_args.tokenized_cache_dir, self.logger)
+                for file_path, keep in zip(data_files, keep_masks):
+                    _, dataset, hit = process_file(cache, file_path, keep)
+                    num_hits += hit
+                    datasets_list.append(dataset)
+                if self.training_args.local_process_index == 0:
+                    cache.write_manifest()
+        self.logger.info(f'Tokenized cache: {num_hits} files reused, {len(data_files) - num_hits} files processed.')
+        dataset = concatenate_datasets(datasets_list)
+        if shuffle:
+            dataset = dataset.shuffle(seed=self.training_args.seed)
+        return dataset
 
-    def preprocess_train_dpo_text_dataset(self, examples):
-        prompt_list, accept_list, reject_list = [], [], []
-        for prompt, answer in self.format_example(examples):
-            prompt_list.append(prompt)
-            accept_list.append(answer[0])
-            reject_list.append(answer[1])
-        return {'prompt': prompt_list, 'chosen': accept_list, 'rejected': reject_list}
+    def wait_for_everyone(self):
+        if self.training_args.world_size > 1:
+            torch.distributed.barrier()
+
+    def process_files_sharded(self, process_file, data_files, keep_masks, run_settings):
+        """
+        Every rank processes its own files into the shared cache instead of waiting for the main process, the
+        files are balanced by size. After a barrier the ranks merge the keys written by the others and load
+        every file from the cache.
+        """
+        rank, world_size = self.training_args.process_index, self.training_args.world_size
+        run_id = hashlib.sha256(json.dumps([data_files, run_settings, world_size], sort_keys=True,
+                                           default=str).encode('utf-8')).hexdigest()[:16]
+        cache = TokenizedFileCache(self.data_args.tokenized_cache_dir, self.logger)
+        owners = assign_files_to_ranks([os.path.getsize(file_path) for file_path in data_files], world_size)
+        keys = {}
+        num_hits = 0
+        for file_path, keep, owner in zip(data_files, keep_masks, owners):
+            if owner == rank:
+                keys[file_path], _, hit = process_file(cache, file_path, keep)
+                num_hits += hit
+        self.logger.info(f'Rank {rank} processed {len(keys)} of {len(data_files)} files.')
+        cache.write_rank_index(run_id, rank, keys)
+        self.wait_for_everyone()
+        keys = cache.merge_rank_indexes(run_id, world_size)
+        datasets_list = [cache.load(keys[file_path]) for file_path in data_files]
+        self.wait_for_everyone()
+        if rank == 0:
+            cache.write_manifest()
+            cache.remove_rank_indexes(run_id, world_size)
+        return datasets_list, num_hits
+
+    def prepare_cached_dataset(self):
+        train_data_files = self.get_data_files(self.data_args.train_file_dir)
+        eval_dataset = None
+        dev_split = None
+        if self.training_args.do_eval:
+            if self.data_args.validation_file_dir is not None and os.path.exists(self.data_args.validation_file_dir):
+                eval_data_files = self.get_data_files(self.data_args.validation_file_dir)
+                eval_dataset = self.process_files_with_cache(
+                    self.get_process_func('validation'), eval_data_files, False)
+            elif self.data_args.dev_ratio > 0.0:
+                dev_split = 'train'
+                eval_dataset = self.process_files_with_cache(
+                    self.get_process_func('validation'), train_data_files, False, dev_split='validation')
+            else:
+                raise ValueError('do_eval requires a validation dataset')
+        train_dataset = self.process_files_with_cache(
+            self.get_process_func('train'), train_data_files, shuffle=self.mode != 'pretrain', dev_split=dev_split)
+        return train_dataset, eval_dataset
 
     def prepare_dataset(self, test=False):
 
-        def process_dataset(process_func, dataset, shuffle=True):
+        def process_dataset(process_func, dataset, shuffle=True, desc='Running tokenizer on dataset'):
             with self.training_args.main_process_first(desc='Handle dataset.'):
-                if shuffle:
-                    dataset = dataset.shuffle()
                 dataset = dataset.map(
-                    process_func,
+                    self.with_truncation_flags(process_func),
                     batched=True,
                     num_proc=self.data_args.preprocessing_num_workers,
                     remove_columns=dataset.column_names,
                     load_from_cache_file=not self.data_args.overwrite_cache,
-                    desc='Running tokenizer on dataset'
+                    desc=desc
                 )
+                dataset = self.pop_truncation_flags(dataset)
+                if shuffle:
+                    # shuffle after tokenization so that the map reads the rows sequentially
+                    dataset = dataset.shuffle(seed=self.training_args.seed)
                 return dataset
 
         if not test:
-            raw_datasets = self.load_datasets_from_files()
-            train_dataset = raw_datasets['train']
+            if self.mode == 'pretrain' and self.deduplicator is not None and \
+                    (self.data_args.token_shards_dir is not None or self.data_args.streaming):
+                self.logger.warning('dedup is not applied to streaming or memory-mapped pretrain corpora.')
+            if self.mode == 'pretrain' and self.data_args.token_shards_dir is not None:
+                return self.prepare_memmap_pretrain_dataset()
+            if self.mode == 'pretrain' and self.data_args.streaming:
+                return self.prepare_streaming_pretrain_dataset()
+            if self.data_args.tokenized_cache_dir is not None:
+                train_dataset, eval_dataset = self.prepare_cached_dataset()
+            else:
+                raw_datasets = self.load_datasets_from_files()
+                train_dataset = process_dataset(
+                    self.get_process_func('train'), raw_datasets['train'], shuffle=self.mode != 'pretrain')
+                eval_dataset = None
+                if self.training_args.do_eval:
+                    if 'validation' not in raw_datasets.keys():
+                        raise ValueError('do_eval requires a validation dataset')
+                    eval_dataset = process_dataset(self.get_process_func('validation'), raw_datasets['validation'], False)
             if self.mode == 'pretrain':
-                train_dataset = process_dataset(self.preprocess_pretrain_dataset, train_dataset)
-            elif self.mode == 'sft_train':
-                train_dataset = process_dataset(self.preprocess_train_supervised_fine_tuning_dataset, train_dataset)
-            elif self.mode == 'rm_train':
-                train_dataset = process_dataset(self.preprocess_train_reward_model_dataset, train_dataset)
-            elif self.mode == 'ppo_train':
-                train_dataset = process_dataset(self.preprocess_eval_supervised_fine_tuning_dataset, train_dataset)
-            elif self.mode == 'dpo_train':
-                train_dataset = process_dataset(self.preprocess_train_dpo_text_dataset, train_dataset)
+                # pack the documents in their original order, then shuffle the blocks
+                train_dataset = self.pack_pretrain_dataset(train_dataset).shuffle(seed=self.training_args.seed)
+                if eval_dataset is not None:
+                    eval_dataset = self.pack_pretrain_dataset(eval_dataset)
+            if self.mode == 'sft_train' and self.data_args.sft_packing:
+                num_samples = len(train_dataset)
+                train_dataset = process_dataset(self.pack_supervised_fine_tuning_dataset, train_dataset, desc='Packing dataset')
+                self.logger.info(f'Packed {num_samples} samples into {len(train_dataset)} blocks.')
             self.logger.debug(f'Train dataset nums: {len(train_dataset)}')
-
-            eval_dataset = None
-            if self.training_args.do_eval:
-                if 'validation' not in raw_datasets.keys():
-                    raise ValueError('do_eval requires a validation dataset')
-                eval_dataset = raw_datasets['validation']
-                if self.mode == 'pretrain':
-                    eval_dataset = process_dataset(self.preprocess_pretrain_dataset, eval_dataset, False)
-                elif self.mode == 'sft_train':
-                    eval_dataset = process_dataset(self.preprocess_eval_supervised_fine_tuning_dataset, eval_dataset, False)
-                elif self.mode == 'rm_train':
-                    eval_dataset = process_dataset(self.preprocess_train_reward_model_dataset, eval_dataset, False)
-                elif self.mode == 'dpo_train':
-                    eval_dataset = process_dataset(self.preprocess_train_dpo_text_dataset, eval_dataset, False)
+            if eval_dataset is not None:
                 self.logger.debug(f'Validation dataset nums: {len(eval_dataset)}')
-            return train_dataset, eval_dataset
+            return self.set_numpy_format(train_dataset), self.set_numpy_format(eval_dataset)
         else:
             raw_datasets = self.load_datasets_from_files(test=True)
-            test_dataset = raw_datasets['test']
-            if self.mode == 'sft_batch_test':
-                test_dataset = process_dataset(self.preprocess_eval_supervised_fine_tuning_dataset, test_dataset, False)
-            elif self.mode == 'rm_batch_test':
-                test_dataset = process_dataset(self.preprocess_train_reward_model_dataset, test_dataset, False)
+            test_dataset = process_dataset(self.get_process_func('test'), raw_datasets['test'], False)
             self.logger.debug(f'Test dataset nums: {len(test_dataset)}')
-            return test_dataset
+            return self.set_numpy_format(test_dataset)
+
+    def set_numpy_format(self, dataset):
+        # the collators read the token columns as numpy views of the arrow buffers instead of python lists
+        if self.mode == 'pretrain' or not isinstance(dataset, Dataset):
+            return dataset
+        dataset.set_format('numpy')
+        return dataset
+
+
+def pad_to_tensor(sequences, padding_value, padding_side='right', pad_to_multiple_of=None, pin_memory=False):
+    """
+    Pad the sequences into one preallocated tensor, returns it with the lengths of the sequences.
+    """
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    max_length = int(lengths.max()) if len(sequences) else 0
+    if pad_to_multiple_of is not None:
+        max_length = -(-max_length // pad_to_multiple_of) * pad_to_multiple_of
+    batch = torch.full((len(sequences), max_length), padding_value, dtype=torch.long, pin_memory=pin_memory)
+    # write through a numpy view of the tensor, the sequences are copied once and never turned into tensors
+    batch_view = batch.numpy()
+    for i, (sequence, length) in enumerate(zip(sequences, lengths.tolist())):
+        if padding_side == 'right':
+            batch_view[i, :length] = sequence
+        else:
+            batch_view[i, max_length - length:] = sequence
+    return batch, torch.from_numpy(lengths)
+
+
+def lengths_to_attention_mask(lengths, max_length, padding_side='right', pin_memory=False):
+    positions = torch.arange(max_length)
+    if padding_side == 'right':
+        attention_mask = positions[None, :] < lengths[:, None]
+    else:
+        attention_mask = positions[None, :] >= (max_length - lengths)[:, None]
+    attention_mask = attention_mask.long()
+    return attention_mask.pin_memory() if pin_memory else attention_mask
+
+
+class DataCollatorForPretrainDataset:
+    """
+    Stack the packed blocks, which all have the same length. The labels come with the blocks and are not masked by
+    the pad id, eos is the same as pad for many tokenizers. Blocks without labels only mask the padding positions.
+    """
+    def __init__(self, label_pad_token_id):
+        self.label_pad_token_id = label_pad_token_id
+
+    def __call__(self, features):
+        batch = {key: torch.stack([torch.as_tensor(feature[key], dtype=torch.long) for feature in features])
+                 for key in features[0]}
+        if 'labels' not in batch:
+            batch['labels'] = batch['input_ids'].masked_fill(batch['attention_mask'] == 0, self.label_pad_token_id)
+        return batch
 
 
-class DataCollatorForRewardModelTraining(DataCollatorWithPadding):
-    def __init__(self, tokenizer, return_tensors):
+class DataCollatorForSupervisedDataset:
+    """
+    Pad input_ids and labels into preallocated tensors and build the attention mask from the lengths, the features
+    can be numpy views or lists.
+    """
+    def __init__(self, tokenizer, label_pad_token_id, pad_to_multiple_of=None, pin_memory=False):
+        self.tokenizer = tokenizer
+        self.label_pad_token_id = label_pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pin_memory = pin_memory
+
+    def __call__(self, features):
+        padding_side = self.tokenizer.padding_side
+        input_ids, lengths = pad_to_tensor([feature['input_ids'] for feature in features],
+                                           self.tokenizer.pad_token_id, padding_side, self.pad_to_multiple_of,
+                                           self.pin_memory)
+        batch = {
+            'input_ids': input_ids,
+            'attention_mask': lengths_to_attention_mask(lengths, input_ids.size(1), padding_side, self.pin_memory)
+        }
+        if 'labels' in features[0]:
+            batch['labels'], _ = pad_to_tensor([feature['labels'] for feature in features], self.label_pad_token_id,
+                                               padding_side, self.pad_to_multiple_of, self.pin_memory)
+        return batch
+
+
+class DataCollatorForRewardModelTraining:
+    """
+    Stack the accepted and the rejected samples into one padded batch, accepted ones first.
+    """
+    def __init__(self, tokenizer, return_tensors='pt', pin_memory=False):
         self.tokenizer = tokenizer
         self.return_tensors = return_tensors
+        self.pin_memory = pin_memory
+
+    def __call__(self, features):
+        padding_side = self.tokenizer.padding_side
+        input_ids, lengths = pad_to_tensor(
+            [feature[key] for key in ('accept_ids', 'reject_ids') for feature in features],
+            self.tokenizer.pad_token_id, padding_side, pin_memory=self.pin_memory)
+        attention_mask = lengths_to_attention_mask(lengths, input_ids.size(1), padding_side, self.pin_memory)
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+class DataCollatorForSharedPromptRewardModel:
+    """
+    Put every prompt once in a row followed by all of its responses. The prompt has segment id 1 in attention_mask
+    and the responses -2, -3, ..., so that the patched attention lets a response see the prompt and itself only,
+    the position ids of every response continue from the prompt. The values are read at the last token of every
+    response, value_rows and value_positions locate them and group_sizes splits them into the groups.
+    """
+    def __init__(self, tokenizer, pin_memory=False):
+        self.tokenizer = tokenizer
+        self.pin_memory = pin_memory
+
+    def __call__(self, features):
+        input_ids_list, segment_ids_list, position_ids_list = [], [], []
+        value_rows, value_positions, group_sizes = [], [], []
+        for row, feature in enumerate(features):
+            prompt_length = len(feature['prompt_ids'])
+            input_ids = [np.asarray(feature['prompt_ids'], dtype=np.int64)]
+            segment_ids = [np.ones(prompt_length, dtype=np.int64)]
+            position_ids = [np.arange(prompt_length)]
+            end = prompt_length
+            for k, response_ids in enumerate(feature['response_ids']):
+                input_ids.append(np.asarray(response_ids, dtype=np.int64))
+                segment_ids.append(np.full(len(response_ids), -(k + 2), dtype=np.int64))
+                position_ids.append(np.arange(prompt_length, prompt_length + len(response_ids)))
+                end += len(response_ids)
+                value_rows.append(row)
+                value_positions.append(end - 1)
+            group_sizes.append(len(feature['response_ids']))
+            input_ids_list.append(np.concatenate(input_ids))
+            segment_ids_list.append(np.concatenate(segment_ids))
+            position_ids_list.append(np.concatenate(position_ids))
+        input_ids, _ = pad_to_tensor(input_ids_list, self.tokenizer.pad_token_id, pin_memory=self.pin_memory)
+        attention_mask, _ = pad_to_tensor(segment_ids_list, 0, pin_memory=self.pin_memory)
+        position_ids, _ = pad_to_tensor(position_ids_list, 0, pin_memory=self.pin_memory)
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'position_ids': position_ids,
+            'value_rows': torch.tensor(value_rows),
+            'value_positions': torch.tensor(value_positions),
+            'group_sizes': torch.tensor(group_sizes)
+        }
+
+
+class DataCollatorForDPODataset:
+    """
+    Pad the tokenized chosen and rejected samples for DPOTrainer, the reference log-probs are passed on when they
+    are precomputed.
+    """
+    def __init__(self, tokenizer, label_pad_token_id, pin_memory=False):
+        self.tokenizer = tokenizer
+        self.label_pad_token_id = label_pad_token_id
+        self.pin_memory = pin_memory
+
+    def __call__(self, features):
+        batch = {}
+        for key in ('chosen', 'rejected'):
+            input_ids, lengths = pad_to_tensor([feature[f'{key}_input_ids'] for feature in features],
+                                               self.tokenizer.pad_token_id, pin_memory=self.pin_memory)
+            batch[f'{key}_input_ids'] = input_ids
+            batch[f'{key}_attention_mask'] = lengths_to_attention_mask(lengths, input_ids.size(1),
+                                                                       pin_memory=self.pin_memory)
+            batch[f'{key}_labels'], _ = pad_to_tensor([feature[f'{key}_labels'] for feature in features],
+                                                      self.label_pad_token_id, pin_memory=self.pin_memory)
+        for key in ('reference_chosen_logps', 'reference_rejected_logps'):
+            if key in features[0]:
+                batch[key] = torch.tensor([float(feature[key]) for feature in features], dtype=torch.float32)
+        return batch
+
+
+class DataCollatorForPackedDPODataset:
+    """
+    Concatenate the chosen samples of a batch and then the rejected ones into one row without padding. Every sample
+    has its own segment id (1, 2, ...) in attention_mask and its position ids restart from 0, the first label of
+    every sample is masked so that no token is predicted from the previous sample.
+    """
+    def __init__(self, tokenizer, label_pad_token_id, pin_memory=False):
+        self.tokenizer = tokenizer
+        self.label_pad_token_id = label_pad_token_id
+        self.pin_memory = pin_memory
+
+    def __call__(self, features):
+        sequences = [(feature[f'{key}_input_ids'], feature[f'{key}_labels'])
+                     for key in ('chosen', 'rejected') for feature in features]
+        lengths = np.fromiter((len(input_ids) for input_ids, _ in sequences), dtype=np.int64, count=len(sequences))
+        ends = np.cumsum(lengths)
+        # keep one padding position so that flash attention takes the unpad branch with the segment ids
+        total_length = int(ends[-1]) + 1
+        input_ids = torch.full((1, total_length), self.tokenizer.pad_token_id, dtype=torch.long,
+                               pin_memory=self.pin_memory)
+        labels = torch.full((1, total_length), self.label_pad_token_id, dtype=torch.long, pin_memory=self.pin_memory)
+        input_ids_view, labels_view = input_ids.numpy()[0], labels.numpy()[0]
+        for (sequence_input_ids, sequence_labels), start, end in zip(sequences, (ends - lengths).tolist(),
+                                                                     ends.tolist()):
+            input_ids_view[start:end] = sequence_input_ids
+            labels_view[start + 1:end] = sequence_labels[1:]
+        starts = np.zeros(total_length, dtype=bool)
+        starts[ends - lengths] = True
+        starts[-1] = True
+        position_ids, segment_ids = document_positions(starts)
+        segment_ids[-1] = 0
+        batch = {
+            'input_ids': input_ids,
+            'attention_mask': torch.from_numpy(segment_ids[None, :]),
+            'position_ids': torch.from_numpy(position_ids[None, :]),
+            'labels': labels
+        }
+        for key in ('reference_chosen_logps', 'reference_rejected_logps'):
+            if key in features[0]:
+                batch[key] = torch.tensor([float(feature[key]) for feature in features], dtype=torch.float32)
+        return batch
+
+
+class DataCollatorForPackedSupervisedDataset:
+    def __init__(self, tokenizer, label_pad_token_id, segment_attention=True):
+        self.tokenizer = tokenizer
+        self.label_pad_token_id = label_pad_token_id
+        self.segment_attention = segment_attention
 
     def __call__(self, features):
-        features = [
-            {'input_ids': feature[key], 'attention_mask': [1] * len(feature[key])}
-            for key in ('accept_ids', 'reject_ids') for feature in features
-        ]
-        return super().__call__(features)
+        max_length = max(len(feature['input_ids']) for feature in features)
+        if self.segment_attention:
+            # keep at least one padding position so that flash attention takes the unpad branch with the segment ids
+            max_length += 1
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_length), self.label_pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+        for i, feature in enumerate(features):
+            length = len(feature['input_ids'])
+            input_ids[i, :length] = torch.as_tensor(feature['input_ids'], dtype=torch.long)
+            labels[i, :length] = torch.as_tensor(feature['labels'], dtype=torch.long)
+            position_ids[i, :length] = torch.as_tensor(feature['position_ids'], dtype=torch.long)
+            attention_mask[i, :length] = torch.as_tensor(feature['attention_mask'], dtype=torch.long)
+        if not self.segment_attention:
+            attention_mask = (attention_mask > 0).long()
+        return {'input_ids': input_ids, 'attention_mask': attention_mask,
+                'labels': labels, 'position_ids': position_ids}
@@ -12,10 +12,16 @@ from engines.utils.dispatch_to_multi_gpu import dispatch
 from engines.utils.print_parameters import summary
 from engines.utils.cpm_quantizer import QuantizedLinear
 from engines.utils.expand_vocab import expand_vocab
+from engines.utils.memory_estimator import build_empty_model, get_model_dims, count_parameters
+from engines.utils.memory_estimator import load_deepspeed_settings, estimate_static_memory, estimate_activation_memory
+from engines.utils.memory_estimator import estimate_batch_memory
+from engines.utils.memory_estimator import max_batch_size, describe_zero, ZERO_CANDIDATES, DEVICE_OVERHEAD_GB, GIB
+from engines.utils.dataset_stats import format_stats_table
 from peft.utils import CONFIG_NAME, WEIGHTS_NAME
 from peft import PeftModel
 from types import MethodType
 import bitsandbytes as bnb
+import json
 import os
 import math
 import torch
@@ -26,6 +32,7 @@ class BaseModels:
         self.logger = logger
         self.model_args = config.model_args
         self.training_args = config.training_args
+        self.generating_args = config.generating_args
         self.mode = config.mode
         self.tokenizer = data_manager.tokenizer
         self.data_manager = data_manager
@@ -52,16 +59,41 @@ class BaseModels:
             self.logger.info(f'The given dir: {adapter_dir} may be not have adapter checkpoint.')
         return model
 
+    def load_adapter_with_reference(self, model, adapter_dir, reference_adapter='reference'):
+        """
+        Load the adapter to keep training it, and the same adapter once more as a frozen reference_adapter, the
+        base weights are not merged and shared by both.
+        """
+        if adapter_dir is None or not os.path.exists(os.path.join(adapter_dir, CONFIG_NAME)):
+            raise ValueError(f'The given dir: {adapter_dir} may be not have adapter checkpoint.')
+        self.logger.info(f'Found adapter model at {adapter_dir}, load it as trainable and as the frozen reference.')
+        self.has_peft = True
+        model = PeftModel.from_pretrained(model, adapter_dir, is_trainable=True)
+        model.load_adapter(adapter_dir, adapter_name=reference_adapter, is_trainable=False)
+        model.set_adapter('default')
+        return model
+
     def load_reward_model(self, model, vhead_dir):
         if os.path.exists(vhead_path := os.path.join(vhead_dir, 'vhead.bin')):
             self.logger.info(f'Found v_head model at {vhead_dir} and load it.')
-            model = self.load_adapter(model, adapter_dir=vhead_dir)
+            if self.training_args.fine_tuning_type == 'full' and not os.path.exists(
+                    os.path.join(vhead_dir, CONFIG_NAME)):
+                # vhead.bin only holds the value head, the full fine-tuned backbone is saved next to it
+                if not os.path.exists(os.path.join(vhead_dir, 'config.json')):
+                    raise ValueError(f'The given dir: {vhead_dir} does not have the fine-tuned reward backbone.')
+                self.logger.info(f'Load the reward backbone from {vhead_dir}.')
+                model = self.load_base_model(model_to_load=vhead_dir)
+            else:
+                model = self.load_adapter(model, adapter_dir=vhead_dir)
             self.has_vhead = True
             if self.model_args.model_type == 'chatglm' and any(
                     key.endswith('rotary_pos_emb') for key, _ in model.named_modules()):
                 model.lm_head = model.transformer.output_layer
             model = AutoModelForCausalLMWithValueHead.from_pretrained(model)
-            model.load_state_dict(torch.load(vhead_path), strict=False)
+            # older vhead.bin files hold the whole model, only the value head is taken from them
+            state_dict = torch.load(vhead_path, map_location='cpu')
+            model.v_head.load_state_dict(
+                {key[len('v_head.'):]: value for key, value in state_dict.items() if key.startswith('v_head.')})
         else:
             self.logger.info(f'The given dir: {vhead_dir} may be not have v_head checkpoint.')
         return model
@@ -138,7 +170,7 @@ class BaseModels:
                         self.logger.warning('Current model support the length you set.')
         return model
 
-    def load_base_model(self):
+    def load_base_model(self, model_to_load=None):
         config_kwargs = {'cache_dir': self.model_args.cache_dir,
                          'torch_dtype': self.model_args.torch_dtype}
         dispatched = False
@@ -173,7 +205,9 @@ class BaseModels:
                 config_kwargs['device_map'] = 'auto'
                 dispatched = True
 
-        if self.model_args.checkpoint_dir is not None and self.training_args.fine_tuning_type == 'full':
+        if model_to_load is not None:
+            pass
+        elif self.model_args.checkpoint_dir is not None and self.training_args.fine_tuning_type == 'full':
             model_to_load = self.model_args.checkpoint_dir
         else:
             model_to_load = self.model_args.model_path
@@ -359,3 +393,117 @@ class BaseModels:
             self.model_args.torch_dtype,
             self.training_args
         )
+
+    def estimate_memory(self):
+        """
+        Estimate the memory of one device for training in estimate_mode from the model config, the model is built on
+        the meta device so no weights are loaded. Suggest the largest batch size, or the offloading that fits.
+        """
+        args, data_args = self.training_args, self.data_manager.data_args
+        mode = args.estimate_mode
+        self.logger.info(f'Build the model of {self.model_args.model_path} on the meta device.')
+        model = build_empty_model(self.model_args.model_path, self.model_args.model_type)
+        dims = get_model_dims(model.config)
+        lora_rank = args.adalora_init_r if args.fine_tuning_type == 'adalora' else args.lora_rank
+        # qlora targets all the linear layers
+        counts = count_parameters(model, [target.strip() for target in args.lora_target.split(',')], lora_rank,
+                                  all_linear=self.model_args.quantization_bit is not None)
+        match args.fine_tuning_type:
+            case 'full':
+                num_trainable = counts['parameters']
+            case 'lora' | 'adalora':
+                num_trainable = counts['lora']
+            case 'prefix_tuning':
+                num_trainable = args.num_virtual_tokens * 2 * dims['num_layers'] * dims['hidden_size']
+            case _:
+                num_trainable = args.num_virtual_tokens * dims['hidden_size']
+
+        dtype = self.model_args.torch_dtype
+        if not isinstance(dtype, torch.dtype):
+            dtype = getattr(model.config, 'torch_dtype', None) or torch.float16
+            dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+        dtype_bytes = torch.finfo(dtype).bits // 8
+        sequence_length = data_args.max_input_token
+        if mode == 'pretrain':
+            sequence_length = self.data_manager.get_pretrain_block_size()
+        elif mode == 'ppo_train':
+            sequence_length += self.generating_args.max_new_tokens
+        num_devices = args.estimate_num_devices or int(os.environ.get('WORLD_SIZE', 0)) or \
+            max(1, torch.cuda.device_count())
+        settings = {
+            'counts': counts,
+            'num_trainable': num_trainable,
+            'full': args.fine_tuning_type == 'full',
+            'amp': args.fp16 or args.bf16,
+            'quantization_bit': self.model_args.quantization_bit,
+            'dtype_bytes': dtype_bytes,
+            'activation_bytes': 2 if args.fp16 or args.bf16 or dtype_bytes == 2 else 4,
+            'num_devices': num_devices,
+            'reference_copy': mode == 'dpo_train' and args.dpo_reference == 'copy' and
+            not args.dpo_precompute_ref_log_probs,
+            'sequence_length': sequence_length,
+            'sequences_per_sample': 2 if mode in ('rm_train', 'dpo_train') else 1,
+            'flash_attn': self.model_args.use_flash_attn and
+            self.model_args.model_type in ('falcon', 'mistral', 'llama'),
+            'gradient_checkpointing': args.gradient_checkpointing,
+            # the reward model skips the lm head and only sft computes the chunked loss
+            'logits': mode != 'rm_train',
+            'chunked_ce_loss': args.chunked_ce_loss and mode == 'sft_train',
+            'ce_chunk_size': args.ce_chunk_size
+        }
+        if args.estimate_device_memory_gb is not None:
+            device_bytes = args.estimate_device_memory_gb * GIB
+        elif torch.cuda.is_available():
+            device_bytes = torch.cuda.get_device_properties(0).total_memory
+        else:
+            device_bytes = None
+
+        zero = load_deepspeed_settings(args.deepspeed)
+        activations = estimate_activation_memory(dims, settings)
+        batch_bytes = estimate_batch_memory(dims, settings)
+        batch_size = args.per_device_train_batch_size
+        rows, plans = [], []
+        for candidate in (zero, *ZERO_CANDIDATES):
+            static = estimate_static_memory(settings, candidate)
+            total = sum(static.values()) + batch_size * sum(activations.values()) + batch_bytes + \
+                DEVICE_OVERHEAD_GB * GIB
+            plan = {'deepspeed': describe_zero(candidate), **{key: value / GIB for key, value in static.items()},
+                    'activations_per_sample': sum(activations.values()) / GIB,
+                    'activations_per_batch': batch_bytes / GIB, 'total': total / GIB}
+            if device_bytes is not None:
+                plan['max_batch_size'] = max_batch_size(static, activations, device_bytes, batch_bytes)
+            plans.append(plan)
+            rows.append([plan['deepspeed']] + [f'{plan[key]:.2f}' for key in (
+                'weights', 'gradients', 'optimizer', 'reference', 'activations_per_sample', 'activations_per_batch',
+                'total')] + [plan.get('max_batch_size', '-')])
+        self.logger.info(f'Model dims: {dims}, parameters: {counts}, trainable: {num_trainable}')
+        self.logger.info(f'Memory of one of {num_devices} devices for {mode} with per_device_train_batch_size='
+                         f'{batch_size} and {sequence_length} tokens per sequence (GB):\n' + format_stats_table(
+                             ['setting', 'weights', 'gradients', 'optimizer', 'reference', 'act/sample', 'act/batch',
+                              f'total@{batch_size}', 'max_batch'], rows))
+
+        suggestion = None
+        if device_bytes is None:
+            self.logger.warning('No cuda device found, set estimate_device_memory_gb to get a batch size suggestion.')
+        elif (max_batch := plans[0]['max_batch_size']) >= batch_size:
+            suggestion = f'{describe_zero(zero)} fits, per_device_train_batch_size can be raised up to {max_batch}.'
+        elif max_batch >= 1:
+            accumulation = math.ceil(batch_size * args.gradient_accumulation_steps / max_batch)
+            suggestion = f'{describe_zero(zero)} fits per_device_train_batch_size={max_batch} at most, use ' \
+                         f'gradient_accumulation_steps={accumulation} to keep the global batch size.'
+        elif (plan := next((plan for plan in plans[1:] if plan['max_batch_size'] >= 1), None)) is not None:
+            suggestion = f"{describe_zero(zero)} does not fit, use deepspeed {plan['deepspeed']} which fits " \
+                         f"per_device_train_batch_size={plan['max_batch_size']} at most."
+        else:
+            suggestion = 'None of the settings fits, try gradient_checkpointing, lora, quantization_bit=4 or a ' \
+                         'shorter max_input_token.'
+        if suggestion is not None:
+            self.logger.info(suggestion)
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        estimate_file = os.path.join(args.output_dir, 'memory_estimate.json')
+        with open(estimate_file, 'w', encoding='utf-8') as f:
+            json.dump({'mode': mode, 'num_devices': num_devices, 'dims': dims, 'parameters': counts,
+                       'trainable': num_trainable, 'plans': plans, 'suggestion': suggestion}, f, indent=2)
+        self.logger.info(f'Memory estimate saved to {estimate_file}')
+        return plans
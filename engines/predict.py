@@ -9,6 +9,7 @@ from engines.utils.parse_text import parse_text
 from engines.utils.metrics import Metrics
 from engines.models import BaseModels
 from engines.utils.logits_process import logits_processor
+from engines.utils.profiler import StepProfiler
 from threading import Thread
 import gradio as gr
 import mdtex2html
@@ -28,12 +29,29 @@ class Predictor(BaseModels):
         self.model = self.load_adapter(self.model, adapter_dir=self.model_args.checkpoint_dir)
         self.logger.info(f'Model struct:\n{self.model}')
         self.model.eval()
+        self.profiler = None
+        if self.training_args.torch_profile:
+            self.profiler = StepProfiler(self.training_args, self.training_args.output_dir, name=self.mode)
+
+    def start_generation(self, gen_kwargs):
+        if self.profiler is None or self.profiler.finished:
+            thread = Thread(target=self.model.generate, kwargs=gen_kwargs)
+            thread.start()
+            return
+        # the profiler only sees the operators of the thread it is started in, so the generations of the window run
+        # in the calling thread and the streamer is read after them
+        self.profiler.start()
+        self.model.generate(**gen_kwargs)
+        self.profiler.step()
+
+    def encode_prompt(self, query, history):
+        prompt_template = self.prompt_template.get_prompt(query, history)
+        return self.tokenizer([prompt_template], return_tensors='pt')['input_ids']
 
     def web_inference(self):
         def predict(input, chatbot, history, max_new_tokens, top_p, repetition_penalty, temperature):
             chatbot.append((parse_text(input), ''))
-            prompt_template = self.prompt_template.get_prompt(input, history)
-            input_ids = self.tokenizer([prompt_template], return_tensors='pt')['input_ids']
+            input_ids = self.encode_prompt(input, history)
             input_ids = input_ids.to(self.model.device)
             streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
             gen_kwargs = self.generating_args.to_dict()
@@ -51,8 +69,7 @@ class Predictor(BaseModels):
                 'streamer': streamer
             })
 
-            thread = Thread(target=self.model.generate, kwargs=gen_kwargs)
-            thread.start()
+            self.start_generation(gen_kwargs)
 
             response = ''
             for new_text in streamer:
@@ -113,8 +130,7 @@ class Predictor(BaseModels):
 
     def terminal_inference(self):
         def predict(input, history):
-            prompt_template = self.prompt_template.get_prompt(input, history)
-            input_ids = self.tokenizer([prompt_template], return_tensors='pt')['input_ids']
+            input_ids = self.encode_prompt(input, history)
             input_ids = input_ids.to(self.model.device)
             streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
             gen_kwargs = self.generating_args.to_dict()
@@ -124,8 +140,7 @@ class Predictor(BaseModels):
                 'logits_processor': logits_processor(),
                 'streamer': streamer
             })
-            thread = Thread(target=self.model.generate, kwargs=gen_kwargs)
-            thread.start()
+            self.start_generation(gen_kwargs)
             print(f'{self.model_args.model_type}:', end='', flush=True)
             response = ''
             for new_text in streamer:
@@ -7,19 +7,26 @@
 from engines.models import BaseModels
 from engines.utils.print_parameters import print_trainable_parameters
 from engines.utils.metrics import Metrics
-from engines.data import DataCollatorForRewardModelTraining
-from engines.utils.trainer import SFTTrainer, RewardTrainer, MyPPOTrainer
-from trl import DPOTrainer
+from engines.data import DataCollatorForRewardModelTraining, DataCollatorForPackedSupervisedDataset
+from engines.data import DataCollatorForPretrainDataset
+from engines.data import DataCollatorForSupervisedDataset, DataCollatorForDPODataset, DataCollatorForPackedDPODataset
+from engines.data import DataCollatorForSharedPromptRewardModel
+from engines.utils.packing import apply_packed_attention_patch
+from engines.utils.throughput import ThroughputCallback, count_tokens
+from engines.utils.profiler import ProfilerCallback, StepProfiler
+from engines.utils.trainer import PretrainTrainer, SFTTrainer, RewardTrainer, MyPPOTrainer, MyDPOTrainer
+from engines.utils.trainer import last_token_indices, gather_last_values
+from engines.utils.chunked_loss import get_output_embeddings, skip_output_embeddings
 from peft import LoraConfig, AdaLoraConfig, PromptTuningConfig, PromptEncoderConfig, PrefixTuningConfig
 from peft import TaskType, get_peft_model
 from copy import deepcopy
-from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
-from transformers import Trainer
+from transformers.trainer_utils import get_last_checkpoint
 from config import TrainingArguments
 from trl import AutoModelForCausalLMWithValueHead, PPOConfig, set_seed
 from tqdm import tqdm
 import torch
 import math
+import json
 import os
 
 
@@ -134,6 +141,24 @@ class Train(BaseModels):
             model.print_trainable_parameters()
         return model
 
+    def collate_into_pinned_memory(self):
+        # collate straight into pinned memory only in the main process, the dataloader workers must not touch cuda
+        return self.training_args.dataloader_pin_memory and self.training_args.dataloader_num_workers == 0 \
+            and torch.cuda.is_available()
+
+    def get_resume_checkpoint(self):
+        # the trainer and data states are saved in output_dir/checkpoint-N, resume from the newest one
+        output_dir = self.training_args.output_dir
+        return (get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None) or output_dir
+
+    def get_train_callbacks(self):
+        callbacks = []
+        if self.training_args.throughput_metrics:
+            callbacks.append(ThroughputCallback(peak_tflops=self.training_args.peak_tflops))
+        if self.training_args.torch_profile:
+            callbacks.append(ProfilerCallback(self.training_args, name=self.mode))
+        return callbacks or None
+
     def set_train_environment(self, model):
 
         if (noise_alpha := self.training_args.noise_alpha) > 0:
@@ -166,24 +191,35 @@ class Train(BaseModels):
             model.model_parallel = True
 
     def pretrain(self):
+        if self.data_manager.data_args.streaming and self.training_args.max_steps <= 0:
+            raise ValueError('Streaming pretrain requires max_steps to be set.')
         self.logger.info(f'Load base model from {self.model_args.model_path}')
         model = self.load_base_model()
-        data_collator = DataCollatorForLanguageModeling(tokenizer=self.tokenizer, mlm=False)
+        if self.data_manager.data_args.pretrain_document_mask:
+            segment_attention = apply_packed_attention_patch(self.model_args.model_type, self.logger)
+            data_collator = DataCollatorForPackedSupervisedDataset(
+                tokenizer=self.tokenizer,
+                label_pad_token_id=self.data_manager.label_pad_token_id,
+                segment_attention=segment_attention
+            )
+        else:
+            data_collator = DataCollatorForPretrainDataset(label_pad_token_id=self.data_manager.label_pad_token_id)
         model = self.construct_base_model(model)
         self.set_train_environment(model)
         self.logger.info(f'Model struct:\n{model}')
         train_dataset, eval_dataset = self.data_manager.prepare_dataset()
-        trainer = Trainer(
+        trainer = PretrainTrainer(
             model=model,
             args=self.training_args,
             train_dataset=train_dataset if self.training_args.do_train else None,
             tokenizer=self.tokenizer,
             data_collator=data_collator,
+            callbacks=self.get_train_callbacks()
         )
         self.logger.info('*** Start training. ***')
         checkpoint = None
         if self.training_args.resume_from_checkpoint:
-            checkpoint = self.training_args.output_dir
+            checkpoint = self.get_resume_checkpoint()
             self.logger.info(f'Resume checkpoint from {checkpoint}')
         try:
             trainer_result = trainer.train(resume_from_checkpoint=checkpoint)
@@ -208,29 +244,42 @@ class Train(BaseModels):
             trainer.save_metrics('eval', metrics)
 
     def supervised_fine_tuning(self, test=False):
+        if not test and self.data_manager.data_args.sft_packing and \
+                not apply_packed_attention_patch(self.model_args.model_type, self.logger):
+            # the samples of a block would attend to each other, and models without position_ids drop that column
+            raise ValueError(f'sft_packing is not supported for {self.model_args.model_type}.')
         self.logger.info(f'Load base model from {self.model_args.model_path}')
         model = self.load_base_model()
-        data_collator = DataCollatorForSeq2Seq(
+        data_collator = DataCollatorForSupervisedDataset(
             tokenizer=self.tokenizer,
-            return_tensors='pt',
             label_pad_token_id=self.data_manager.label_pad_token_id,
+            pin_memory=self.collate_into_pinned_memory()
         )
         if not test:
             model = self.construct_base_model(model)
             self.set_train_environment(model)
             self.logger.info(f'Model struct:\n{model}')
             train_dataset, eval_dataset = self.data_manager.prepare_dataset()
+            # only the train set is packed, the eval set is padded
+            eval_data_collator = data_collator
+            if self.data_manager.data_args.sft_packing:
+                data_collator = DataCollatorForPackedSupervisedDataset(
+                    tokenizer=self.tokenizer,
+                    label_pad_token_id=self.data_manager.label_pad_token_id
+                )
             trainer = SFTTrainer(
                 model=model,
                 args=self.training_args,
                 train_dataset=train_dataset if self.training_args.do_train else None,
                 tokenizer=self.tokenizer,
                 data_collator=data_collator,
+                eval_data_collator=eval_data_collator,
+                callbacks=self.get_train_callbacks()
             )
             self.logger.info('*** Start training. ***')
             checkpoint = None
             if self.training_args.resume_from_checkpoint:
-                checkpoint = self.training_args.output_dir
+                checkpoint = self.get_resume_checkpoint()
                 self.logger.info(f'Resume checkpoint from {checkpoint}')
             try:
                 trainer_result = trainer.train(resume_from_checkpoint=checkpoint)
@@ -292,7 +341,16 @@ class Train(BaseModels):
                 model.lm_head = model.transformer.output_layer
             reward_model = AutoModelForCausalLMWithValueHead.from_pretrained(model)
         self.logger.info(f'Model struct:\n{reward_model}')
-        data_collator = DataCollatorForRewardModelTraining(tokenizer=self.tokenizer, return_tensors='pt')
+        if self.training_args.rm_shared_prompt:
+            if self.model_args.use_flash_attn:
+                raise ValueError('rm_shared_prompt can not be used with flash attention.')
+            if not apply_packed_attention_patch(self.model_args.model_type, self.logger):
+                raise ValueError(f'rm_shared_prompt is not supported for {self.model_args.model_type}.')
+            data_collator = DataCollatorForSharedPromptRewardModel(
+                tokenizer=self.tokenizer, pin_memory=self.collate_into_pinned_memory())
+        else:
+            data_collator = DataCollatorForRewardModelTraining(
+                tokenizer=self.tokenizer, return_tensors='pt', pin_memory=self.collate_into_pinned_memory())
         if not test:
             print_trainable_parameters(reward_model, self.logger)
             train_dataset, eval_dataset = self.data_manager.prepare_dataset()
@@ -304,7 +362,8 @@ class Train(BaseModels):
                 train_dataset=train_dataset if self.training_args.do_train else None,
                 tokenizer=self.tokenizer,
                 data_collator=data_collator,
-                compute_metrics=self.metrics.computer_training_reward_metric
+                compute_metrics=self.metrics.computer_training_reward_metric,
+                callbacks=self.get_train_callbacks()
             )
             train_result = trainer.train()
             metrics = train_result.metrics
@@ -361,9 +420,8 @@ class Train(BaseModels):
 
         train_dataset, _ = self.data_manager.prepare_dataset()
 
-        data_collator = DataCollatorForSeq2Seq(
+        data_collator = DataCollatorForSupervisedDataset(
             tokenizer=self.tokenizer,
-            return_tensors='pt',
             label_pad_token_id=self.tokenizer.pad_token_id
         )
         output_dir = self.training_args.output_dir
@@ -395,9 +453,22 @@ class Train(BaseModels):
         gen_kwargs['eos_token_id'] = [self.tokenizer.eos_token_id] + self.tokenizer.additional_special_tokens_ids
 
         total_steps = config.total_ppo_epochs
+        # PPOTrainer is not a transformers Trainer, the throughput is measured around every PPO step here
+        throughput = ThroughputCallback(peak_tflops=self.training_args.peak_tflops) \
+            if self.training_args.throughput_metrics else None
+        if throughput is not None:
+            # the FLOPs are counted as one training pass of the policy, the generation, the reward and reference
+            # forwards and the extra ppo_epochs are left out, so the MFU of PPO is a lower bound
+            throughput.setup(ppo_model)
+        profiler = StepProfiler(self.training_args, output_dir, name=self.mode,
+                                rank=self.training_args.process_index) if self.training_args.torch_profile else None
+        if profiler is not None:
+            profiler.start()
         for step, batch in tqdm(enumerate(ppo_trainer.dataloader)):
             if step >= total_steps:
                 break
+            if throughput is not None:
+                throughput.start_batch()
 
             queries = batch['input_ids']
             batch['query'] = self.tokenizer.batch_decode(queries, skip_special_tokens=True)
@@ -406,10 +477,12 @@ class Train(BaseModels):
             responses = ppo_trainer.generate(queries, return_prompt=False, **gen_kwargs)
             batch['response'] = self.tokenizer.batch_decode(responses, skip_special_tokens=True)
             reward_input_batch = ppo_trainer.prepare_model_inputs(queries, responses)
-            _, _, values = reward_model(**reward_input_batch, output_hidden_states=True, return_dict=True)
-
-            values = torch.transpose(values, 1, 0) if self.model_args.model_type == 'chatglm' else values
-            scores = [reward for reward in values[:, -1].detach().cpu()]
+            # score at the last real token like the reward model was trained
+            last_indices = last_token_indices(reward_input_batch['attention_mask'])
+            with skip_output_embeddings(get_output_embeddings(reward_model.pretrained_model)), gather_last_values(
+                    reward_model.v_head, last_indices, seq_first=self.model_args.model_type == 'chatglm'):
+                _, _, values = reward_model(**reward_input_batch, output_hidden_states=True, return_dict=True)
+            scores = [reward for reward in values.detach().cpu()]
 
             unpad_queries = []
             for query in queries:
@@ -419,25 +492,74 @@ class Train(BaseModels):
 
             responses = [i.squeeze(0) for i in responses]
             stats = ppo_trainer.step(queries, responses, scores)
+            if throughput is not None:
+                throughput.end_batch()
+                num_tokens, num_all_tokens, _ = count_tokens({'attention_mask': batch['attention_mask']})
+                num_response_tokens = sum(len(response) for response in responses)
+                throughput.add_tokens(num_tokens + num_response_tokens, num_all_tokens + num_response_tokens,
+                                      len(responses))
+                stats |= {f'throughput/{key}': value for key, value in throughput.pop_interval_metrics().items()}
             ppo_trainer.log_stats(stats, batch, scores)
+            if profiler is not None:
+                profiler.step()
             self.logger.debug(f'Step {step}/{total_steps}: reward score:{scores}')
             if (step + 1) % self.training_args.save_steps == 0:
                 ppo_trainer.save_pretrained(os.path.join(self.training_args.output_dir, f'checkpoint-{step + 1}'))
         ppo_trainer.save_pretrained(self.training_args.output_dir)
+        if profiler is not None:
+            profiler.stop()
+        if throughput is not None:
+            metrics = throughput.summary()
+            self.logger.info(f'Throughput metrics: {metrics}')
+            if ppo_trainer.accelerator.is_main_process:
+                with open(os.path.join(output_dir, 'throughput_results.json'), 'w', encoding='utf-8') as f:
+                    json.dump(metrics, f, indent=4, sort_keys=True)
 
     def train_dpo(self):
         self.logger.info(f'Load base model from {self.model_args.model_path}')
         model = self.load_base_model()
-        model = self.load_adapter(model, adapter_dir=self.model_args.checkpoint_dir)
-        ref_model = deepcopy(model)
-        model = self.construct_base_model(model)
+        reference = self.training_args.dpo_reference
+        if reference != 'copy' and self.training_args.fine_tuning_type not in ('lora', 'adalora'):
+            raise ValueError(f'dpo_reference={reference} requires lora or adalora fine tuning.')
+        reference_adapter = None
+        if reference == 'sft_adapter':
+            # the policy keeps training the sft adapter, a frozen copy of it gives the reference
+            if self.training_args.fine_tuning_type != 'lora':
+                raise ValueError('dpo_reference=sft_adapter requires lora fine tuning.')
+            reference_adapter = 'reference'
+            model = self.load_adapter_with_reference(model, self.model_args.checkpoint_dir, reference_adapter)
+        else:
+            model = self.load_adapter(model, adapter_dir=self.model_args.checkpoint_dir)
+        precompute_ref_log_probs = self.training_args.dpo_precompute_ref_log_probs
+        # precomputed reference log-probs come from the prepared policy when training begins, the adapter modes get
+        # them from the policy's own weights
+        ref_model = None if precompute_ref_log_probs or reference != 'copy' else deepcopy(model)
+        if reference != 'sft_adapter':
+            model = self.construct_base_model(model)
         self.set_train_environment(model)
         self.logger.info(f'Model struct:\n{model}')
         train_dataset, eval_dataset = self.data_manager.prepare_dataset()
         training_args = self.training_args.to_dict()
         training_args |= {'remove_unused_columns': False}
         training_args = TrainingArguments(**training_args)
-        dpo_trainer = DPOTrainer(
+        if self.training_args.dpo_packing:
+            if not self.model_args.use_flash_attn:
+                # without flash attention the packed row needs a dense mask over all of its tokens
+                raise ValueError('dpo_packing can only be used with flash attention.')
+            if not apply_packed_attention_patch(self.model_args.model_type, self.logger):
+                raise ValueError(f'dpo_packing is not supported for {self.model_args.model_type}.')
+            data_collator = DataCollatorForPackedDPODataset(
+                tokenizer=self.tokenizer,
+                label_pad_token_id=self.data_manager.label_pad_token_id,
+                pin_memory=self.collate_into_pinned_memory()
+            )
+        else:
+            data_collator = DataCollatorForDPODataset(
+                tokenizer=self.tokenizer,
+                label_pad_token_id=self.data_manager.label_pad_token_id,
+                pin_memory=self.collate_into_pinned_memory()
+            )
+        dpo_trainer = MyDPOTrainer(
             ref_model=ref_model,
             model=model,
             beta=self.training_args.dpo_beta,
@@ -445,12 +567,19 @@ class Train(BaseModels):
             eval_dataset=eval_dataset,
             tokenizer=self.tokenizer,
             args=training_args,
-            max_length=self.data_manager.data_args.max_input_token
+            data_collator=data_collator,
+            label_pad_token_id=self.data_manager.label_pad_token_id,
+            padding_value=self.tokenizer.pad_token_id,
+            max_length=self.data_manager.data_args.max_input_token,
+            precompute_ref_log_probs=precompute_ref_log_probs,
+            reference_key=f'{self.model_args.model_path}|{self.model_args.checkpoint_dir}',
+            reference_adapter=reference_adapter,
+            callbacks=self.get_train_callbacks()
         )
         self.logger.info('*** Start training. ***')
         checkpoint = None
         if self.training_args.resume_from_checkpoint:
-            checkpoint = self.training_args.output_dir
+            checkpoint = self.get_resume_checkpoint()
             self.logger.info(f'Resume checkpoint from {checkpoint}')
         try:
             trainer_result = dpo_trainer.train(resume_from_checkpoint=checkpoint)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/22 21:30
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : chunked_loss.py
+# @Software: PyCharm
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager
+import torch
+
+
+def get_output_embeddings(model):
+    if (lm_head := model.get_output_embeddings()) is None:
+        # chatglm keeps its output layer inside the transformer
+        lm_head = model.transformer.output_layer
+    return lm_head
+
+
+@contextmanager
+def skip_output_embeddings(lm_head):
+    """
+    Let the model return the final hidden states in place of the logits, lm_head is applied later chunk by chunk.
+    """
+    # accelerate's device_map hooks live in the instance forward, it is put back instead of deleted
+    hooked_forward = lm_head.__dict__.get('forward')
+    lm_head.forward = lambda hidden_states: hidden_states
+    try:
+        yield
+    finally:
+        if hooked_forward is None:
+            del lm_head.forward
+        else:
+            lm_head.forward = hooked_forward
+
+
+def chunk_loss(lm_head, hidden_states, targets):
+    logits = lm_head(hidden_states).float()
+    return torch.nn.functional.cross_entropy(logits, targets, reduction='sum')
+
+
+def chunked_cross_entropy(hidden_states, labels, lm_head, chunk_size=4096, ignore_index=-100):
+    """
+    Causal language modeling loss over the supervised positions only. The hidden states of those positions are
+    gathered and sent through lm_head chunk by chunk, every chunk is checkpointed so that the logits of one chunk
+    at most are alive, in the forward as well as in the backward.
+    """
+    shift_labels = labels[:, 1:]
+    mask = shift_labels != ignore_index
+    # llama and mistral upcast the "logits" to fp32, lm_head runs outside autocast so it needs its own dtype
+    hidden_states = hidden_states[:, :-1][mask].to(lm_head.weight.dtype)
+    targets = shift_labels[mask]
+    num_targets = targets.numel()
+    if num_targets == 0:
+        # keep the graph connected so that every rank runs the same backward
+        return hidden_states.sum() * 0.0
+    loss = hidden_states.new_zeros((), dtype=torch.float32)
+    for hidden_chunk, target_chunk in zip(hidden_states.split(chunk_size), targets.split(chunk_size)):
+        if torch.is_grad_enabled():
+            loss = loss + checkpoint(chunk_loss, lm_head, hidden_chunk, target_chunk, use_reentrant=False)
+        else:
+            loss = loss + chunk_loss(lm_head, hidden_chunk, target_chunk)
+    return loss / num_targets
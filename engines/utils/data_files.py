@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/18 21:05
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : data_files.py
+# @Software: PyCharm
+from datasets import load_dataset, concatenate_datasets, Dataset, Features
+from itertools import groupby
+import pyarrow.parquet as pq
+import pyarrow as pa
+import gzip
+import io
+
+DATA_FILE_SUFFIXES = ('.txt', '.json', '.jsonl', '.jsonl.gz', '.jsonl.zst', '.parquet', '.arrow')
+
+
+def get_file_format(file_path):
+    if file_path.endswith('.txt'):
+        return 'text'
+    if file_path.endswith(('.json', '.jsonl', '.jsonl.gz', '.jsonl.zst')):
+        return 'json'
+    if file_path.endswith('.parquet'):
+        return 'parquet'
+    if file_path.endswith('.arrow'):
+        return 'arrow'
+    raise ValueError(f'Unsupported data file: {file_path}')
+
+
+def open_text_file(file_path):
+    """
+    Open a text file and decompress .gz and .zst files on the fly.
+    """
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    if file_path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst files requires zstandard, run `pip install zstandard`.')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(file_path, encoding='utf-8')
+
+
+def iter_record_batches(file_path, columns, batch_size=1000):
+    """
+    Read the given columns of a .parquet or .arrow file batch by batch.
+    """
+    if get_file_format(file_path) == 'parquet':
+        yield from pq.ParquetFile(file_path).iter_batches(batch_size=batch_size, columns=columns)
+        return
+    with pa.memory_map(file_path) as source:
+        try:
+            reader = pa.ipc.open_stream(source)
+            batches = iter(reader)
+        except pa.ArrowInvalid:
+            source.seek(0)
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            yield pa.RecordBatch.from_arrays([batch.column(batch.schema.get_field_index(column))
+                                              for column in columns], names=columns)
+
+
+def load_data_file_group(file_format, data_files, columns, cache_dir=None):
+    if file_format == 'arrow':
+        # memory-mapped as they are, nothing is parsed
+        return concatenate_datasets([Dataset.from_file(file_path) for file_path in data_files])
+    if file_format == 'parquet':
+        # only the needed columns are read, row group by row group
+        schemas = [set(pq.read_schema(file_path).names) for file_path in data_files]
+        columns = [column for column in columns if all(column in names for names in schemas)]
+        return load_dataset('parquet', data_files={'train': data_files}, columns=columns,
+                            cache_dir=cache_dir)['train']
+    kwargs = {'keep_linebreaks': True} if file_format == 'text' else {}
+    # the json builder parses in blocks and decompresses .gz and .zst files into the cache first
+    return load_dataset(file_format, data_files={'train': data_files}, cache_dir=cache_dir, **kwargs)['train']
+
+
+def load_data_files(data_files, columns, cache_dir=None):
+    """
+    Load data files of any supported format into one dataset in the order of data_files, only the given columns
+    which exist are kept.
+    """
+    datasets_list = []
+    for file_format, group in groupby(data_files, key=get_file_format):
+        dataset = load_data_file_group(file_format, list(group), columns, cache_dir)
+        unused_columns = [column for column in dataset.column_names if column not in columns]
+        if unused_columns:
+            dataset = dataset.remove_columns(unused_columns)
+        datasets_list.append(dataset)
+    if len(datasets_list) == 1:
+        return datasets_list[0]
+    # files of different formats may miss optional columns or type them differently
+    features = {}
+    for dataset in datasets_list:
+        for column, feature in dataset.features.items():
+            features.setdefault(column, feature)
+    features = Features(features)
+    aligned_datasets = []
+    for dataset in datasets_list:
+        for column in features:
+            if column not in dataset.column_names:
+                dataset = dataset.add_column(column, [None] * len(dataset))
+        aligned_datasets.append(dataset.cast(features))
+    return concatenate_datasets(aligned_datasets)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/16 20:40
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : dataset_stats.py
+# @Software: PyCharm
+import numpy as np
+
+
+def summarize_lengths(lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if not len(lengths):
+        return {'num_samples': 0, 'num_tokens': 0}
+    p50, p90, p99 = np.percentile(lengths, [50, 90, 99])
+    return {
+        'num_samples': int(len(lengths)),
+        'num_tokens': int(lengths.sum()),
+        'mean': round(float(lengths.mean()), 2),
+        'min': int(lengths.min()),
+        'p50': int(p50),
+        'p90': int(p90),
+        'p99': int(p99),
+        'max': int(lengths.max())
+    }
+
+
+def length_histogram(lengths, num_bins=16):
+    counts, edges = np.histogram(np.asarray(lengths, dtype=np.int64), bins=num_bins)
+    return [{'from': int(np.ceil(low)), 'to': int(np.floor(high)), 'count': int(count)}
+            for low, high, count in zip(edges[:-1], edges[1:], counts)]
+
+
+def padding_fraction(lengths, batch_size, sort=False, seed=0):
+    """
+    Fraction of padding tokens when the samples are cut into batches of batch_size in random order,
+    or sorted by length like group_by_length does.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if not len(lengths):
+        return 0.0
+    lengths = np.sort(lengths) if sort else lengths[np.random.default_rng(seed).permutation(len(lengths))]
+    num_batches = -(-len(lengths) // batch_size)
+    batches = np.zeros(num_batches * batch_size, dtype=np.int64)
+    batches[:len(lengths)] = lengths
+    batches = batches.reshape(num_batches, batch_size)
+    padded_tokens = int((batches.max(axis=1) * np.count_nonzero(batches, axis=1)).sum())
+    return 1 - int(lengths.sum()) / max(1, padded_tokens)
+
+
+def packed_block_lengths(lengths, block_size, chunk_size=1000):
+    """
+    Lengths of the blocks made by first-fit decreasing, the samples are packed chunk by chunk like the batched map
+    of the packing preprocessor does.
+    """
+    block_lengths = []
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), block_size)
+    for start in range(0, len(lengths), chunk_size):
+        bins = []
+        for length in np.sort(lengths[start: start + chunk_size])[::-1].tolist():
+            for i, used in enumerate(bins):
+                if used + length <= block_size:
+                    bins[i] += length
+                    break
+            else:
+                bins.append(length)
+        block_lengths.extend(bins)
+    return np.asarray(block_lengths, dtype=np.int64)
+
+
+def steps_per_epoch(num_batches, gradient_accumulation_steps):
+    return max(1, num_batches // gradient_accumulation_steps) if num_batches else 0
+
+
+def format_stats_table(header, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    lines = [' | '.join(str(value).ljust(width) for value, width in zip(header, widths))]
+    lines.append('-+-'.join('-' * width for width in widths))
+    lines.extend(' | '.join(str(value).ljust(width) for value, width in zip(row, widths)) for row in rows)
+    return '\n'.join(lines)
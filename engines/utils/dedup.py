@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/14 21:20
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : dedup.py
+# @Software: PyCharm
+from engines.utils.tokenize_cache import TokenizedFileCache
+import numpy as np
+import unicodedata
+import hashlib
+import zlib
+import json
+import time
+import re
+import os
+
+# bump it when the signatures change
+DEDUP_VERSION = 1
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+MERSENNE_PRIME = (1 << 61) - 1
+TEXT_COLUMNS = ('text', 'instruction', 'input', 'output', 'history')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_text(text):
+    # full-width to half-width, lower case, drop whitespaces and punctuations
+    return _NON_WORD.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+def example_to_text(examples, i):
+    texts = []
+    for column in TEXT_COLUMNS:
+        if column in examples and (value := examples[column][i]) is not None:
+            texts.append(value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+    return '\n'.join(texts)
+
+
+def optimal_bands(threshold, num_perm=NUM_PERM):
+    # the probability of becoming candidates is 1 - (1 - s ** rows) ** bands, its steepest point is about
+    # (1 / bands) ** (1 / rows), choose the split whose steepest point is closest to the threshold
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+
+class MinHasher:
+    """
+    MinHash over character shingles, which works for both Chinese and space separated languages.
+    """
+    def __init__(self, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1, chunk_size=8192):
+        rng = np.random.default_rng(seed)
+        # a * hash + b stays under 2 ** 64 since hash < 2 ** 32 and a, b < 2 ** 29
+        self.a = rng.integers(1, 1 << 29, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 29, num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.chunk_size = chunk_size
+
+    def shingle_hashes(self, text):
+        size = self.shingle_size
+        shingles = {text[i: i + size] for i in range(max(1, len(text) - size + 1))}
+        return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64,
+                           count=len(shingles))
+
+    def signature(self, text):
+        hashes = self.shingle_hashes(text)
+        signature = np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        for start in range(0, len(hashes), self.chunk_size):
+            chunk = hashes[start: start + self.chunk_size, None]
+            signature = np.minimum(signature, ((chunk * self.a + self.b) % MERSENNE_PRIME).min(axis=0))
+        return (signature & 0xffffffff).astype(np.uint32)
+
+    def __call__(self, examples):
+        num_rows = len(examples[next(iter(examples))])
+        exact_hashes, minhashes = [], []
+        for i in range(num_rows):
+            text = normalize_text(example_to_text(examples, i))
+            digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+            exact_hashes.append(int.from_bytes(digest, 'little', signed=True))
+            minhashes.append(self.signature(text))
+        return {'exact_hash': exact_hashes, 'minhash': minhashes}
+
+
+def find_duplicates(exact_hashes, minhashes, threshold):
+    """
+    Returns the mask of the rows to keep, the first one of every group of duplicates is kept.
+    Rows are exactly duplicated when their normalized texts are the same, and nearly duplicated when their
+    estimated Jaccard similarity reaches threshold.
+    """
+    keep = np.ones(len(exact_hashes), dtype=bool)
+    seen = set()
+    for i, exact_hash in enumerate(exact_hashes.tolist()):
+        if exact_hash in seen:
+            keep[i] = False
+        else:
+            seen.add(exact_hash)
+    if threshold is None or threshold >= 1.0 or not len(minhashes):
+        return keep
+
+    bands, rows = optimal_bands(threshold, minhashes.shape[1])
+    min_equal = threshold * minhashes.shape[1]
+    buckets = [{} for _ in range(bands)]
+    for i in np.flatnonzero(keep).tolist():
+        minhash = minhashes[i]
+        keys = [minhash[band * rows: (band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = set()
+        for bucket, key in zip(buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        if any(np.count_nonzero(minhashes[j] == minhash) >= min_equal for j in candidates):
+            keep[i] = False
+            continue
+        for bucket, key in zip(buckets, keys):
+            bucket.setdefault(key, []).append(i)
+    return keep
+
+
+class SignatureCache(TokenizedFileCache):
+    """
+    Signatures saved per source file as .npz, only new or changed files need to be hashed again.
+    """
+    def load(self, key):
+        if key not in self.manifest['entries']:
+            return None
+        path = os.path.join(self.cache_dir, key + '.npz')
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as signatures:
+            return signatures['exact_hash'], signatures['minhash']
+
+    def save(self, key, file_path, signatures):
+        exact_hashes, minhashes = signatures
+        tmp_path = os.path.join(self.cache_dir, key + '.tmp.npz')
+        np.savez(tmp_path, exact_hash=exact_hashes, minhash=minhashes)
+        os.replace(tmp_path, os.path.join(self.cache_dir, key + '.npz'))
+        self.manifest['entries'][key] = {
+            'source': os.path.abspath(file_path),
+            'num_rows': len(exact_hashes),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+
+class Deduplicator:
+    """
+    Exact and MinHash-LSH near-duplicate removal across a list of data files, the signatures are computed with
+    datasets.map over num_proc processes and kept on disk when cache_dir is given.
+    """
+    def __init__(self, threshold, logger, cache_dir=None, num_proc=None):
+        self.threshold = threshold
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.num_proc = num_proc
+        self.minhasher = MinHasher()
+        self.settings = {'dedup_version': DEDUP_VERSION, 'num_perm': NUM_PERM, 'shingle_size': SHINGLE_SIZE}
+
+    def compute_signatures(self, dataset, desc):
+        signatures = dataset.map(
+            self.minhasher,
+            batched=True,
+            num_proc=self.num_proc,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=False,
+            desc=desc
+        ).with_format('numpy')
+        if not len(signatures):
+            return np.empty(0, dtype=np.int64), np.empty((0, NUM_PERM), dtype=np.uint32)
+        return signatures['exact_hash'].astype(np.int64), np.stack(signatures['minhash']).astype(np.uint32)
+
+    def get_keep_masks(self, data_files, load_func, is_main_process=True):
+        """
+        Returns one keep mask per file, load_func loads a list of files into a datasets.Dataset.
+        """
+        if not data_files:
+            return []
+        cache = SignatureCache(self.cache_dir, self.logger) if self.cache_dir is not None else None
+        exact_hashes, minhashes = [], []
+        num_hits = 0
+        for file_path in data_files:
+            key = cache.get_key(file_path, self.settings) if cache is not None else None
+            if cache is not None and (signatures := cache.load(key)) is not None:
+                num_hits += 1
+            else:
+                signatures = self.compute_signatures(load_func([file_path]),
+                                                     desc=f'Hashing {os.path.basename(file_path)}')
+                if cache is not None:
+                    cache.save(key, file_path, signatures)
+            exact_hashes.append(signatures[0])
+            minhashes.append(signatures[1])
+        if cache is not None:
+            if is_main_process:
+                cache.write_manifest()
+            self.logger.info(f'Dedup signatures: {num_hits} files reused, {len(data_files) - num_hits} files hashed.')
+
+        all_exact_hashes = np.concatenate(exact_hashes)
+        keep = find_duplicates(all_exact_hashes, np.concatenate(minhashes), self.threshold)
+        num_removed = len(keep) - int(keep.sum())
+        num_exact = len(keep) - len(np.unique(all_exact_hashes))
+        self.logger.info(f'Dedup: {num_removed} of {len(keep)} rows removed, '
+                         f'{num_exact} exact and {num_removed - num_exact} near duplicates.')
+        return np.split(keep, np.cumsum([len(hashes) for hashes in exact_hashes])[:-1])
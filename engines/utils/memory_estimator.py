@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/28 20:45
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : memory_estimator.py
+# @Software: PyCharm
+from transformers import AutoConfig, AutoModel, AutoModelForCausalLM
+from accelerate import init_empty_weights
+import torch
+import json
+import math
+
+GIB = 2 ** 30
+# cuda context, allocator fragmentation and communication buffers
+DEVICE_OVERHEAD_GB = 1.5
+OUTPUT_LAYER_NAMES = ('lm_head', 'embed_out', 'output_layer')
+# the deepspeed settings tried when the current one does not fit, from the fastest to the slowest
+ZERO_CANDIDATES = (
+    {'stage': 2, 'offload_optimizer': False, 'offload_param': False},
+    {'stage': 2, 'offload_optimizer': True, 'offload_param': False},
+    {'stage': 3, 'offload_optimizer': False, 'offload_param': False},
+    {'stage': 3, 'offload_optimizer': True, 'offload_param': False},
+    {'stage': 3, 'offload_optimizer': True, 'offload_param': True}
+)
+
+
+def build_empty_model(model_path, model_type):
+    """
+    Build the model on the meta device from its config, no weights are read or allocated.
+    """
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    model_class = AutoModel if model_type == 'chatglm' else AutoModelForCausalLM
+    with init_empty_weights():
+        return model_class.from_config(config, trust_remote_code=True)
+
+
+def get_model_dims(config):
+    # the names of the sizes differ from model to model
+    def first(*names, default=None):
+        return next((value for name in names if (value := getattr(config, name, None)) is not None), default)
+
+    hidden_size = first('hidden_size', 'n_embd', 'd_model')
+    return {
+        'num_layers': first('num_hidden_layers', 'num_layers', 'n_layer'),
+        'hidden_size': hidden_size,
+        'num_heads': first('num_attention_heads', 'n_head'),
+        'intermediate_size': first('intermediate_size', 'ffn_hidden_size', 'n_inner', default=4 * hidden_size),
+        'vocab_size': first('padded_vocab_size', 'vocab_size')
+    }
+
+
+def count_parameters(model, lora_targets=None, lora_rank=8, all_linear=False):
+    """
+    Returns the number of all parameters, of the parameters in the linear layers which can be quantized and of the
+    LoRA parameters for the target modules.
+    """
+    num_parameters, num_linear, num_lora = 0, 0, 0
+    for param in model.parameters():
+        num_parameters += param.numel()
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear) or name.split('.')[-1] in OUTPUT_LAYER_NAMES:
+            continue
+        num_linear += module.weight.numel()
+        if all_linear or (lora_targets and any(name.endswith(target) for target in lora_targets)):
+            num_lora += lora_rank * (module.in_features + module.out_features)
+    return {'parameters': num_parameters, 'linear': num_linear, 'lora': num_lora}
+
+
+def load_deepspeed_settings(deepspeed):
+    if deepspeed is None:
+        return None
+    if isinstance(deepspeed, str):
+        with open(deepspeed, encoding='utf-8') as f:
+            deepspeed = json.load(f)
+    zero = deepspeed.get('zero_optimization', {})
+    return {
+        'stage': int(zero.get('stage', 0)),
+        'offload_optimizer': zero.get('offload_optimizer', {}).get('device', 'none') in ('cpu', 'nvme'),
+        'offload_param': zero.get('offload_param', {}).get('device', 'none') in ('cpu', 'nvme')
+    }
+
+
+def estimate_static_memory(settings, zero=None):
+    """
+    Bytes of the weights, gradients, optimizer states and the reference model on one device. Without deepspeed the
+    trainable parameters keep their dtype and adamw keeps two states of the same dtype, a half precision model is
+    upcast to fp32 for full fine-tuning with fp16 or bf16. Under ZeRO the trainable
+    parameters have half precision weights and gradients and an fp32 master copy with two fp32 states, the stage
+    partitions them across the devices and offloading moves them to the host.
+    """
+    counts, dtype_bytes = settings['counts'], settings['dtype_bytes']
+    num_devices = settings['num_devices']
+    num_trainable = settings['num_trainable']
+    if settings['quantization_bit'] is not None:
+        base_bytes = counts['linear'] * settings['quantization_bit'] / 8 + \
+            (counts['parameters'] - counts['linear']) * dtype_bytes
+    else:
+        base_bytes = counts['parameters'] * dtype_bytes
+    # the base model is trained itself in full fine-tuning, otherwise it is frozen
+    frozen_bytes = 0 if settings['full'] else base_bytes
+    # peft keeps the adapters in fp32, and construct_base_model upcasts the fully trained model for amp
+    trainable_bytes = dtype_bytes if settings['full'] and not settings['amp'] else 4
+    if zero is None:
+        weights = frozen_bytes + num_trainable * trainable_bytes
+        gradients = num_trainable * trainable_bytes
+        optimizer = 2 * num_trainable * trainable_bytes
+    else:
+        stage = zero['stage']
+        weights = frozen_bytes + num_trainable * 2
+        gradients = num_trainable * 2
+        optimizer = num_trainable * 12
+        if stage >= 1:
+            optimizer /= num_devices
+        if stage >= 2:
+            gradients /= num_devices
+        if stage >= 3:
+            weights /= num_devices
+        if zero['offload_optimizer']:
+            optimizer = 0
+        if stage >= 3 and zero['offload_param']:
+            weights = 0
+    reference = 0
+    if settings['reference_copy']:
+        reference = base_bytes
+        if zero is not None and zero['stage'] >= 3:
+            reference /= num_devices
+    return {'weights': weights, 'gradients': gradients, 'optimizer': optimizer, 'reference': reference}
+
+
+def estimate_activation_memory(dims, settings):
+    """
+    Bytes of the activations of one sample. A layer keeps about 10 * hidden + 4 * intermediate values of every
+    token for the backward, and the attention probabilities unless flash attention is used. With gradient
+    checkpointing only the input of every layer is kept and one layer is recomputed at a time. The logits are
+    upcast to fp32 and get an fp32 gradient, the chunked loss only holds the logits of one chunk of the batch which
+    are counted by estimate_batch_memory.
+    """
+    act_bytes = settings['activation_bytes']
+    num_tokens = settings['sequence_length'] * settings['sequences_per_sample']
+    hidden_size, num_layers = dims['hidden_size'], dims['num_layers']
+    layer_bytes = (10 * hidden_size + 4 * dims['intermediate_size']) * act_bytes
+    if not settings['flash_attn']:
+        layer_bytes += 2 * dims['num_heads'] * settings['sequence_length'] * act_bytes
+    if settings['gradient_checkpointing']:
+        layers = num_tokens * (num_layers * hidden_size * act_bytes + layer_bytes)
+    else:
+        layers = num_tokens * num_layers * layer_bytes
+    logits = 0
+    if settings['logits'] and not settings['chunked_ce_loss']:
+        logits = num_tokens * dims['vocab_size'] * (act_bytes + 8)
+    return {'layers': layers, 'logits': logits}
+
+
+def estimate_batch_memory(dims, settings):
+    """
+    Bytes of the activations held once per batch whatever its size, the logits of a chunk of the chunked loss.
+    """
+    if not settings['logits'] or not settings['chunked_ce_loss']:
+        return 0
+    return settings['ce_chunk_size'] * dims['vocab_size'] * (settings['activation_bytes'] + 8)
+
+
+def max_batch_size(static, activations, device_bytes, batch_bytes=0):
+    available = device_bytes - DEVICE_OVERHEAD_GB * GIB - sum(static.values()) - batch_bytes
+    per_sample = sum(activations.values())
+    return max(0, math.floor(available / per_sample)) if per_sample else 0
+
+
+def describe_zero(zero):
+    if zero is None:
+        return 'no deepspeed'
+    offload = [name for name in ('optimizer', 'param') if zero[f'offload_{name}']]
+    return f"zero{zero['stage']}" + (f" offload {'+'.join(offload)}" if offload else '')
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/4 21:40
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : packing.py
+# @Software: PyCharm
+from itertools import chain
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def pack_supervised_samples(input_ids_list, labels_list, block_size, label_pad_token_id):
+    """
+    Pack tokenized samples into blocks of at most block_size tokens with first-fit decreasing.
+    Every sample gets its own segment id (1, 2, ...) in attention_mask and its position ids restart from 0.
+    """
+    order = sorted(range(len(input_ids_list)), key=lambda idx: len(input_ids_list[idx]), reverse=True)
+    bins = []
+    for idx in order:
+        length = len(input_ids_list[idx])
+        for packed_bin in bins:
+            if packed_bin[0] >= length:
+                packed_bin[0] -= length
+                packed_bin[1].append(idx)
+                break
+        else:
+            bins.append([block_size - length, [idx]])
+
+    packed_input_ids, packed_labels, packed_position_ids, packed_attention_mask = [], [], [], []
+    for _, indices in bins:
+        input_ids, labels, position_ids, attention_mask = [], [], [], []
+        for segment_id, idx in enumerate(indices, start=1):
+            length = len(input_ids_list[idx])
+            input_ids.extend(input_ids_list[idx])
+            # the first token of a sample never be predicted from the previous sample
+            labels.extend([label_pad_token_id] + list(labels_list[idx][1:]))
+            position_ids.extend(range(length))
+            attention_mask.extend([segment_id] * length)
+        packed_input_ids.append(input_ids)
+        packed_labels.append(labels)
+        packed_position_ids.append(position_ids)
+        packed_attention_mask.append(attention_mask)
+    return {'input_ids': packed_input_ids, 'attention_mask': packed_attention_mask,
+            'labels': packed_labels, 'position_ids': packed_position_ids}
+
+
+def get_packed_unpad_data(attention_mask):
+    """
+    Replacement of `_get_unpad_data` in transformers' flash attention implementations, segment ids in the
+    attention mask are turned into cu_seqlens so that packed samples are computed as independent sequences.
+    """
+    max_segment = int(attention_mask.max().item())
+    seqlens_in_batch = torch.stack(
+        [(attention_mask == segment_id).sum(dim=-1) for segment_id in range(1, max_segment + 1)], dim=-1).flatten()
+    seqlens_in_batch = seqlens_in_batch[seqlens_in_batch > 0].to(torch.int32)
+    indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, max_seqlen_in_batch
+
+
+def build_block_diagonal_causal_mask(attention_mask, dtype):
+    """
+    Turn [batch, seq] segment ids into a [batch, 1, seq, seq] additive mask, a token only attends to the earlier
+    tokens of the same segment.
+    """
+    seq_length = attention_mask.size(-1)
+    same_segment = attention_mask[:, :, None] == attention_mask[:, None, :]
+    causal = torch.ones((seq_length, seq_length), dtype=torch.bool, device=attention_mask.device).tril()
+    allowed = same_segment & causal[None, :, :] & (attention_mask[:, None, :] != 0)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=attention_mask.device)
+    mask = mask.masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+def build_shared_prompt_causal_mask(attention_mask, dtype):
+    """
+    Turn [batch, seq] rows of a prompt (segment 1) followed by its responses (segments -2, -3, ...) into a
+    [batch, 1, seq, seq] additive mask, a response attends to the prompt and to the earlier tokens of itself.
+    """
+    seq_length = attention_mask.size(-1)
+    key_segments = attention_mask[:, None, :]
+    causal = torch.ones((seq_length, seq_length), dtype=torch.bool, device=attention_mask.device).tril()
+    allowed = ((attention_mask[:, :, None] == key_segments) | (key_segments == 1)) & causal[None, :, :] & \
+        (key_segments != 0)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=attention_mask.device)
+    mask = mask.masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+def apply_packed_attention_patch(model_type, logger):
+    """
+    Let the decoder understand segment ids in attention_mask, returns False when the model is not supported and
+    packed samples are only separated by position ids. Negative segment ids mark responses sharing a prompt.
+    """
+    match model_type:
+        case 'llama':
+            from transformers.models.llama import modeling_llama as modeling
+            model_class = modeling.LlamaModel
+        case 'mistral':
+            from transformers.models.mistral import modeling_mistral as modeling
+            model_class = modeling.MistralModel
+        case _:
+            logger.warning(f'Attention isolation of packed samples is not supported for {model_type}, '
+                           'samples in a block are only separated by position ids.')
+            return False
+
+    if hasattr(modeling, '_get_unpad_data'):
+        # flash attention 2
+        modeling._get_unpad_data = get_packed_unpad_data
+
+    prepare_decoder_attention_mask = model_class._prepare_decoder_attention_mask
+    if not getattr(prepare_decoder_attention_mask, 'is_packed_patch', False):
+        def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, *args, **kwargs):
+            # Mistral's sliding window is ignored inside a packed block since it never longer than max_input_token.
+            if attention_mask is not None and attention_mask.dim() == 2 and attention_mask.min() < 0:
+                return build_shared_prompt_causal_mask(attention_mask, inputs_embeds.dtype)
+            if attention_mask is not None and attention_mask.dim() == 2 and attention_mask.max() > 1:
+                return build_block_diagonal_causal_mask(attention_mask, inputs_embeds.dtype)
+            return prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, *args, **kwargs)
+
+        _prepare_decoder_attention_mask.is_packed_patch = True
+        model_class._prepare_decoder_attention_mask = _prepare_decoder_attention_mask
+    logger.info(f'Patched {model_class.__name__} to isolate the attention of packed samples.')
+    return True
+
+
+def document_positions(starts):
+    """
+    From a [num_blocks, block_size] mask of document starts, get position ids restarting at every document and
+    segment ids counting the documents of each block from 1.
+    """
+    index = np.broadcast_to(np.arange(starts.shape[-1]), starts.shape)
+    last_start = np.maximum.accumulate(np.where(starts, index, 0), axis=-1)
+    return index - last_start, np.cumsum(starts, axis=-1)
+
+
+class PretrainPacker:
+    """
+    Concatenate tokenized documents into blocks of block_size tokens, the leftover of a batch is carried to the
+    next one so that only the tail of the whole corpus is dropped. The labels are the block itself, eos is the
+    same as pad for many tokenizers and must not be masked. With document_mask the blocks also get position ids and
+    segment ids that keep documents from seeing each other, and the first label of every document is masked.
+    """
+    def __init__(self, block_size, eos_token_id=None, document_mask=False, label_pad_token_id=-100):
+        self.block_size = block_size
+        self.eos_token_id = eos_token_id
+        self.document_mask = document_mask
+        self.label_pad_token_id = label_pad_token_id
+        self.reset()
+
+    def reset(self):
+        self.carry_input_ids = np.empty(0, dtype=np.int64)
+        self.carry_starts = np.empty(0, dtype=bool)
+
+    def pack(self, input_ids_list):
+        lengths = np.fromiter((len(input_ids) for input_ids in input_ids_list), dtype=np.int64,
+                              count=len(input_ids_list))
+        flat_input_ids = np.fromiter(chain.from_iterable(input_ids_list), dtype=np.int64, count=int(lengths.sum()))
+        if self.eos_token_id is not None:
+            # append eos to every non-empty document which does not end with it
+            ends = np.cumsum(lengths)
+            need_eos = lengths > 0
+            need_eos[need_eos] = flat_input_ids[ends[need_eos] - 1] != self.eos_token_id
+            flat_input_ids = np.insert(flat_input_ids, ends[need_eos], self.eos_token_id)
+            lengths = lengths + need_eos
+        starts = np.zeros(len(flat_input_ids), dtype=bool)
+        starts[(np.cumsum(lengths) - lengths)[lengths > 0]] = True
+
+        flat_input_ids = np.concatenate([self.carry_input_ids, flat_input_ids])
+        starts = np.concatenate([self.carry_starts, starts])
+        num_blocks = len(flat_input_ids) // self.block_size
+        used = num_blocks * self.block_size
+        self.carry_input_ids, self.carry_starts = flat_input_ids[used:], starts[used:]
+
+        input_ids = flat_input_ids[:used].reshape(num_blocks, self.block_size)
+        if not self.document_mask:
+            return {'input_ids': input_ids, 'attention_mask': np.ones_like(input_ids), 'labels': input_ids.copy()}
+        starts = starts[:used].reshape(num_blocks, self.block_size)
+        # a block always starts a new segment even in the middle of a document
+        starts[:, 0] = True
+        position_ids, segment_ids = document_positions(starts)
+        labels = np.where(starts, self.label_pad_token_id, input_ids)
+        return {'input_ids': input_ids, 'attention_mask': segment_ids, 'labels': labels, 'position_ids': position_ids}
+
+    def __call__(self, examples, indices):
+        # datasets.map runs the batches in order in one process, start over when it starts over
+        if len(indices) and indices[0] == 0:
+            self.reset()
+        return {key: list(value) for key, value in self.pack(examples['input_ids']).items()}
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/27 21:10
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : profiler.py
+# @Software: PyCharm
+from transformers import TrainerCallback
+from torch.profiler import profile, schedule, ProfilerActivity
+from loguru import logger
+import torch
+import os
+
+PROFILE_DIR_NAME = 'profile'
+
+
+class StepProfiler:
+    """
+    torch.profiler over a window of steps given by the profile_* training arguments. Every finished window is
+    exported to output_dir/profile as a chrome trace and a table of the top operators, the profiler stops itself
+    once all the windows are done.
+    """
+    def __init__(self, args, output_dir, name, rank=0):
+        self.output_dir = os.path.join(output_dir, PROFILE_DIR_NAME)
+        self.name = f'{name}-rank{rank}'
+        self.total_steps = args.profile_wait + (args.profile_warmup + args.profile_active) * args.profile_repeat
+        self.row_limit = args.profile_row_limit
+        self.record_shapes = args.profile_record_shapes
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+        self.profiler = profile(
+            activities=activities,
+            schedule=schedule(wait=args.profile_wait, warmup=args.profile_warmup, active=args.profile_active,
+                              repeat=args.profile_repeat),
+            on_trace_ready=self.export,
+            record_shapes=args.profile_record_shapes,
+            profile_memory=args.profile_memory,
+            with_stack=args.profile_with_stack
+        )
+        self.num_steps = 0
+        self.running = False
+
+    @property
+    def finished(self):
+        return self.num_steps >= self.total_steps
+
+    def export(self, profiler):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f'{self.name}-step{profiler.step_num}')
+        profiler.export_chrome_trace(prefix + '.trace.json')
+        table = profiler.key_averages(group_by_input_shape=self.record_shapes).table(
+            sort_by=self.sort_by, row_limit=self.row_limit)
+        with open(prefix + '.top_ops.txt', 'w', encoding='utf-8') as f:
+            f.write(table)
+        logger.info(f'Profiler trace and top operators saved to {prefix}.*')
+
+    def start(self):
+        if not self.running and not self.finished:
+            self.profiler.start()
+            self.running = True
+
+    def step(self):
+        if not self.running:
+            return
+        self.num_steps += 1
+        self.profiler.step()
+        if self.finished:
+            self.stop()
+
+    def stop(self):
+        if self.running:
+            self.profiler.stop()
+            self.running = False
+
+
+class ProfilerCallback(TrainerCallback):
+    """
+    Profile a window of optimizer steps, the gradient accumulation of a step is profiled as a whole.
+    """
+    def __init__(self, args, name):
+        self.profiler = StepProfiler(args, args.output_dir, name, rank=args.process_index)
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.profiler.start()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.profiler.step()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.profiler.stop()
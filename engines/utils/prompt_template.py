@@ -257,26 +257,134 @@ class Template:
         format_result = self._format_example(query, history)
         return ''.join(format_result) if join_history else format_result
 
-    def _format_example(self, query, history):
+    def get_segments(self, turn_idx):
+        r"""
+        Returns the constant strings before and after the query of a turn.
+        """
         # add separator for non-empty prefix
         prefix = self.prefix + self.sep if self.prefix else ''
+        head, tail = self.prompt.format(query='\0').split('\0')
+        if self.prompt_template == 'chatglm':
+            current_prefix = prefix.format(turn_idx + 1)
+            if turn_idx + 1 > 1:
+                current_prefix = '\n\n' + current_prefix
+            return current_prefix + head, tail
+        return (prefix if turn_idx == 0 else self.sep) + head, tail
+
+    def _format_example(self, query, history):
         history = history if (history and self.use_history) else []
         history = history + [(query, '<dummy>')]
         conversations = []
         for turn_idx, (user_query, bot_resp) in enumerate(history):
-            if self.prompt_template == 'chatglm':
-                prompt = self.prompt.format(query=user_query)
-                current_prefix = prefix.format(turn_idx + 1)
-                if turn_idx + 1 > 1:
-                    current_prefix = '\n\n' + current_prefix
-                conversations.append(current_prefix + prompt)
-                conversations.append(bot_resp)
-            else:
-                if turn_idx == 0:
-                    conversations.append(prefix + self.prompt.format(query=user_query))
-                    conversations.append(bot_resp)
-                else:
-                    conversations.append(self.sep + self.prompt.format(query=user_query))
-                    conversations.append(bot_resp)
+            head, tail = self.get_segments(turn_idx)
+            conversations.append(head + user_query + tail)
+            conversations.append(bot_resp)
         # drop last
         return conversations[:-1]
+
+
+class CompiledTemplate:
+    """
+    A template whose constant segments are tokenized once, the prompt ids are assembled from the cached segments
+    and the tokenized queries and responses. Tokenizing the pieces apart is not always the same as tokenizing the
+    whole prompt, so it is checked on probe conversations first and falls back to the string prompts if not. The
+    probes can not cover every text, a row whose pieces meet at anything but a line break or a special token is
+    tokenized as a string too.
+    """
+    probe_conversations = [
+        ('你好，请介绍一下你自己。', [('今天天气怎么样？', '今天是晴天，气温25度。')]),
+        ('What is 1 + 1?', [('Hello!', 'Hi, how can I help you?')]),
+    ]
+
+    def __init__(self, template, tokenizer, logger=None):
+        self.template = template
+        self.tokenizer = tokenizer
+        self.segments = {}
+        self.special_tokens = tuple(token for token in set(tokenizer.all_special_tokens) |
+                                    set(tokenizer.get_added_vocab()) if token)
+        self.exact = self.check_exact()
+        if logger is not None and not self.exact:
+            logger.warning(f'The segments of template {template.prompt_template} are not tokenized the same as the '
+                           'whole prompt, prompts are tokenized as full strings.')
+
+    def encode_texts(self, texts):
+        if not texts:
+            return []
+        return self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+    def get_segment_ids(self, turn_idx):
+        # only chatglm numbers its rounds, the other templates share the segments from the second turn on
+        key = turn_idx if self.template.prompt_template == 'chatglm' else min(turn_idx, 1)
+        if key not in self.segments:
+            head_ids, tail_ids = self.encode_texts(list(self.template.get_segments(key)))
+            self.segments[key] = (head_ids, tail_ids)
+        return self.segments[key]
+
+    def assemble(self, samples, join_history):
+        texts = []
+        for query, history in samples:
+            for user_query, bot_resp in (history if (history and self.template.use_history) else []):
+                texts.extend([user_query, bot_resp])
+            texts.append(query)
+        ids_list = iter(self.encode_texts(texts))
+        results = []
+        for query, history in samples:
+            turns = (history if (history and self.template.use_history) else []) + [(query, None)]
+            sentences = []
+            for turn_idx, (_, bot_resp) in enumerate(turns):
+                head_ids, tail_ids = self.get_segment_ids(turn_idx)
+                sentences.append(head_ids + next(ids_list) + tail_ids)
+                if bot_resp is not None:
+                    sentences.append(next(ids_list))
+            results.append([token_id for ids in sentences for token_id in ids] if join_history else sentences)
+        return results
+
+    def check_exact(self):
+        expected_joined = self.encode_texts(
+            [self.template.get_prompt(query, history) for query, history in self.probe_conversations])
+        expected_sentences = [self.encode_texts(self.template.get_prompt(query, history, False))
+                              for query, history in self.probe_conversations]
+        return self.assemble(self.probe_conversations, True) == expected_joined and \
+            self.assemble(self.probe_conversations, False) == expected_sentences
+
+    def is_boundary(self, left, right):
+        if left.endswith(self.special_tokens) or right.startswith(self.special_tokens):
+            return True
+        # a line break is not merged with the non-whitespace character next to it
+        return (left[-1] in '\r\n' and not right[0].isspace()) or (right[0] in '\r\n' and not left[-1].isspace())
+
+    def is_exact_row(self, query, history, join_history):
+        turns = (history if (history and self.template.use_history) else []) + [(query, None)]
+        sentences = []
+        for turn_idx, (user_query, bot_resp) in enumerate(turns):
+            head, tail = self.template.get_segments(turn_idx)
+            sentences.append([head, user_query, tail])
+            if bot_resp is not None:
+                sentences.append([bot_resp])
+        if join_history:
+            sentences = [[piece for sentence in sentences for piece in sentence]]
+        for pieces in sentences:
+            pieces = [piece for piece in pieces if piece]
+            if not all(self.is_boundary(left, right) for left, right in zip(pieces, pieces[1:])):
+                return False
+        return True
+
+    def encode_strings(self, samples, join_history):
+        if join_history:
+            return self.encode_texts([self.template.get_prompt(query, history) for query, history in samples])
+        prompts = [self.template.get_prompt(query, history, False) for query, history in samples]
+        ids_list = iter(self.encode_texts([sentence for prompt in prompts for sentence in prompt]))
+        return [[next(ids_list) for _ in prompt] for prompt in prompts]
+
+    def encode_prompts(self, samples, join_history=True):
+        r"""
+        Tokenize a batch of (query, history) into prompt ids without special tokens, a list of ids per sentence is
+        returned for every sample when join_history is False.
+        """
+        if not self.exact:
+            return self.encode_strings(samples, join_history)
+        exact_rows = [self.is_exact_row(query, history, join_history) for query, history in samples]
+        assembled = iter(self.assemble([sample for sample, exact in zip(samples, exact_rows) if exact], join_history))
+        strings = iter(self.encode_strings(
+            [sample for sample, exact in zip(samples, exact_rows) if not exact], join_history))
+        return [next(assembled) if exact else next(strings) for exact in exact_rows]
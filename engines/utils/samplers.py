@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/6 22:10
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : samplers.py
+# @Software: PyCharm
+from torch.utils.data import DataLoader, IterableDataset
+import numpy as np
+import itertools
+import heapq
+
+
+def compute_sample_lengths(dataset, tokenizer=None, num_proc=None):
+    """
+    Number of padded tokens one sample costs in a batch, a pair of responses counts twice because the collators
+    stack them into the same padded batch, a prompt shared by a group of responses counts once.
+    """
+    column_names = dataset.column_names
+    if 'input_ids' in column_names:
+        def count_tokens(examples):
+            return {'length': [len(input_ids) for input_ids in examples['input_ids']]}
+    elif 'accept_ids' in column_names:
+        def count_tokens(examples):
+            return {'length': [2 * max(len(accept_ids), len(reject_ids))
+                               for accept_ids, reject_ids in zip(examples['accept_ids'], examples['reject_ids'])]}
+    elif 'chosen_input_ids' in column_names:
+        def count_tokens(examples):
+            return {'length': [2 * max(len(chosen_ids), len(rejected_ids)) for chosen_ids, rejected_ids
+                               in zip(examples['chosen_input_ids'], examples['rejected_input_ids'])]}
+    elif 'response_ids' in column_names:
+        def count_tokens(examples):
+            return {'length': [len(prompt_ids) + sum(len(response_ids) for response_ids in responses)
+                               for prompt_ids, responses in zip(examples['prompt_ids'], examples['response_ids'])]}
+    elif 'chosen' in column_names:
+        def count_tokens(examples):
+            prompt_ids = tokenizer(examples['prompt'], add_special_tokens=False)['input_ids']
+            chosen_ids = tokenizer(examples['chosen'], add_special_tokens=False)['input_ids']
+            rejected_ids = tokenizer(examples['rejected'], add_special_tokens=False)['input_ids']
+            return {'length': [2 * (len(prompt) + max(len(chosen), len(rejected)) + 2)
+                               for prompt, chosen, rejected in zip(prompt_ids, chosen_ids, rejected_ids)]}
+    else:
+        raise ValueError(f'Can not count the tokens of dataset with columns: {column_names}')
+    lengths = dataset.map(
+        count_tokens,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=column_names,
+        desc='Counting tokens of dataset'
+    )['length']
+    return np.asarray(lengths, dtype=np.int64)
+
+
+class TokenBudgetBatchSampler:
+    """
+    Group samples of similar length into batches whose padded size stays under max_tokens_per_batch.
+    Samples are shuffled, split into buckets, sorted by length inside each bucket and then cut into batches,
+    finally the batches are shuffled again so that the lengths of consecutive steps are mixed.
+    """
+    # the bucket holds about this many batches, larger buckets mean less padding but less randomness
+    batches_per_bucket = 100
+
+    def __init__(self, lengths, max_tokens_per_batch, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_batch = 0
+        self._batches_cache = (None, None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch):
+        # the next epoch starts from this batch, used once
+        self.start_batch = start_batch
+
+    def _build_global_batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        num_samples = len(self.lengths)
+        indices = rng.permutation(num_samples) if self.shuffle else np.arange(num_samples)
+        mean_length = max(1.0, float(self.lengths.mean())) if num_samples else 1.0
+        bucket_size = max(1, int(self.max_tokens_per_batch / mean_length)) * self.batches_per_bucket
+        batches = []
+        for start in range(0, num_samples, bucket_size):
+            bucket = indices[start: start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batch, batch_max_length = [], 0
+            for idx, length in zip(bucket.tolist(), self.lengths[bucket].tolist()):
+                if batch and max(batch_max_length, length) * (len(batch) + 1) > self.max_tokens_per_batch:
+                    batches.append(batch)
+                    batch, batch_max_length = [], 0
+                batch.append(idx)
+                batch_max_length = max(batch_max_length, length)
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def get_batches(self, epoch):
+        if self._batches_cache[0] == epoch:
+            return self._batches_cache[1]
+        batches = self._build_global_batches(epoch)
+        if self.num_replicas > 1:
+            # every rank must run the same number of steps
+            if remainder := len(batches) % self.num_replicas:
+                if self.drop_last:
+                    batches = batches[:-remainder]
+                else:
+                    batches = batches + batches[:self.num_replicas - remainder]
+            batches = batches[self.rank::self.num_replicas]
+        self._batches_cache = (epoch, batches)
+        return batches
+
+    def padding_ratio(self, epoch=0):
+        batches = self.get_batches(epoch)
+        real_tokens = sum(int(self.lengths[batch].sum()) for batch in batches)
+        padded_tokens = sum(int(self.lengths[batch].max()) * len(batch) for batch in batches)
+        return 1 - real_tokens / max(1, padded_tokens)
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)
+        start_batch, self.start_batch = self.start_batch, 0
+        self.epoch += 1
+        yield from batches[start_batch:]
+
+    def __len__(self):
+        return len(self.get_batches(self.epoch))
+
+
+def partition_greedy(lengths, num_parts):
+    """
+    Split the samples into num_parts parts of the same size, the longest sample goes first and each sample goes to
+    the lightest part which still has room. Returns the positions of the samples in every part.
+    """
+    part_size = len(lengths) // num_parts
+    parts = [[] for _ in range(num_parts)]
+    loads = [0] * num_parts
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        part = min((p for p in range(num_parts) if len(parts[p]) < part_size), key=lambda p: loads[p])
+        parts[part].append(i)
+        loads[part] += int(lengths[i])
+    return parts
+
+
+def partition_karmarkar_karp(lengths, num_parts):
+    """
+    Balanced largest differencing method of Karmarkar and Karp. The sorted samples are cut into tuples of
+    num_parts, every tuple is a partial partition, and the two partial partitions with the largest spread are
+    merged repeatedly by pairing the heaviest part of one with the lightest part of the other.
+    """
+    counter = itertools.count()
+    order = np.argsort(-lengths, kind='stable').tolist()
+    heap = []
+    for start in range(0, len(order), num_parts):
+        parts = [[i] for i in order[start: start + num_parts]]
+        loads = [int(lengths[i]) for i in order[start: start + num_parts]]
+        heapq.heappush(heap, (min(loads) - max(loads), next(counter), loads, parts))
+    while len(heap) > 1:
+        _, _, loads_a, parts_a = heapq.heappop(heap)
+        _, _, loads_b, parts_b = heapq.heappop(heap)
+        order_a = sorted(range(num_parts), key=lambda p: loads_a[p])
+        order_b = sorted(range(num_parts), key=lambda p: -loads_b[p])
+        loads = [loads_a[a] + loads_b[b] for a, b in zip(order_a, order_b)]
+        parts = [parts_a[a] + parts_b[b] for a, b in zip(order_a, order_b)]
+        heapq.heappush(heap, (min(loads) - max(loads), next(counter), loads, parts))
+    return heap[0][3]
+
+
+def load_imbalance(loads):
+    # how much longer the slowest rank works than the average one
+    loads = np.asarray(loads, dtype=np.float64)
+    return float(loads.max() / max(1.0, loads.mean()) - 1)
+
+
+class TokenBalancedBatchSampler:
+    """
+    Give every data-parallel rank a micro-batch of batch_size samples with about the same number of tokens.
+    The shuffled samples are taken window_steps global batches at a time, the window is sorted by length and cut
+    into global batches, then each global batch is partitioned across the ranks and the order of the steps inside
+    the window is shuffled. The plan is the same on every rank, so the imbalance of each step is known locally.
+    """
+    partition_funcs = {'greedy': partition_greedy, 'karmarkar_karp': partition_karmarkar_karp}
+
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False,
+                 window_steps=8, method='karmarkar_karp'):
+        if method not in self.partition_funcs:
+            raise ValueError(f'Unknown balancing method: {method}')
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.window_steps = window_steps
+        self.partition = self.partition_funcs[method]
+        self.epoch = 0
+        # imbalance of the steps yielded since the trainer last logged
+        self.recent_imbalances = []
+        self.start_batch = 0
+        self._plan_cache = (None, None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch):
+        self.start_batch = start_batch
+
+    def get_indices(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        num_samples = len(self.lengths)
+        indices = rng.permutation(num_samples) if self.shuffle else np.arange(num_samples)
+        global_batch_size = self.batch_size * self.num_replicas
+        if self.drop_last:
+            num_steps = num_samples // global_batch_size
+        else:
+            num_steps = -(-num_samples // global_batch_size)
+            # repeat the first samples so that every rank runs the same number of full steps
+            indices = np.resize(indices, num_steps * global_batch_size)
+        return indices[:num_steps * global_batch_size].reshape(num_steps, global_batch_size), rng
+
+    def get_plan(self, epoch):
+        """
+        Returns the batches of this rank and the imbalance of every step.
+        """
+        if self._plan_cache[0] == epoch:
+            return self._plan_cache[1]
+        steps, rng = self.get_indices(epoch)
+        batches, imbalances = [], []
+        for start in range(0, len(steps), self.window_steps):
+            window = steps[start: start + self.window_steps].reshape(-1)
+            window = window[np.argsort(-self.lengths[window], kind='stable')]
+            window_steps = window.reshape(-1, self.batch_size * self.num_replicas)
+            for step_idx in (rng.permutation(len(window_steps)) if self.shuffle else range(len(window_steps))):
+                step = window_steps[step_idx]
+                parts = self.partition(self.lengths[step], self.num_replicas)
+                batches.append(step[parts[self.rank]].tolist())
+                imbalances.append(load_imbalance([self.lengths[step[part]].sum() for part in parts]))
+        plan = (batches, np.asarray(imbalances))
+        self._plan_cache = (epoch, plan)
+        return plan
+
+    def baseline_imbalance(self, epoch=0):
+        # the imbalance when the ranks take the shuffled samples in turn like DistributedSampler
+        steps, _ = self.get_indices(epoch)
+        if not len(steps):
+            return 0.0
+        loads = self.lengths[steps].reshape(len(steps), self.batch_size, self.num_replicas).sum(axis=1)
+        return float(np.mean([load_imbalance(step_loads) for step_loads in loads]))
+
+    def mean_imbalance(self, epoch=0):
+        _, imbalances = self.get_plan(epoch)
+        return float(imbalances.mean()) if len(imbalances) else 0.0
+
+    def __iter__(self):
+        batches, imbalances = self.get_plan(self.epoch)
+        start_batch, self.start_batch = self.start_batch, 0
+        self.epoch += 1
+        for batch, imbalance in zip(batches[start_batch:], imbalances[start_batch:].tolist()):
+            self.recent_imbalances.append(imbalance)
+            yield batch
+
+    def __len__(self):
+        return len(self.get_plan(self.epoch)[0])
+
+
+class ShuffledBatchSampler:
+    """
+    Shuffle the samples every epoch and give every rank its own batches like DistributedSampler does, the order
+    is a numpy permutation so a resumed epoch can start from any batch without walking through the earlier ones.
+    """
+    def __init__(self, num_samples, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch):
+        self.start_batch = start_batch
+
+    def __len__(self):
+        global_batch_size = self.batch_size * self.num_replicas
+        if self.drop_last:
+            return self.num_samples // global_batch_size
+        return -(-self.num_samples // global_batch_size)
+
+    def __iter__(self):
+        num_batches = len(self)
+        start_batch, self.start_batch = self.start_batch, 0
+        epoch = self.epoch
+        self.epoch += 1
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + epoch).permutation(self.num_samples)
+        else:
+            indices = np.arange(self.num_samples)
+        # repeat the first samples so that every rank runs the same number of full batches
+        indices = np.resize(indices, num_batches * self.batch_size * self.num_replicas)
+        indices = indices.reshape(num_batches, self.num_replicas, self.batch_size)[:, self.rank]
+        for batch in indices[start_batch:]:
+            yield batch.tolist()
+
+
+class ResumableDataLoader(DataLoader):
+    """
+    Count the batches handed to the training loop, so that the epoch and the position inside it can be saved with
+    the checkpoints. After load_state_dict the next epoch seeks right to the saved position, the batch sampler or
+    the iterable dataset skips the consumed samples itself instead of the trainer collating and dropping them.
+    """
+    def __init__(self, *args, seed=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seed = seed
+        self.epoch = 0
+        self.current_epoch = 0
+        self.position = 0
+        # the trainer counts epochs from its own state, which differs from ours for datasets without length
+        self.epoch_offset = 0
+        self.resume_state = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch + self.epoch_offset
+
+    def seek(self, epoch, position):
+        self.batch_sampler.set_epoch(epoch)
+        self.batch_sampler.set_start_batch(position)
+
+    def state_dict(self):
+        return {'epoch': self.current_epoch, 'position': self.position, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        epoch, position = state['epoch'], state['position']
+        if not isinstance(self.dataset, IterableDataset) and position >= len(self):
+            epoch, position = epoch + 1, 0
+        self.resume_state = {'epoch': epoch, 'position': position}
+
+    def __iter__(self):
+        if self.resume_state is not None:
+            self.epoch_offset += self.resume_state['epoch'] - self.epoch
+            self.epoch, self.position = self.resume_state['epoch'], self.resume_state['position']
+            self.resume_state = None
+        else:
+            self.position = 0
+        self.current_epoch = self.epoch
+        self.seek(self.epoch, self.position)
+        self.epoch += 1
+        for batch in super().__iter__():
+            self.position += 1
+            yield batch
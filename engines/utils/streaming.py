@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/8 21:15
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : streaming.py
+# @Software: PyCharm
+from torch.utils.data import IterableDataset, get_worker_info
+from engines.utils.packing import PretrainPacker
+from engines.utils.data_files import get_file_format, open_text_file, iter_record_batches
+from engines.utils.samplers import ResumableDataLoader
+import random
+import json
+
+
+def read_texts(file_path, text_column='text'):
+    """
+    Read texts from a data file block by block, a .json file holding a whole array is loaded at once.
+    """
+    if get_file_format(file_path) in ('parquet', 'arrow'):
+        for batch in iter_record_batches(file_path, [text_column]):
+            yield from batch.column(0).to_pylist()
+        return
+    with open_text_file(file_path) as f:
+        if file_path.endswith('.json'):
+            first_char = f.read(1)
+            while first_char.isspace():
+                first_char = f.read(1)
+            f.seek(0)
+            if first_char == '[':
+                for row in json.load(f):
+                    yield row[text_column]
+                return
+        for line in f:
+            if file_path.endswith('.txt'):
+                yield line
+            elif line.strip():
+                yield json.loads(line)[text_column]
+
+
+class StreamingPretrainDataset(IterableDataset):
+    """
+    Read the corpus lazily and yield blocks of block_size tokens, every rank and every dataloader worker reads its
+    own shard so that nothing is tokenized twice.
+    """
+    def __init__(self, data_files, tokenizer, block_size, shuffle_buffer_size=10000, seed=0, rank=0,
+                 world_size=1, tokenize_batch_size=1000, eos_token_id=None, document_mask=False,
+                 label_pad_token_id=-100):
+        self.data_files = sorted(data_files)
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.eos_token_id = eos_token_id
+        self.document_mask = document_mask
+        self.label_pad_token_id = label_pad_token_id
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.tokenize_batch_size = tokenize_batch_size
+        self.epoch = 0
+        self.start_batch = 0
+        self.batch_size = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch, batch_size):
+        self.start_batch = start_batch
+        self.batch_size = batch_size
+
+    def get_skip_blocks(self):
+        # the dataloader takes the batches from the workers in turn, so the consumed batches of every worker are
+        # known from the global batch count
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        return max(0, -(-(self.start_batch - worker_id) // num_workers)) * self.batch_size
+
+    def _shard_texts(self, rng):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_shards = self.world_size * num_workers
+        shard_id = self.rank * num_workers + worker_id
+        data_files = list(self.data_files)
+        rng.shuffle(data_files)
+        if len(data_files) >= num_shards:
+            # shard by files
+            for file_path in data_files[shard_id::num_shards]:
+                yield from read_texts(file_path)
+        else:
+            # not enough files, shard by lines
+            line_idx = 0
+            for file_path in data_files:
+                for text in read_texts(file_path):
+                    if line_idx % num_shards == shard_id:
+                        yield text
+                    line_idx += 1
+
+    def _shuffle_texts(self, texts, rng):
+        if self.shuffle_buffer_size <= 1:
+            yield from texts
+            return
+        buffer = []
+        for text in texts:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(text)
+                continue
+            idx = rng.randrange(self.shuffle_buffer_size)
+            yield buffer[idx]
+            buffer[idx] = text
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _tokenize(self, texts):
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == self.tokenize_batch_size:
+                yield self.tokenizer(batch)['input_ids']
+                batch = []
+        if batch:
+            yield self.tokenizer(batch)['input_ids']
+
+    def __iter__(self):
+        # every worker shares the file order of the epoch but has its own shuffle buffer
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        file_rng = random.Random(self.seed + self.epoch)
+        buffer_rng = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker_id}')
+        texts = self._shuffle_texts(self._shard_texts(file_rng), buffer_rng)
+        packer = PretrainPacker(self.block_size, self.eos_token_id, self.document_mask, self.label_pad_token_id)
+        # blocks already trained on are packed again but never collated or sent to the main process
+        skip_blocks = self.get_skip_blocks()
+        for input_ids_list in self._tokenize(texts):
+            blocks = packer.pack(input_ids_list)
+            num_blocks = len(blocks['input_ids'])
+            if skip_blocks >= num_blocks:
+                skip_blocks -= num_blocks
+                continue
+            for i in range(skip_blocks, num_blocks):
+                yield {key: value[i] for key, value in blocks.items()}
+            skip_blocks = 0
+
+
+class StreamingDataLoader(ResumableDataLoader):
+    """
+    Tell the streaming dataset which epoch it is on and where to start, the dataset is copied into the workers so
+    its own counters can not be kept there.
+    """
+    def seek(self, epoch, position):
+        self.dataset.set_epoch(epoch)
+        self.dataset.set_start_batch(position, self.batch_size)
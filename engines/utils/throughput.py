@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/26 20:50
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : throughput.py
+# @Software: PyCharm
+from transformers import TrainerCallback
+import time
+import torch
+
+# dense bf16/fp16 tensor core TFLOPS, looked up by the device name in this order
+PEAK_TFLOPS = (
+    ('H100', 989.0), ('H800', 989.0), ('A100', 312.0), ('A800', 312.0), ('L40S', 362.0), ('L40', 181.0),
+    ('A6000', 155.0), ('A10', 125.0), ('V100', 125.0), ('4090', 165.0), ('3090', 71.0)
+)
+
+
+def get_peak_tflops():
+    if not torch.cuda.is_available():
+        return None
+    device_name = torch.cuda.get_device_name()
+    return next((tflops for name, tflops in PEAK_TFLOPS if name in device_name), None)
+
+
+def count_tokens(inputs, sync=True):
+    """
+    Returns the numbers of real tokens, of all tokens and of rows in a batch. The attention masks tell the padding,
+    segment ids of packed rows count as real tokens. Without sync the real tokens are left as a device tensor.
+    """
+    masks = [value for key, value in inputs.items() if key.endswith('attention_mask') and torch.is_tensor(value)]
+    if not masks:
+        masks = [value for key, value in inputs.items() if key.endswith('input_ids') and torch.is_tensor(value)]
+        num_tokens = sum(mask.numel() for mask in masks)
+        return num_tokens, num_tokens, sum(mask.size(0) for mask in masks)
+    num_tokens = sum((mask != 0).sum() for mask in masks)
+    return int(num_tokens) if sync else num_tokens, sum(mask.numel() for mask in masks), \
+        sum(mask.size(0) for mask in masks)
+
+
+def count_matmul_parameters(model):
+    """
+    Parameters taking part in the matrix multiplications, the input embeddings are only looked up. Packed 4-bit
+    weights hold two parameters per element.
+    """
+    num_parameters = sum(param.numel() * (2 if param.dtype == torch.uint8 else 1) for param in model.parameters())
+    input_embeddings, output_embeddings = model.get_input_embeddings(), model.get_output_embeddings()
+    if input_embeddings is not None and (output_embeddings is None or
+                                         output_embeddings.weight is not input_embeddings.weight):
+        num_parameters -= input_embeddings.weight.numel()
+    return num_parameters
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Measure the training of this device: real tokens per second, the padding fraction, the model FLOPs utilization,
+    the time spent waiting for the dataloader against the time spent in forward/backward and the peak memory.
+    The trainer calls start_batch when a batch arrives, the step and substep ends close it. On cuda the batches are
+    timed with events and the device is only synchronized when the metrics are read. The FLOPs of a token
+    are estimated as 6 * parameters + 12 * layers * hidden size * sequence length, recomputation by gradient
+    checkpointing is not counted.
+    """
+    def __init__(self, peak_tflops=None):
+        self.peak_tflops = peak_tflops
+        self.num_parameters = None
+        self.attention_flops = 0
+        self.batch_start = None
+        self.last_end = None
+        self.pending_times = []
+        self.pending_tokens = []
+        self.interval = self.new_meter()
+        self.total = self.new_meter()
+        self.max_memory = 0
+
+    @staticmethod
+    def new_meter():
+        return {'tokens': 0, 'all_tokens': 0, 'flops': 0.0, 'wait': 0.0, 'compute': 0.0}
+
+    @staticmethod
+    def mark():
+        # the host runs ahead of the device, an event records when the device gets to this point without waiting
+        if torch.cuda.is_available():
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def elapsed(start, end):
+        if isinstance(start, float):
+            return end - start
+        return start.elapsed_time(end) / 1000
+
+    def setup(self, model=None):
+        if model is not None:
+            # the value head models of trl wrap the language model
+            model = getattr(model, 'pretrained_model', model)
+            config = model.config
+            num_layers = getattr(config, 'num_hidden_layers', None) or getattr(config, 'num_layers', None)
+            self.num_parameters = count_matmul_parameters(model)
+            self.attention_flops = 12 * num_layers * config.hidden_size if num_layers else 0
+        if self.peak_tflops is None:
+            self.peak_tflops = get_peak_tflops()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.last_end = self.mark()
+
+    def start_batch(self, inputs=None):
+        self.batch_start = self.mark()
+        if self.last_end is not None:
+            # on the device this is the idle time between two batches
+            self.pending_times.append(('wait', self.last_end, self.batch_start))
+        if inputs is not None:
+            self.pending_tokens.append(count_tokens(inputs, sync=False))
+
+    def add_tokens(self, num_tokens, num_all_tokens, num_rows=1):
+        flops = 0.0
+        if self.num_parameters is not None:
+            sequence_length = num_tokens / max(1, num_rows)
+            flops = num_tokens * (6 * self.num_parameters + self.attention_flops * sequence_length)
+        for meter in (self.interval, self.total):
+            meter['tokens'] += num_tokens
+            meter['all_tokens'] += num_all_tokens
+            meter['flops'] += flops
+
+    def add_time(self, key, seconds):
+        self.interval[key] += seconds
+        self.total[key] += seconds
+
+    def end_batch(self):
+        if self.batch_start is None:
+            return
+        self.last_end = self.mark()
+        self.pending_times.append(('compute', self.batch_start, self.last_end))
+        self.batch_start = None
+
+    def pause(self):
+        # logging, saving and evaluating are neither waiting for data nor training
+        self.last_end = self.mark()
+
+    def flush(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        for key, start, end in self.pending_times:
+            self.add_time(key, self.elapsed(start, end))
+        for num_tokens, num_all_tokens, num_rows in self.pending_tokens:
+            self.add_tokens(int(num_tokens), num_all_tokens, num_rows)
+        self.pending_times, self.pending_tokens = [], []
+
+    def get_metrics(self, meter):
+        self.flush()
+        seconds = meter['wait'] + meter['compute']
+        metrics = {
+            'tokens_per_second': round(meter['tokens'] / seconds, 2) if seconds else 0.0,
+            'padding_fraction': round(1 - meter['tokens'] / meter['all_tokens'], 4) if meter['all_tokens'] else 0.0,
+            'data_wait_seconds': round(meter['wait'], 3),
+            'compute_seconds': round(meter['compute'], 3),
+            'data_wait_fraction': round(meter['wait'] / seconds, 4) if seconds else 0.0
+        }
+        if self.num_parameters is not None and self.peak_tflops and seconds:
+            metrics['mfu'] = round(meter['flops'] / seconds / (self.peak_tflops * 1e12), 4)
+        if torch.cuda.is_available():
+            self.max_memory = max(self.max_memory, torch.cuda.max_memory_allocated())
+            metrics['peak_memory_gb'] = round(torch.cuda.max_memory_allocated() / 2 ** 30, 2)
+        return metrics
+
+    def pop_interval_metrics(self):
+        metrics = self.get_metrics(self.interval)
+        self.interval = self.new_meter()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        return metrics
+
+    def summary(self):
+        metrics = self.get_metrics(self.total)
+        if torch.cuda.is_available():
+            metrics['peak_memory_gb'] = round(self.max_memory / 2 ** 30, 2)
+        return metrics
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.setup(model)
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self.end_batch()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.end_batch()
+
+    def on_log(self, args, state, control, **kwargs):
+        self.pause()
+
+    def on_save(self, args, state, control, **kwargs):
+        self.pause()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.pause()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/10 20:30
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : token_shards.py
+# @Software: PyCharm
+from engines.utils.streaming import read_texts
+from engines.utils.packing import document_positions
+from torch.utils.data import Dataset
+from multiprocessing import Pool
+import numpy as np
+import torch
+import json
+import os
+
+META_NAME = 'meta.json'
+_worker_tokenizer = None
+
+
+def token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def tokenize_file_to_shard(file_path, shard_path, tokenizer, eos_token_id=None, batch_size=1000):
+    """
+    Tokenize one file into a flat token file `shard_path.bin` and its document offsets `shard_path.idx.npy`,
+    documents are ended with eos_token_id when it is given.
+    """
+    dtype = token_dtype(len(tokenizer))
+    offsets = [0]
+
+    def flush(texts):
+        for input_ids in tokenizer(texts)['input_ids']:
+            if eos_token_id is not None and input_ids and input_ids[-1] != eos_token_id:
+                input_ids = input_ids + [eos_token_id]
+            np.asarray(input_ids, dtype=dtype).tofile(f)
+            offsets.append(offsets[-1] + len(input_ids))
+
+    with open(shard_path + '.bin.tmp', 'wb') as f:
+        batch = []
+        for text in read_texts(file_path):
+            batch.append(text)
+            if len(batch) == batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    os.replace(shard_path + '.bin.tmp', shard_path + '.bin')
+    with open(shard_path + '.idx.npy', 'wb') as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+    return {'num_tokens': offsets[-1], 'num_docs': len(offsets) - 1}
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(file_path, shard_path, eos_token_id):
+    return tokenize_file_to_shard(file_path, shard_path, _worker_tokenizer, eos_token_id)
+
+
+def write_token_shards(data_files, tokenizer, output_dir, eos_token_id=None, num_workers=None, logger=None):
+    """
+    Tokenize every file into its own shard under output_dir and write the meta file describing them.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    data_files = sorted(data_files)
+    shard_names = [f'shard-{i:05d}' for i in range(len(data_files))]
+    tasks = [(file_path, os.path.join(output_dir, name), eos_token_id)
+             for file_path, name in zip(data_files, shard_names)]
+    if num_workers is not None and num_workers > 1:
+        with Pool(num_workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+            results = pool.starmap(_tokenize_in_worker, tasks)
+    else:
+        results = [tokenize_file_to_shard(file_path, shard_path, tokenizer, eos_token_id)
+                   for file_path, shard_path, eos_token_id in tasks]
+    shards = []
+    for (file_path, _, _), name, result in zip(tasks, shard_names, results):
+        shards.append({'name': name, 'source': file_path, **result})
+        if logger is not None:
+            logger.info(f"Tokenized {file_path}: {result['num_docs']} docs, {result['num_tokens']} tokens.")
+    meta = {
+        'dtype': np.dtype(token_dtype(len(tokenizer))).name,
+        'tokenizer': tokenizer.name_or_path,
+        'vocab_size': len(tokenizer),
+        'eos_token_id': eos_token_id,
+        'shards': shards
+    }
+    with open(os.path.join(output_dir, META_NAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+class MemmapPretrainDataset(Dataset):
+    """
+    Slice fixed-size blocks out of memory-mapped token shards, the shards are opened lazily in every process so
+    that ranks and dataloader workers share the page cache. With document_mask the document offsets are used to
+    restart position ids and separate the documents of a block.
+    """
+    def __init__(self, shards_dir, block_size, document_mask=False, label_pad_token_id=-100):
+        with open(os.path.join(shards_dir, META_NAME), encoding='utf-8') as f:
+            meta = json.load(f)
+        shards = [shard for shard in meta['shards'] if shard['num_tokens'] > 0]
+        self.dtype = np.dtype(meta['dtype'])
+        self.vocab_size = meta['vocab_size']
+        self.paths = [os.path.join(shards_dir, shard['name'] + '.bin') for shard in shards]
+        self.cumulative_tokens = np.concatenate([[0], np.cumsum([shard['num_tokens'] for shard in shards])])
+        self.total_tokens = int(self.cumulative_tokens[-1])
+        self.block_size = block_size
+        self.document_mask = document_mask
+        self.label_pad_token_id = label_pad_token_id
+        self.document_starts = None
+        if document_mask:
+            self.document_starts = np.concatenate([
+                np.load(os.path.join(shards_dir, shard['name'] + '.idx.npy'))[:-1] + shard_start
+                for shard, shard_start in zip(shards, self.cumulative_tokens[:-1])
+            ]) if shards else np.empty(0, dtype=np.int64)
+        self._arrays = None
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = [np.memmap(path, dtype=self.dtype, mode='r') for path in self.paths]
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def get_tokens(self, start, end):
+        arrays = self._get_arrays()
+        pieces = []
+        shard_idx = int(np.searchsorted(self.cumulative_tokens, start, side='right')) - 1
+        while start < end:
+            shard_start = int(self.cumulative_tokens[shard_idx])
+            local_end = min(end, int(self.cumulative_tokens[shard_idx + 1])) - shard_start
+            pieces.append(arrays[shard_idx][start - shard_start: local_end])
+            start = shard_start + local_end
+            shard_idx += 1
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def __len__(self):
+        return self.total_tokens // self.block_size
+
+    def __getitem__(self, idx):
+        start, end = idx * self.block_size, (idx + 1) * self.block_size
+        input_ids = torch.from_numpy(self.get_tokens(start, end).astype(np.int64))
+        if not self.document_mask:
+            return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids), 'labels': input_ids.clone()}
+        first, last = np.searchsorted(self.document_starts, [start, end])
+        starts = np.zeros(self.block_size, dtype=bool)
+        starts[self.document_starts[first:last] - start] = True
+        starts[0] = True
+        position_ids, segment_ids = document_positions(starts)
+        labels = input_ids.masked_fill(torch.from_numpy(starts), self.label_pad_token_id)
+        return {'input_ids': input_ids, 'attention_mask': torch.from_numpy(segment_ids), 'labels': labels,
+                'position_ids': torch.from_numpy(position_ids)}
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/12/12 21:50
+# @Author : lishouxian
+# @Email : gzlishouxian@gmail.com
+# @File : tokenize_cache.py
+# @Software: PyCharm
+from datasets import load_from_disk
+import hashlib
+import heapq
+import json
+import time
+import os
+
+# bump it when the output of the preprocessors changes
+CACHE_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+RANK_INDEX_DIR = 'rank_index'
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_tokenizer(tokenizer):
+    sha256 = hashlib.sha256()
+    sha256.update(type(tokenizer).__name__.encode('utf-8'))
+    sha256.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode('utf-8'))
+    sha256.update(json.dumps(sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]),
+                             ensure_ascii=False).encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def assign_files_to_ranks(file_sizes, world_size):
+    """
+    Returns the rank of every file, the largest files go first and each to the rank with the fewest bytes so far.
+    """
+    owners = [0] * len(file_sizes)
+    loads = [(0, rank) for rank in range(world_size)]
+    for i in sorted(range(len(file_sizes)), key=lambda i: (-file_sizes[i], i)):
+        load, rank = heapq.heappop(loads)
+        owners[i] = rank
+        heapq.heappush(loads, (load + file_sizes[i], rank))
+    return owners
+
+
+class TokenizedFileCache:
+    """
+    Tokenized datasets saved per source file, the key covers the content of the file and every setting which
+    changes the tokenized result, so only new or changed files need to be processed again.
+    """
+    def __init__(self, cache_dir, logger):
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'files': {}, 'entries': {}}
+
+    def get_file_hash(self, file_path):
+        # reuse the content hash when neither size nor modification time changed
+        stat = os.stat(file_path)
+        record = self.manifest['files'].get(os.path.abspath(file_path))
+        if record is not None and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            return record['sha256']
+        file_hash = hash_file(file_path)
+        self.manifest['files'][os.path.abspath(file_path)] = {
+            'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash}
+        return file_hash
+
+    def get_key(self, file_path, settings):
+        key = {'version': CACHE_VERSION, 'file': self.get_file_hash(file_path), **settings}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def load(self, key):
+        if key not in self.manifest['entries']:
+            return None
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.exists(path):
+            return None
+        return load_from_disk(path)
+
+    def save(self, key, file_path, dataset):
+        dataset.save_to_disk(os.path.join(self.cache_dir, key))
+        self.manifest['entries'][key] = {
+            'source': os.path.abspath(file_path),
+            'num_rows': len(dataset),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    def write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_rank_index_path(self, run_id, rank):
+        return os.path.join(self.cache_dir, RANK_INDEX_DIR, f'{run_id}-{rank}.json')
+
+    def write_rank_index(self, run_id, rank, keys):
+        """
+        Save the keys of the files processed by this rank with their manifest records, keys maps file to key.
+        """
+        index = {
+            'keys': keys,
+            'files': {os.path.abspath(file_path): self.manifest['files'][os.path.abspath(file_path)]
+                      for file_path in keys},
+            'entries': {key: self.manifest['entries'][key] for key in keys.values()}
+        }
+        path = self.get_rank_index_path(run_id, rank)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def merge_rank_indexes(self, run_id, world_size):
+        keys = {}
+        for rank in range(world_size):
+            with open(self.get_rank_index_path(run_id, rank), encoding='utf-8') as f:
+                index = json.load(f)
+            keys.update(index['keys'])
+            self.manifest['files'].update(index['files'])
+            self.manifest['entries'].update(index['entries'])
+        return keys
+
+    def remove_rank_indexes(self, run_id, world_size):
+        for rank in range(world_size):
+            path = self.get_rank_index_path(run_id, rank)
+            if os.path.exists(path):
+                os.remove(path)
@@ -4,17 +4,217 @@
 # @Email : gzlishouxian@gmail.com
 # @File : trainer.py
 # @Software: PyCharm
-from transformers import Seq2SeqTrainer, Trainer
+from transformers import Seq2SeqTrainer, Trainer, TrainerCallback
 from transformers.modeling_utils import unwrap_model
-from trl import PPOTrainer
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from trl import PPOTrainer, DPOTrainer
 from trl.core import PPODecorators, logprobs_from_logits
+from engines.utils.samplers import TokenBudgetBatchSampler, TokenBalancedBatchSampler, compute_sample_lengths
+from engines.utils.samplers import ShuffledBatchSampler, ResumableDataLoader
+from engines.utils.streaming import StreamingPretrainDataset, StreamingDataLoader
+from engines.utils.token_shards import MemmapPretrainDataset
+from engines.utils.chunked_loss import get_output_embeddings, skip_output_embeddings, chunked_cross_entropy
+from engines.utils.throughput import ThroughputCallback
+from contextlib import contextmanager
+from torch.utils.data import DataLoader
+from peft import PeftModel
 from typing import Optional, List
+from loguru import logger
+from tqdm import tqdm
+import numpy as np
+import datasets
+import hashlib
+import json
 import torch
 import os
 import math
 
+# epoch and position of the train dataloader saved in every checkpoint
+DATA_STATE_NAME = 'data_state.json'
+
+
+class BatchSamplerMixin:
+    resumable_dataloader = None
+    resume_data_state = None
+
+    def train(self, resume_from_checkpoint=None, **kwargs):
+        self.resume_data_state = None
+        if isinstance(resume_from_checkpoint, str) and \
+                os.path.isfile(state_file := os.path.join(resume_from_checkpoint, DATA_STATE_NAME)):
+            with open(state_file, encoding='utf-8') as f:
+                self.resume_data_state = json.load(f)
+        train_result = super().train(resume_from_checkpoint=resume_from_checkpoint, **kwargs)
+        if (throughput := self.throughput_callback) is not None:
+            metrics = throughput.summary()
+            logger.info(f'Throughput metrics: {metrics}')
+            self.log_metrics('throughput', metrics)
+            self.save_metrics('throughput', metrics)
+        return train_result
+
+    @property
+    def throughput_callback(self):
+        return next((callback for callback in self.callback_handler.callbacks
+                     if isinstance(callback, ThroughputCallback)), None)
+
+    def training_step(self, model, inputs):
+        if (throughput := self.throughput_callback) is not None:
+            throughput.start_batch(inputs)
+        return super().training_step(model, inputs)
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        super()._save_checkpoint(model, trial, metrics=metrics)
+        if self.resumable_dataloader is not None and self.args.should_save:
+            output_dir = os.path.join(self._get_output_dir(trial=trial),
+                                      f'{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}')
+            state = {**self.resumable_dataloader.state_dict(), 'world_size': self.args.world_size}
+            with open(os.path.join(output_dir, DATA_STATE_NAME), 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=2)
+
+    def prepare_resumable_dataloader(self, dataloader):
+        self.resumable_dataloader = dataloader
+        state = self.resume_data_state
+        if state is None:
+            return dataloader
+        if state['world_size'] != self.args.world_size or state['seed'] != self.args.seed:
+            logger.warning('The data state of the checkpoint was saved with another world size or seed, '
+                           'the consumed batches are skipped by the trainer.')
+            return dataloader
+        dataloader.load_state_dict(state)
+        # the dataloader seeks by itself, the trainer must not skip the batches again
+        self.args.ignore_data_skip = True
+        logger.info(f"Resume the data from epoch {state['epoch']}, batch {state['position']}.")
+        return dataloader
+
+    def get_train_dataloader(self):
+        if isinstance(self.train_dataset, StreamingPretrainDataset):
+            # the streaming dataset shards itself across ranks and workers
+            return self.prepare_resumable_dataloader(StreamingDataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+                seed=self.args.seed
+            ))
+        if isinstance(self.train_dataset, MemmapPretrainDataset):
+            # a permutation of the blocks can be cut at any batch when resuming
+            batch_sampler = ShuffledBatchSampler(
+                len(self.train_dataset),
+                batch_size=self._train_batch_size,
+                num_replicas=self.args.world_size,
+                rank=self.args.process_index,
+                seed=self.args.seed,
+                drop_last=self.args.dataloader_drop_last
+            )
+            return self.prepare_resumable_dataloader(ResumableDataLoader(
+                self.train_dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+                seed=self.args.seed
+            ))
+        if self.args.max_tokens_per_batch is None and not self.args.token_balanced_sampler:
+            return super().get_train_dataloader()
+        if self.train_dataset is None:
+            raise ValueError('Trainer: training requires a train_dataset.')
+        if self.args.max_tokens_per_batch is not None and self.args.token_balanced_sampler:
+            raise ValueError('max_tokens_per_batch and token_balanced_sampler can not be used together.')
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        lengths = compute_sample_lengths(train_dataset, self.tokenizer, self.args.dataloader_num_workers or None)
+        if isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description='training')
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description='training')
+        if self.args.token_balanced_sampler:
+            batch_sampler = TokenBalancedBatchSampler(
+                lengths,
+                batch_size=self._train_batch_size,
+                num_replicas=self.args.world_size,
+                rank=self.args.process_index,
+                seed=self.args.seed,
+                drop_last=self.args.dataloader_drop_last,
+                window_steps=self.args.balance_window_steps,
+                method=self.args.balance_method
+            )
+            self.token_balanced_sampler = batch_sampler
+            logger.info(f'Token balanced batching: {len(batch_sampler)} batches per device, token imbalance: '
+                        f'{batch_sampler.baseline_imbalance():.2%} unbalanced, '
+                        f'{batch_sampler.mean_imbalance():.2%} balanced.')
+        else:
+            batch_sampler = TokenBudgetBatchSampler(
+                lengths,
+                max_tokens_per_batch=self.args.max_tokens_per_batch,
+                num_replicas=self.args.world_size,
+                rank=self.args.process_index,
+                seed=self.args.seed,
+                drop_last=self.args.dataloader_drop_last
+            )
+            logger.info(f'Token budget batching: {len(batch_sampler)} batches per device, '
+                        f'padding ratio: {batch_sampler.padding_ratio():.2%}')
+        # the batch sampler already shards batches across ranks, inputs are moved to device by the trainer
+        return self.prepare_resumable_dataloader(ResumableDataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            seed=self.args.seed
+        ))
+
+    def log(self, logs):
+        # mean imbalance of the steps since the last log, the sampler may run a few batches ahead of training
+        if (sampler := getattr(self, 'token_balanced_sampler', None)) is not None and sampler.recent_imbalances:
+            logs['token_imbalance'] = round(float(np.mean(sampler.recent_imbalances)), 4)
+            sampler.recent_imbalances.clear()
+        if 'loss' in logs and (throughput := self.throughput_callback) is not None:
+            metrics = throughput.pop_interval_metrics()
+            if self.is_world_process_zero():
+                logger.info(f'Step {self.state.global_step} throughput: {metrics}')
+            logs.update(metrics)
+        super().log(logs)
+
+
+class PretrainTrainer(BatchSamplerMixin, Trainer):
+    pass
+
+
+class SFTTrainer(BatchSamplerMixin, Seq2SeqTrainer):
+    def __init__(self, *args, eval_data_collator=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the eval and test sets are not packed, they keep the padding collator when the train set is packed
+        self.eval_data_collator = eval_data_collator
+
+    @contextmanager
+    def use_eval_data_collator(self):
+        data_collator = self.data_collator
+        if self.eval_data_collator is not None:
+            self.data_collator = self.eval_data_collator
+        try:
+            yield
+        finally:
+            self.data_collator = data_collator
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        with self.use_eval_data_collator():
+            return super().get_eval_dataloader(eval_dataset)
+
+    def get_test_dataloader(self, test_dataset):
+        with self.use_eval_data_collator():
+            return super().get_test_dataloader(test_dataset)
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if not self.args.chunked_ce_loss or return_outputs or self.label_smoother is not None \
+                or 'labels' not in inputs:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+        labels = inputs.pop('labels')
+        lm_head = get_output_embeddings(unwrap_model(model))
+        with skip_output_embeddings(lm_head):
+            outputs = model(**inputs)
+        hidden_states = outputs['logits'] if isinstance(outputs, dict) else outputs[0]
+        return chunked_cross_entropy(hidden_states, labels, lm_head, self.args.ce_chunk_size)
 
-class SFTTrainer(Seq2SeqTrainer):
     def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs):
         prompt_len, label_len = inputs['input_ids'].size(-1), inputs['labels'].size(-1)
         if prompt_len > label_len:
@@ -41,31 +241,314 @@ class SFTTrainer(Seq2SeqTrainer):
         return padded_tensor.contiguous()
 
 
-class RewardTrainer(Trainer):
+def last_token_indices(attention_mask):
+    # works for both padding sides
+    return attention_mask.size(-1) - 1 - attention_mask.flip(-1).int().argmax(-1)
+
+
+@contextmanager
+def gather_last_values(v_head, last_indices, seq_first=False, rows=None):
+    """
+    Apply the value head only to the hidden state of the last real token of every sequence, the values come out
+    with shape [batch]. With rows several values can be read from the same row.
+    """
+    def forward(hidden_states):
+        indices = last_indices.to(hidden_states.device)
+        if rows is None:
+            batch_indices = torch.arange(len(indices), device=hidden_states.device)
+        else:
+            batch_indices = rows.to(hidden_states.device)
+        if seq_first:
+            hidden_states = hidden_states[indices, batch_indices]
+        else:
+            hidden_states = hidden_states[batch_indices, indices]
+        return type(v_head).forward(v_head, hidden_states)
+
+    v_head.forward = forward
+    try:
+        yield
+    finally:
+        del v_head.forward
+
+
+class RewardTrainer(BatchSamplerMixin, Trainer):
     def __init__(self, model_type, **kwargs):
         super().__init__(**kwargs)
         self.model_type = model_type
         self.can_return_loss = True
 
     def compute_loss(self, model, inputs, return_outputs=False):
+        if 'group_sizes' in inputs:
+            return self.compute_grouped_loss(model, inputs, return_outputs)
         batch_size = int(inputs['input_ids'].size(0) / 2)
-        _, _, values = model(**inputs)
-        if self.model_type == 'chatglm':
-            values = torch.transpose(values, 1, 0)
-        r_accept, r_reject = values[:, -1].split(batch_size, dim=0)
+        value_model = unwrap_model(model)
+        last_indices = last_token_indices(inputs['attention_mask'])
+        # the lm head is skipped and the value head only sees the last real token, the hidden states of chatglm
+        # are sequence first
+        with skip_output_embeddings(get_output_embeddings(value_model.pretrained_model)), \
+                gather_last_values(value_model.v_head, last_indices, seq_first=self.model_type == 'chatglm'):
+            _, _, values = model(**inputs)
+        r_accept, r_reject = values.split(batch_size, dim=0)
         loss = -torch.nn.functional.logsigmoid(r_accept - r_reject).mean()
         outputs = {'r_accept': r_accept, 'r_reject': r_reject}
         return (loss, outputs) if return_outputs else loss
 
+    def compute_grouped_loss(self, model, inputs, return_outputs=False):
+        """
+        Every row holds a prompt and its responses from the best to the worst, see
+        DataCollatorForSharedPromptRewardModel. The loss is averaged over all ordered pairs of every group.
+        """
+        value_rows, value_positions = inputs.pop('value_rows'), inputs.pop('value_positions')
+        group_sizes = inputs.pop('group_sizes').tolist()
+        value_model = unwrap_model(model)
+        with skip_output_embeddings(get_output_embeddings(value_model.pretrained_model)), \
+                gather_last_values(value_model.v_head, value_positions, rows=value_rows):
+            _, _, values = model(**inputs)
+        losses, r_accept, r_reject = [], [], []
+        for group_values in values.split(group_sizes):
+            differences = group_values[:, None] - group_values[None, :]
+            better = torch.ones_like(differences, dtype=torch.bool).triu(1)
+            losses.append(-torch.nn.functional.logsigmoid(differences[better]))
+            r_accept.append(group_values[0])
+            # the best response has to beat all the others
+            r_reject.append(group_values[1:].max())
+        loss = torch.cat(losses).mean()
+        outputs = {'r_accept': torch.stack(r_accept), 'r_reject': torch.stack(r_reject)}
+        return (loss, outputs) if return_outputs else loss
+
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         output_dir = self.args.output_dir if output_dir is None else output_dir
         self.model = unwrap_model(self.model)
-        state_dict = self.model.state_dict()
+        # only the value head, the backbone is saved as the adapter
+        state_dict = {f'v_head.{key}': value for key, value in self.model.v_head.state_dict().items()}
         torch.save(state_dict, os.path.join(output_dir, 'vhead.bin'))
         self.model.pretrained_model.save_pretrained(output_dir)
         torch.save(self.args, os.path.join(output_dir, 'training_args.bin'))
 
 
+class PrecomputedReferenceModel(torch.nn.Module):
+    """
+    Stands for the reference model when its log-probs are precomputed, so that DPOTrainer does not copy the
+    policy as the reference.
+    """
+    def forward(self, *args, **kwargs):
+        raise RuntimeError('The reference log-probs are precomputed, the reference model can not be called.')
+
+
+class ReferenceLogProbsCollator:
+    """
+    Put the precomputed reference log-probs into the features by their reference_index before collating, the
+    dataloaders are built before the log-probs are known and read them when the batches are collated.
+    """
+    def __init__(self, data_collator):
+        self.data_collator = data_collator
+        self.log_probs = None
+
+    def __call__(self, features):
+        if self.log_probs is not None:
+            for feature in features:
+                log_probs = self.log_probs[int(feature['reference_index'])]
+                feature['reference_chosen_logps'], feature['reference_rejected_logps'] = log_probs
+        return self.data_collator(features)
+
+
+class ReferenceLogProbsCallback(TrainerCallback):
+    """
+    The trainer and deepspeed place and partition the model only when the training begins, the reference log-probs
+    are computed then, before the first batch is read.
+    """
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.trainer.prepare_reference_log_probs()
+
+
+class MyDPOTrainer(BatchSamplerMixin, DPOTrainer):
+    def __init__(self, *args, precompute_ref_log_probs=False, reference_key='', reference_adapter=None, **kwargs):
+        self.precompute_ref_log_probs = precompute_ref_log_probs
+        self.reference_key = reference_key
+        # the frozen adapter giving the reference, the reference disables the adapters when it is None
+        self.reference_adapter = reference_adapter
+        if precompute_ref_log_probs and kwargs.get('ref_model') is None and \
+                not isinstance(kwargs.get('model'), PeftModel):
+            kwargs['ref_model'] = PrecomputedReferenceModel()
+        super().__init__(*args, **kwargs)
+        # the collators of this repo return the same keys as DPODataCollatorWithPadding
+        self.use_dpo_data_collator = True
+        if precompute_ref_log_probs:
+            self.accelerator.__dict__.pop('prepare_model', None)
+            self.ref_model = None
+            self.data_collator = ReferenceLogProbsCollator(self.data_collator)
+            # the eval samples are numbered after the train samples
+            self.train_dataset = self.add_reference_index(self.train_dataset, 0)
+            if self.eval_dataset is not None:
+                self.eval_dataset = self.add_reference_index(self.eval_dataset, len(self.train_dataset))
+            # ahead of the other callbacks, so the throughput meters start after the precompute
+            self.callback_handler.callbacks.insert(0, ReferenceLogProbsCallback(self))
+
+    def create_accelerator_and_postprocess(self):
+        super().create_accelerator_and_postprocess()
+        if isinstance(self.ref_model, PrecomputedReferenceModel):
+            # trl prepares the given reference model, the stub has nothing to place or wrap
+            prepare_model = self.accelerator.prepare_model
+            self.accelerator.prepare_model = lambda model, *args, **kwargs: model if isinstance(
+                model, PrecomputedReferenceModel) else prepare_model(model, *args, **kwargs)
+
+    @staticmethod
+    def add_reference_index(dataset, offset):
+        format_type = dataset.format['type']
+        dataset = dataset.add_column('reference_index', np.arange(offset, offset + len(dataset)))
+        dataset.set_format(format_type)
+        return dataset
+
+    @contextmanager
+    def reference_context(self):
+        """
+        Let the peft policy act as the reference, by switching to the frozen reference adapter or by disabling the
+        adapter.
+        """
+        model = self.accelerator.unwrap_model(self.model)
+        if self.reference_adapter is None:
+            with model.disable_adapter():
+                yield
+            return
+        active_adapter = model.active_adapter
+        model.set_adapter(self.reference_adapter)
+        try:
+            yield
+        finally:
+            model.set_adapter(active_adapter)
+
+    @torch.no_grad()
+    def compute_reference_log_probs(self, dataset, desc):
+        # the new adapter or the untouched weights make the policy the same as the reference before training
+        dataloader = self.accelerator.prepare(DataLoader(
+            dataset,
+            batch_size=self.args.per_device_eval_batch_size,
+            collate_fn=self.data_collator.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory
+        ))
+        model = self.accelerator.unwrap_model(self.model)
+        training = model.training
+        model.eval()
+        log_probs = []
+        for batch in tqdm(dataloader, desc=desc, disable=not self.is_local_process_zero()):
+            batch = self._prepare_inputs(batch)
+            if isinstance(model, PeftModel):
+                with self.reference_context():
+                    chosen_logps, rejected_logps, _, _ = self.concatenated_forward(model, batch)
+            else:
+                chosen_logps, rejected_logps, _, _ = self.concatenated_forward(model, batch)
+            log_probs.append(self.accelerator.gather_for_metrics(
+                torch.stack([chosen_logps, rejected_logps], dim=-1)).float().cpu().numpy())
+        model.train(training)
+        return np.concatenate(log_probs) if log_probs else np.empty((0, 2), dtype=np.float32)
+
+    def load_reference_log_probs(self, dataset, split):
+        """
+        Compute the reference log-probs of every sample once, they are saved as a memory-mapped .npy file keyed by
+        the dataset and the reference model, so later runs on the same data read them back.
+        """
+        key = hashlib.sha256(f'{dataset._fingerprint}|{self.reference_key}'.encode('utf-8')).hexdigest()[:16]
+        log_probs_dir = os.path.join(self.args.output_dir, 'reference_log_probs')
+        log_probs_file = os.path.join(log_probs_dir, f'{split}-{key}.npy')
+        if os.path.exists(log_probs_file):
+            logger.info(f'Load the reference log-probs from {log_probs_file}')
+            log_probs = np.load(log_probs_file, mmap_mode='r')
+        else:
+            log_probs = self.compute_reference_log_probs(dataset, desc=f'Computing {split} reference log-probs')
+            if self.is_world_process_zero():
+                os.makedirs(log_probs_dir, exist_ok=True)
+                memmap = np.lib.format.open_memmap(log_probs_file + '.tmp', mode='w+', dtype=np.float32,
+                                                   shape=log_probs.shape)
+                memmap[:] = log_probs
+                memmap.flush()
+                del memmap
+                os.replace(log_probs_file + '.tmp', log_probs_file)
+                logger.info(f'Reference log-probs saved to {log_probs_file}')
+        if len(log_probs) != len(dataset):
+            raise ValueError(f'{log_probs_file} holds {len(log_probs)} rows, but the dataset has {len(dataset)}.')
+        return np.asarray(log_probs, dtype=np.float32)
+
+    def prepare_reference_log_probs(self):
+        if not self.precompute_ref_log_probs or self.data_collator.log_probs is not None:
+            return
+        log_probs = [self.load_reference_log_probs(self.train_dataset, 'train')]
+        if self.eval_dataset is not None:
+            log_probs.append(self.load_reference_log_probs(self.eval_dataset, 'eval'))
+        self.data_collator.log_probs = np.concatenate(log_probs)
+
+    def evaluate(self, *args, **kwargs):
+        # evaluating without training
+        self.prepare_reference_log_probs()
+        return super().evaluate(*args, **kwargs)
+
+    def concatenated_forward(self, model, batch):
+        if 'input_ids' not in batch:
+            return super().concatenated_forward(model, batch)
+        return self.packed_forward(model, batch)
+
+    def packed_forward(self, model, batch):
+        """
+        Forward the packed row of DataCollatorForPackedDPODataset, the log-probs of the tokens are summed into their
+        sequences by the segment ids, the first half of the sequences are the chosen ones.
+        """
+        segment_ids = batch['attention_mask']
+        num_sequences = int(segment_ids.max())
+        logits = model(
+            input_ids=batch['input_ids'],
+            attention_mask=segment_ids,
+            position_ids=batch['position_ids']
+        ).logits[0, :-1].float()
+        labels, label_segment_ids = batch['labels'][0, 1:], segment_ids[0, 1:]
+        per_token_logps = -torch.nn.functional.cross_entropy(
+            logits, labels, ignore_index=self.label_pad_token_id, reduction='none')
+        logps = per_token_logps.new_zeros(num_sequences + 1).index_add(0, label_segment_ids, per_token_logps)[1:]
+        # the mean logit of every token stands for the logits in the metrics, the padding position is left out
+        token_logits = logits.detach().mean(dim=-1)
+        chosen_tokens = (label_segment_ids > 0) & (label_segment_ids <= num_sequences // 2)
+        rejected_tokens = label_segment_ids > num_sequences // 2
+        chosen_logps, rejected_logps = logps.split(num_sequences // 2)
+        return chosen_logps, rejected_logps, token_logits[chosen_tokens], token_logits[rejected_tokens]
+
+    def get_reference_log_probs(self, batch):
+        if 'reference_chosen_logps' in batch:
+            return batch['reference_chosen_logps'], batch['reference_rejected_logps']
+        with torch.no_grad():
+            if self.ref_model is None:
+                with self.reference_context():
+                    reference_chosen_logps, reference_rejected_logps, _, _ = self.concatenated_forward(self.model, batch)
+            else:
+                reference_chosen_logps, reference_rejected_logps, _, _ = self.concatenated_forward(
+                    self.ref_model, batch)
+        return reference_chosen_logps, reference_rejected_logps
+
+    def get_batch_metrics(self, model, batch, train_eval='train'):
+        metrics = {}
+        policy_chosen_logps, policy_rejected_logps, policy_chosen_logits, policy_rejected_logits = \
+            self.concatenated_forward(model, batch)
+        reference_chosen_logps, reference_rejected_logps = self.get_reference_log_probs(batch)
+        losses, chosen_rewards, rejected_rewards = self.dpo_loss(
+            policy_chosen_logps,
+            policy_rejected_logps,
+            reference_chosen_logps.to(policy_chosen_logps.dtype),
+            reference_rejected_logps.to(policy_rejected_logps.dtype)
+        )
+        reward_accuracies = (chosen_rewards > rejected_rewards).float()
+        prefix = 'eval_' if train_eval == 'eval' else ''
+        metrics[f'{prefix}rewards/chosen'] = chosen_rewards.cpu().numpy().mean()
+        metrics[f'{prefix}rewards/rejected'] = rejected_rewards.cpu().numpy().mean()
+        metrics[f'{prefix}rewards/accuracies'] = reward_accuracies.cpu().numpy().mean()
+        metrics[f'{prefix}rewards/margins'] = (chosen_rewards - rejected_rewards).cpu().numpy().mean()
+        metrics[f'{prefix}logps/rejected'] = policy_rejected_logps.detach().cpu().numpy().mean()
+        metrics[f'{prefix}logps/chosen'] = policy_chosen_logps.detach().cpu().numpy().mean()
+        metrics[f'{prefix}logits/rejected'] = policy_rejected_logits.detach().cpu().numpy().mean()
+        metrics[f'{prefix}logits/chosen'] = policy_chosen_logits.detach().cpu().numpy().mean()
+        return losses.mean(), metrics
+
+
 class MyPPOTrainer(PPOTrainer):
     def __init__(self, model_type, **kwargs):
         super().__init__(**kwargs)
@@ -74,3 +74,13 @@ if __name__ == '__main__':
         # 扩充词表
         model = BaseModels(data_manager, config, logger)
         model.expand_vocab()
+    elif mode == 'dataset_stats':
+        # 数据集统计
+        data_manager.dataset_stats()
+    elif mode == 'tokenize_corpus':
+        # 预训练语料离线分词
+        data_manager.tokenize_corpus()
+    elif mode == 'estimate_memory':
+        # 估算训练显存
+        model = BaseModels(data_manager, config, logger)
+        model.estimate_memory()